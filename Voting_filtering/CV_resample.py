@@ -3,7 +3,6 @@ from src.NN import get_model
 from src.callbacks import LossMetricHistory
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from keras.utils import to_categorical
-from keras.models import load_model
 from src.utils import *
 from sklearn.metrics import roc_auc_score
 
@@ -11,9 +10,11 @@ from sklearn.metrics import roc_auc_score
 # Data import and making train, test and validation sets
 sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38] #[33,34]
 path_to_data = os.path.join(os.pardir,'sample_data')
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3), resample_to=323)
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+data = DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                       windows=[(0.2, 0.5)],
+                                                                       baseline_window=(0.2, 0.3), resample_to=323,
+                                                                       lazy=True, max_memory=0, n_jobs=-1)
 # Some files for logging
 logdir = os.path.join(os.getcwd(),'logs', 'cf', 'CV_resampled', '323Hz')
 
@@ -193,15 +194,14 @@ for sbj in sbjs:
         bestepochs = np.array([])
         model = get_model(time_samples_num, channels_num, dropouts=dropouts)
         callback = LossMetricHistory(n_iter=epochs,
-                                     verbose=1, fname_bestmodel=os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)))
-        model.fit(X_tr, to_categorical(y_tr), epochs=epochs,
-                         validation_data=(X_val, to_categorical(y_val)), callbacks=[callback],
+                                     verbose=1, fname_bestmodel=os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)),
+                                     restore_best=True, validation_data=(X_val, to_categorical(y_val)))
+        model.fit(X_tr, to_categorical(y_tr), epochs=epochs, callbacks=[callback],
                          batch_size=64, shuffle=True)
         bestepochs = np.append(bestepochs, callback.bestepoch + 1)
 
 
         # Testing and saving predictions
-        model = load_model(os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)))
         y_pred_tr = model.predict(X_tr)[:, 0]
         y_pred_val = model.predict(X_val)[:, 0]
         y_pred_test = model.predict(X_test)
@@ -8,262 +8,241 @@ tf.set_random_seed(random_state)
 
 from src.data import DataBuildClassifier
 from src.NN import get_model
-from src.callbacks import LossMetricHistory
+from src.folds import train_folds, new_session
+from src.scheduler import schedule_subjects
+from src.filtering import select_errors
 from sklearn.model_selection import train_test_split, StratifiedKFold
 
 import sys
 from keras.utils import to_categorical
-from keras.models import load_model
 from sklearn.metrics import roc_auc_score
+from functools import partial
+import multiprocessing
 import os
-if len(sys.argv) < 4:
-    print("Usage: \n"
-          "python %s path_to_data path_to_logs filtration_rate[0...0.5)"%sys.argv[0],
-          "[compute_noisy_ens (0 or 1, default 1)] [compute_noisy_naive (0 or 1, default 1)]\n"
-          "For example, if you want to discard 10% of data in each class \n"
-          "and then train the network again, use something like: \n"
-          "%s ../Data ./logs/cf 0.1"%sys.argv[0])
-    exit()
-
-filt_rate = sys.argv[3]
-logdir = sys.argv[2] #os.path.join(os.getcwd(),'logs', 'cf_ensemble_naive_fr%s'%filt_rate)
-if not os.path.isdir(logdir):
-    os.makedirs(logdir)
-fname_ens = os.path.join(logdir, 'auc_scores_ens.csv')
-with open(fname_ens, 'w') as fout:
-    fout.write('subject,auc_noisy,auc_pure,samples_before,samples_after\n')
-
-fname_nai = os.path.join(logdir, 'auc_scores_naive.csv')
-with open(fname_nai, 'w') as fout:
-    fout.write('subject,auc_noisy,auc_pure,samples_before,samples_after, best_epoch\n')
-
-with open(os.path.join(logdir, 'err_ind_ens.csv'), 'w') as fout:
-    fout.write('subject,class,indices\n')
-with open(os.path.join(logdir, 'err_ind_naive.csv'), 'w') as fout:
-    fout.write('subject,class,indices\n')
-
-epochs = 150
-dropouts = (0.72,0.32,0.05)
-nfold = 4
-
-path_to_data = sys.argv[1] # '/home/likan_blk/BCI/NewData/'
-sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3), resample_to=323)
-dropouts = (0.72,0.32,0.05)
-
-mean_val_aucs=[]
-test_aucs_naive = []
-test_aucs_ensemble = []
-
-for sbj in sbjs:
+
+
+def load_subject(sbj, params):
+    '''
+    Loads preprocessed data of one subject (from the cache, filled by the main process)
+    '''
+    data = DataBuildClassifier(params['path_to_data'], cache_dir=params['cache_dir']).get_data(
+        [sbj], shuffle=False, windows=[(0.2, 0.5)], baseline_window=(0.2, 0.3), resample_to=323)
+    return data[sbj][0], data[sbj][1]
+
+
+def split_rates(y_pred, y_train, train_ind, rates):
+    '''
+    Splits training samples into the most erroneous ones of each class and pure ones for every filtration rate
+    (from one partial sorting of predictions)
+    :return: dict {rate: (pure_ind (shuffled), err_nontarg_ind, err_target_ind)} - indices into the initial X array
+    '''
+    sets = {}
+    for rate, (pure_ind, err_nontarg_ind, err_target_ind) in zip(rates, select_errors(
+            y_pred, y_train, train_ind, [float(rate) for rate in rates])):
+        # Removing instances with noisy labels
+        np.random.RandomState(random_state).shuffle(pure_ind)
+        sets[rate] = (pure_ind, err_nontarg_ind, err_target_ind)
+    return sets
+
+
+def train_noisy(sbj, params):
+    '''
+    Cross-validation on the noisy training set of a subject and the naive model trained on the whole noisy
+    training set. Their predictions clean the data for all filtration rates (ensemble and naive models)
+    '''
     np.random.seed(random_state)
-    tf.set_random_seed(random_state)
 
-    X, y = data[sbj][0], data[sbj][1]
+    X, y = load_subject(sbj, params)
     train_ind, test_ind = train_test_split(np.arange(len(y)), shuffle=True,
                                            test_size=0.2, stratify=y,
                                            random_state=random_state)
     X_train, y_train, X_test, y_test = X[train_ind], y[train_ind], X[test_ind], y[test_ind]
-    val_inds = []
-    fold_pairs = []
-    cv = StratifiedKFold(n_splits=4, shuffle=False)
+    folds = []
+    cv = StratifiedKFold(n_splits=params['nfold'], shuffle=False)
     for tr_ind, val_ind in cv.split(X_train, y_train):
-        X_tr, X_val = X_train[tr_ind], X_train[val_ind]
-        y_tr, y_val = y_train[tr_ind], y_train[val_ind]
-        fold_pairs.append((X_tr, y_tr, X_val, y_val))
-        val_inds.append(train_ind[val_ind])  # indices of all the validation instances in the initial X array
-
+        folds.append((train_ind[tr_ind], train_ind[val_ind]))
 
     bestepochs = np.array([])
-    time_samples_num = X_train.shape[1]
-    channels_num = X_train.shape[2]
     y_pred = 0
     y_pred_test = 0
-    for fold in fold_pairs:
-        X_tr, y_tr, X_val, y_val = fold[0], to_categorical(fold[1]), fold[2], to_categorical(fold[3])
-        y_val_bin = fold[3]
-
-        np.random.seed(random_state)
-        tf.set_random_seed(random_state)
-
-        model = get_model(time_samples_num, channels_num, dropouts=dropouts)
-        callback = LossMetricHistory(n_iter=epochs,verbose=1,
-                                     fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(nfold)))
-        hist = model.fit(X_tr, y_tr, epochs=epochs,
-                        validation_data=(X_val, y_val), callbacks=[callback],
-                        batch_size=64, shuffle=False)
-        bestepochs = np.append(bestepochs, callback.bestepoch+1)
+    # Folds are trained one after another in this worker, every one is seeded with random_state
+    fold_results = train_folds(X, y, folds, epochs=params['epochs'], dropouts=params['dropouts'],
+                               predict_on={'train': train_ind, 'test': test_ind},
+                               seed=random_state, shuffle=False, verbose=1,
+                               n_jobs=1, intra_op_threads=params['threads'],
+                               patience=params['patience'], min_epochs=params['min_epochs'],
+                               cache_dir=params['fold_cache'])
+    for fold in fold_results:
+        bestepochs = np.append(bestepochs, fold['bestepoch'])
 
         # Validation and data cleaning
-        model = load_model(os.path.join(logdir, "model%s.hdf5"%(nfold)))
-        y_pred += model.predict(X_train)[:,1]   #  ensemble predictions
-        y_pred_test += model.predict(X_test)[:,1]
-
+        y_pred += fold['predictions']['train'][:,1]   #  ensemble predictions
+        y_pred_test += fold['predictions']['test'][:,1]
     bestepoch = int(round(bestepochs.mean()))
 
+    # Mean-epoch (naive) model on the whole noisy training set, shared by all filtration rates
+    new_session(params['threads'], seed=random_state)
+    model = get_model(X_train.shape[1], X_train.shape[2], dropouts=params['dropouts'])
+    model.fit(X_train, to_categorical(y_train), epochs=bestepoch, batch_size=64)
+    y_pred_naive = model.predict(X_train)[:, 1]
+    # Compare to old (noisy) ensemble model
+    auc_noisy_naive = roc_auc_score(y_test, model.predict(X_test)[:, 1])
+
     # Data cleaning
-    filt_rate = float(filt_rate)
-    #ind = np.array(val_inds[i])  # indices of validation samples in the initial dataset
-    n_err1 = int(np.round(y_train.sum() * filt_rate))  # Number of samples in target class to be thrown away
-    n_err0 = int(np.round((len(y_train) - y_train.sum()) * filt_rate))  # Number of samples in nontarget class
-                                                                        # to be thrown away
-
-    #######################################
-    ########### Ensemble model ############
-    #######################################
-    np.random.seed(random_state)
-    tf.set_random_seed(random_state)
-
-    y_pred /= nfold
-    pure_ind = np.array([], dtype=np.int32)
-    err_nontarg_ind = np.array([], dtype=np.int32)
-    err_target_ind = np.array([], dtype=np.int32)
-
-    argsort0 = np.argsort(y_pred[y_train == 0])[::-1]   # Descending sorting of predictions for nontarget class
-                                                        # so that the most erroneous sample are at the
-                                                        # beginning of the array
-    argsort1 = np.argsort(y_pred[y_train == 1])     # Ascending Sorting of predictions for target class
-                                                    # so that the most erroneous sample are at the
-                                                    # beginning of the array
-    target_ind = train_ind[y_train == 1][argsort1]
-    nontarg_ind = train_ind[y_train == 0][argsort0]
-    err_target_ind = np.append(err_target_ind, target_ind[:n_err1])
-    err_nontarg_ind = np.append(err_nontarg_ind, nontarg_ind[:n_err0])  # Take demanded amount of error samples
-    pure_ind = np.append(pure_ind, target_ind[n_err1:])
-    pure_ind = np.append(pure_ind, nontarg_ind[n_err0:])
-
-    # Removing instances with noisy labels
-    np.random.shuffle(pure_ind)
-    X_train_pure = X[pure_ind]
-    y_train_pure = y[pure_ind]
-
-    # Saving erroneous sample indices
-    with open(os.path.join(logdir, 'err_ind_ens.csv'), 'a') as fout:
-        fout.write(str(sbj))
-        fout.write(',0,')
-        fout.write(','.join(map(str, err_nontarg_ind)))
-        fout.write('\n')
-        fout.write(str(sbj))
-        fout.write(',1,')
-        fout.write(','.join(map(str, err_target_ind)))
-        fout.write('\n')
+    return {'sbj': sbj, 'train_ind': train_ind, 'test_ind': test_ind,
+            'auc_noisy_ens': roc_auc_score(y_test, y_pred_test), 'auc_noisy_naive': auc_noisy_naive,
+            'bestepoch': bestepoch,
+            'ensemble': split_rates(y_pred / params['nfold'], y_train, train_ind, params['filt_rates']),
+            'naive': split_rates(y_pred_naive, y_train, train_ind, params['filt_rates'])}
 
-    # Train ensemble model on pure data
-    y_train_pure = to_categorical(y_train_pure)
 
-    cv = StratifiedKFold(n_splits=nfold, shuffle=False)
-    fold_pairs_pure = []
-    y_pred_pure = 0
-    for fold, (tr_ind, val_ind) in enumerate(cv.split(X_train_pure, y_train_pure[:,1])):
-        X_tr, X_val = X_train_pure[tr_ind], X_train_pure[val_ind]
-        y_tr, y_val = y_train_pure[tr_ind], y_train_pure[val_ind]
-        fold_pairs_pure.append((X_tr, y_tr, X_val, y_val))
-        callback = LossMetricHistory(n_iter=epochs, verbose=1,
-                                     fname_bestmodel=os.path.join(logdir, "model%s_ens_pure.hdf5" % (nfold)))
-        np.random.seed(random_state)
-        tf.set_random_seed(random_state)
-        model_pure = get_model(time_samples_num, channels_num, dropouts=dropouts)
-        model_pure.fit(X_tr, y_tr, epochs=epochs,
-                       validation_data=(X_val, y_val), callbacks=[callback],
-                       batch_size=64, shuffle=False)
-        model_pure = load_model(os.path.join(logdir, "model%s_ens_pure.hdf5" % (nfold)))
-        y_pred_pure += model_pure.predict(X_test)[:, 1]
-
-    y_pred_pure /= nfold
+def train_ensemble(state, params, rate):
+    '''
+    Ensemble model: cleaning by the ensemble of noisy fold models and the ensemble of pure fold models
+    '''
+    np.random.seed(random_state)
 
-    # Compare to old (noisy) ensemble model
-    samples_before = y_train.shape[0]
-    samples_after= y_train_pure.shape[0]
+    X, y = load_subject(state['sbj'], params)
+    test_ind = state['test_ind']
+    pure_ind, err_nontarg_ind, err_target_ind = state['ensemble'][rate]
 
-    auc_noisy_ens = roc_auc_score(y_test, y_pred_test)
-    auc_pure_ens = roc_auc_score(y_test, y_pred_pure)
+    # Train ensemble model on pure data
+    cv = StratifiedKFold(n_splits=params['nfold'], shuffle=False)
+    folds_pure = [(pure_ind[tr_ind], pure_ind[val_ind])
+                  for tr_ind, val_ind in cv.split(X[pure_ind], y[pure_ind])]
+    y_pred_pure = 0
+    for fold in train_folds(X, y, folds_pure, epochs=params['epochs'], dropouts=params['dropouts'],
+                            predict_on={'test': test_ind}, seed=random_state, shuffle=False, verbose=1,
+                            n_jobs=1, intra_op_threads=params['threads'],
+                            patience=params['patience'], min_epochs=params['min_epochs']):
+        y_pred_pure += fold['predictions']['test'][:, 1]
 
-    #######################################
-    ###### Mean-epoch (naive) model #######
-    #######################################
-    np.random.seed(random_state)
-    tf.set_random_seed(random_state)
+    y_pred_pure /= params['nfold']
 
-    pure_ind = np.array([], dtype=np.int32)
-    err_nontarg_ind = np.array([], dtype=np.int32)
-    err_target_ind = np.array([], dtype=np.int32)
+    # Compare to old (noisy) ensemble model
+    return {'auc_noisy': state['auc_noisy_ens'], 'auc_pure': roc_auc_score(y[test_ind], y_pred_pure),
+            'samples_after': len(pure_ind), 'err_nontarg_ind': err_nontarg_ind, 'err_target_ind': err_target_ind}
 
-    np.random.seed(random_state)
-    tf.set_random_seed(random_state)
 
-    model = get_model(time_samples_num, channels_num, dropouts=dropouts)
-    model.fit(X_train, to_categorical(y_train), epochs=bestepoch, batch_size=64)
-    y_pred = model.predict(X_train)[:, 1]
-    argsort0 = np.argsort(y_pred[y_train == 0])[::-1]   # Descending sorting of predictions for nontarget class
-                                                        # so that the most erroneous sample are at the
-                                                        # beginning of the array
-    argsort1 = np.argsort(y_pred[y_train == 1])     # Ascending Sorting of predictions for target class
-                                                    # so that the most erroneous sample are at th
-                                                    # beginning of the array
-    target_ind = train_ind[y_train == 1][argsort1]
-    nontarg_ind = train_ind[y_train == 0][argsort0]
-    err_target_ind = np.append(err_target_ind, target_ind[:n_err1])
-    err_nontarg_ind = np.append(err_nontarg_ind, nontarg_ind[:n_err0])  # Take demanded amount of error samples
-    pure_ind = np.append(pure_ind, target_ind[n_err1:])
-    pure_ind = np.append(pure_ind, nontarg_ind[n_err0:])
-
-    # Removing instances with noisy labels
-    np.random.shuffle(pure_ind)
-    X_train_pure = X[pure_ind]
-    y_train_pure = y[pure_ind]
-
-    # Saving erroneous sample indices
-    with open(os.path.join(logdir, 'err_ind_naive.csv'), 'a') as fout:
-        fout.write(str(sbj))
-        fout.write(',0,')
-        fout.write(','.join(map(str, err_nontarg_ind)))
-        fout.write('\n')
-        fout.write(str(sbj))
-        fout.write(',1,')
-        fout.write(','.join(map(str, err_target_ind)))
-        fout.write('\n')
+def train_naive(state, params, rate):
+    '''
+    Mean-epoch (naive) model: cleaning by a single model trained on the whole noisy training set
+    '''
+    X, y = load_subject(state['sbj'], params)
+    test_ind = state['test_ind']
+    time_samples_num = X.shape[1]
+    channels_num = X.shape[2]
+    pure_ind, err_nontarg_ind, err_target_ind = state['naive'][rate]
 
     # Train naive model on pure data
-    y_train_pure = to_categorical(y_train_pure)
-
-    cv = StratifiedKFold(n_splits=nfold, shuffle=False)
-    fold_pairs_pure = []
-    y_pred_pure = 0
+    cv = StratifiedKFold(n_splits=params['nfold'], shuffle=False)
+    folds_pure = [(pure_ind[tr_ind], pure_ind[val_ind])
+                  for tr_ind, val_ind in cv.split(X[pure_ind], y[pure_ind])]
     bestepochs = np.array([])
 
-    for fold, (tr_ind, val_ind) in enumerate(cv.split(X_train_pure, y_train_pure[:,1])):
-        X_tr, X_val = X_train_pure[tr_ind], X_train_pure[val_ind]
-        y_tr, y_val = y_train_pure[tr_ind], y_train_pure[val_ind]
-        callback = LossMetricHistory(n_iter=epochs, verbose=1)
-                                     #fname_bestmodel=os.path.join(logdir, "model%s_naive_pure.hdf5" % (fold)))
-        np.random.seed(random_state)
-        tf.set_random_seed(random_state)
-        model_pure = get_model(time_samples_num, channels_num, dropouts=dropouts)
-        model_pure.fit(X_tr, y_tr, epochs=epochs,
-                       validation_data=(X_val, y_val), callbacks=[callback],
-                       batch_size=64)
-        bestepochs = np.append(bestepochs, callback.bestepoch + 1)
+    for fold in train_folds(X, y, folds_pure, epochs=params['epochs'], dropouts=params['dropouts'],
+                            seed=random_state, verbose=1,
+                            n_jobs=1, intra_op_threads=params['threads'],
+                            patience=params['patience'], min_epochs=params['min_epochs']):
+        bestepochs = np.append(bestepochs, fold['bestepoch'])
     bestepoch = int(round(bestepochs.mean()))
 
-    np.random.seed(random_state)
-    tf.set_random_seed(random_state)
-
-    model_pure = get_model(time_samples_num, channels_num, dropouts=dropouts)
-    model_pure.fit(X_train_pure, y_train_pure, epochs=bestepoch, batch_size=64)
-    y_pred_pure = model_pure.predict(X_test)[:, 1]
-
-    # Compare to old (noisy) ensemble model
-    y_pred = model.predict(X_test)[:, 1]
-    auc_noisy_naive = roc_auc_score(y_test, y_pred)
-    auc_pure_naive = roc_auc_score(y_test, y_pred_pure)
-
-    #######################################
-    # Write results
-    with open(fname_ens, 'a') as fout:
-        fout.write(u"%s,%.04f,%.04f,%s,%s\n"%(sbj, auc_noisy_ens, auc_pure_ens,
-                                                            samples_before, samples_after))
-    with open(fname_nai, 'a') as fout:
-        fout.write(u"%s,%.04f,%.04f,%s,%s,%s\n"%(sbj, auc_noisy_naive, auc_pure_naive, samples_before,
-                                                             samples_after, bestepoch))
+    new_session(params['threads'], seed=random_state)
+    model_pure = get_model(time_samples_num, channels_num, dropouts=params['dropouts'])
+    model_pure.fit(X[pure_ind], to_categorical(y[pure_ind]), epochs=bestepoch, batch_size=64)
+    y_pred_pure = model_pure.predict(X[test_ind])[:, 1]
+
+    return {'auc_noisy': state['auc_noisy_naive'], 'auc_pure': roc_auc_score(y[test_ind], y_pred_pure),
+            'samples_after': len(pure_ind), 'bestepoch': bestepoch,
+            'err_nontarg_ind': err_nontarg_ind, 'err_target_ind': err_target_ind}
+
+
+def write_results(sbj, state, results, rates, logdir):
+    '''
+    Appends results of a subject for all filtration rates to the log files (called in order of subjects)
+    '''
+    samples_before = len(state['train_ind'])
+    for rate in rates:
+        ens, nai = results['ensemble%s' % rate], results['naive%s' % rate]
+        # Saving erroneous sample indices
+        for fname_err, res in [('err_ind_ens.csv', ens), ('err_ind_naive.csv', nai)]:
+            with open(os.path.join(logdir, fname_err), 'a') as fout:
+                fout.write('%s,%s,0,' % (sbj, rate))
+                fout.write(','.join(map(str, res['err_nontarg_ind'])))
+                fout.write('\n')
+                fout.write('%s,%s,1,' % (sbj, rate))
+                fout.write(','.join(map(str, res['err_target_ind'])))
+                fout.write('\n')
+
+        with open(os.path.join(logdir, 'auc_scores_ens.csv'), 'a') as fout:
+            fout.write(u"%s,%s,%.04f,%.04f,%s,%s\n"%(sbj, rate, ens['auc_noisy'], ens['auc_pure'],
+                                                     samples_before, ens['samples_after']))
+        with open(os.path.join(logdir, 'auc_scores_naive.csv'), 'a') as fout:
+            fout.write(u"%s,%s,%.04f,%.04f,%s,%s,%s\n"%(sbj, rate, nai['auc_noisy'], nai['auc_pure'], samples_before,
+                                                        nai['samples_after'], nai['bestepoch']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        # Only lines with the script name are %-formatted
+        print("Usage: \n"
+              "python %s path_to_data path_to_logs filtration_rate[0...0.5) [filtration_rate ...]"%sys.argv[0])
+        print("For example, if you want to discard 10% of data in each class \n"
+              "and then train the network again, use something like:")
+        print("%s ../Data ./logs/cf 0.1"%sys.argv[0])
+        print("Several rates are evaluated with one noisy cross-validation: %s ../Data ./logs/cf 0.05 0.1"%sys.argv[0])
+        exit()
+
+    filt_rates = sys.argv[3:]
+    logdir = sys.argv[2] #os.path.join(os.getcwd(),'logs', 'cf_ensemble_naive_fr%s'%filt_rate)
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    fname_ens = os.path.join(logdir, 'auc_scores_ens.csv')
+    with open(fname_ens, 'w') as fout:
+        fout.write('subject,filt_rate,auc_noisy,auc_pure,samples_before,samples_after\n')
+
+    fname_nai = os.path.join(logdir, 'auc_scores_naive.csv')
+    with open(fname_nai, 'w') as fout:
+        fout.write('subject,filt_rate,auc_noisy,auc_pure,samples_before,samples_after, best_epoch\n')
+
+    with open(os.path.join(logdir, 'err_ind_ens.csv'), 'w') as fout:
+        fout.write('subject,filt_rate,class,indices\n')
+    with open(os.path.join(logdir, 'err_ind_naive.csv'), 'w') as fout:
+        fout.write('subject,filt_rate,class,indices\n')
+
+    epochs = 150
+    # Early stopping: no improvement of validation AUC for patience epochs (but not before min_epochs)
+    patience = 30
+    min_epochs = 40
+    dropouts = (0.72,0.32,0.05)
+    nfold = 4
+
+    path_to_data = sys.argv[1] # '/home/likan_blk/BCI/NewData/'
+    sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+    # Preprocess all subjects into the cache in advance, workers read their subjects from it
+    DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                    windows=[(0.2, 0.5)],
+                                                                    baseline_window=(0.2, 0.3), resample_to=323,
+                                                                    lazy=True, max_memory=0, n_jobs=-1)
+
+    # Subjects (and their final models) are processed in parallel, one single-threaded worker per core.
+    # A worker trains folds one after another: workers can not start processes of their own
+    n_workers = multiprocessing.cpu_count()
+    # The noisy cross-validation is cached: runs with other filtration rates skip it
+    fold_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'fold_cache')
+    params = {'path_to_data': path_to_data, 'cache_dir': cache_dir, 'fold_cache': fold_cache,
+              'epochs': epochs, 'dropouts': dropouts,
+              'patience': patience, 'min_epochs': min_epochs,
+              'nfold': nfold, 'filt_rates': filt_rates, 'threads': max(multiprocessing.cpu_count() // n_workers, 1)}
+
+    # Ensemble and naive models of a subject for all rates are independent and trained in parallel
+    # after the noisy CV and the noisy naive model. Rows of a subject are written as soon as it and
+    # all previous subjects are done
+    jobs = {}
+    for rate in filt_rates:
+        jobs['ensemble%s' % rate] = partial(train_ensemble, params=params, rate=rate)
+        jobs['naive%s' % rate] = partial(train_naive, params=params, rate=rate)
+    schedule_subjects(sbjs, partial(train_noisy, params=params), jobs=jobs,
+                      finish=partial(write_results, rates=filt_rates, logdir=logdir),
+                      n_workers=n_workers)
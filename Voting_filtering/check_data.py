@@ -0,0 +1,146 @@
+'''
+Checks the data layer (tools/data.py) on random fake subjects against the original get_data: reading of
+eegT.mat and eegNT.mat, baseline subtraction, mne resampling and windowing as they were before the data layer
+was optimized. Then other paths of get_data are compared to the plain one: the cache (first and repeated reads,
+rebuild after the source files change), lazy loading, loading in a process pool (n_jobs) with and without
+the cache, and shuffling (in place for fresh data, a copy for cached data). Needs scipy and mne (as get_data
+itself), no TensorFlow.
+Usage: python check_data.py
+'''
+from __future__ import print_function
+import os
+import sys
+import random
+import shutil
+import tempfile
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'tools'))
+from data import DataBuildClassifier
+
+subjects = [25, 26, 27]
+params = {'windows': [(0.2, 0.5)], 'baseline_window': (0.2, 0.3), 'resample_to': 323}
+start_epoch, end_epoch, sample_rate = -0.5, 1, 500
+
+
+def write_subject(path_to_data, subject, rng, n_target=20, n_nontarget=60):
+    '''
+    Random walk EEG of a subject in the format of the experiments (Time x Channels x Trials)
+    '''
+    from scipy.io import savemat
+    subject_dir = os.path.join(path_to_data, str(subject))
+    if not os.path.isdir(subject_dir):
+        os.makedirs(subject_dir)
+    for name, n_trials in (('eegT', n_target), ('eegNT', n_nontarget)):
+        savemat(os.path.join(subject_dir, '%s.mat' % name),
+                {name: np.cumsum(rng.randn(750, 27, n_trials), axis=0)})
+
+
+def original_get_data(path_to_data, subject, windows=None, baseline_window=(), resample_to=None):
+    '''
+    get_data of one subject as it was before the optimizations (without shuffling)
+    '''
+    from scipy.io import loadmat
+    from mne.filter import resample
+    eegT = loadmat(os.path.join(path_to_data, str(subject), 'eegT.mat'))['eegT']
+    eegNT = loadmat(os.path.join(path_to_data, str(subject), 'eegNT.mat'))['eegNT']
+    X = np.concatenate((eegT, eegNT), axis=-1).transpose(2, 0, 1)
+    rate = sample_rate
+    if len(baseline_window):
+        bl_start = int((baseline_window[0] - start_epoch) * rate)
+        bl_end = int((baseline_window[1] - start_epoch) * rate)
+        X = X - X[:, bl_start:bl_end, :].mean(axis=1)[:, np.newaxis, :]
+    y = np.hstack((np.ones(eegT.shape[2]), np.zeros(eegNT.shape[2])))
+    if resample_to is not None and resample_to != rate:
+        X = resample(X, up=1., down=X.shape[1] / (resample_to * (end_epoch - start_epoch)), npad='auto', axis=1)
+        rate = resample_to
+    if windows is not None:
+        time_indices = []
+        for win_start, win_end in windows:
+            time_indices.extend(range(int((win_start - start_epoch) * rate), int((win_end - start_epoch) * rate)))
+        X = X[:, time_indices, :]
+    return X, y
+
+
+def same(data1, data2, rtol=1e-5):
+    '''
+    Whether two {subject: (X, y)} results are equal (X up to float32 rounding)
+    '''
+    for subject in subjects:
+        (X1, y1), (X2, y2) = data1[subject], data2[subject]
+        if X1.shape != X2.shape or not np.array_equal(y1, y2) or \
+                np.abs(np.asarray(X1, np.float64) - X2).max() > rtol * np.abs(X2).max():
+            return False
+    return True
+
+
+def shuffled(data):
+    '''
+    Unshuffled {subject: (X, y)} permuted as get_data(shuffle=True) does: as the original data_shuffle did
+    '''
+    res = {}
+    for subject, (X, y) in data.items():
+        perm = list(range(len(y)))
+        random.Random(1).shuffle(perm)
+        res[subject] = (X[perm], y[perm])
+    return res
+
+
+def main():
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path_to_data = os.path.join(tmp_dir, 'data')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        for subject in subjects:
+            write_subject(path_to_data, subject, rng)
+
+        plain = DataBuildClassifier(path_to_data).get_data(subjects, shuffle=False, **params)
+        no_resampling = dict(params, resample_to=None)
+        cached = DataBuildClassifier(path_to_data, cache_dir=cache_dir)
+        checks = [
+            ('original get_data', lambda: same(plain, dict((subject, original_get_data(path_to_data, subject, **params))
+                                                           for subject in subjects))),
+            ('original get_data, no resampling', lambda: same(
+                DataBuildClassifier(path_to_data).get_data(subjects, shuffle=False, **no_resampling),
+                dict((subject, original_get_data(path_to_data, subject, **no_resampling)) for subject in subjects))),
+            ('cache, first read', lambda: same(cached.get_data(subjects, shuffle=False, **params), plain, rtol=0)),
+            ('cache, repeated read', lambda: same(cached.get_data(subjects, shuffle=False, **params), plain, rtol=0)
+                and not cached.get_data(subjects, shuffle=False, **params)[subjects[0]][0].flags.writeable),
+            ('lazy', lambda: same(cached.get_data(subjects, shuffle=False, lazy=True, max_memory=0, **params),
+                                  plain, rtol=0)),
+            ('process pool', lambda: same(DataBuildClassifier(path_to_data).get_data(subjects, shuffle=False,
+                                                                                      n_jobs=2, **params),
+                                          plain, rtol=0)),
+            ('process pool with cache', lambda: same(
+                DataBuildClassifier(path_to_data, cache_dir=os.path.join(tmp_dir, 'cache2')).get_data(
+                    subjects, shuffle=False, n_jobs=2, **params), plain, rtol=0)),
+            ('shuffle (in place)', lambda: same(DataBuildClassifier(path_to_data).get_data(subjects, **params),
+                                                shuffled(plain), rtol=0)),
+            # Cached data is shuffled in a copy, the cache itself stays unshuffled
+            ('shuffle of cached data', lambda: same(cached.get_data(subjects, **params), shuffled(plain), rtol=0)
+                and same(cached.get_data(subjects, shuffle=False, **params), plain, rtol=0)),
+        ]
+        failed = False
+        for name, check in checks:
+            ok = check()
+            failed = failed or not ok
+            print('%-40s %s' % (name, 'OK' if ok else 'FAILED'))
+
+        # New source files of a subject (of another size) make its cache entry stale
+        write_subject(path_to_data, subjects[0], rng, n_target=21)
+        X, y = cached.get_data(subjects[:1], shuffle=False, **params)[subjects[0]]
+        X_new, y_new = original_get_data(path_to_data, subjects[0], **params)
+        ok = X.shape == X_new.shape and np.array_equal(y, y_new) and \
+            np.abs(X - X_new).max() <= 1e-5 * np.abs(X_new).max()
+        failed = failed or not ok
+        print('%-40s %s' % ('cache rebuild after source change', 'OK' if ok else 'FAILED'))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return failed
+
+
+if __name__ == '__main__':
+    # The process pool needs the guard on platforms without fork
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,60 @@
+'''
+Import-time budget of light entry points: pmean.py, the data layer (tools/data.py, tools/ingest.py)
+and numpy inference (src/inference.py).
+Every entry point is run in a fresh interpreter. It fails if it takes longer than its budget or if it loads
+any of the heavy packages, which should be imported only by code paths that need them.
+Usage: python check_import_time.py
+'''
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+HEAVY = ['mne', 'matplotlib', 'sklearn', 'keras', 'tensorflow', 'scipy.signal', 'scipy.io']
+here = os.path.dirname(os.path.abspath(__file__))
+tools = os.path.join(os.path.dirname(here), 'tools')
+
+# Child process: prints seconds spent in the statement and the heavy modules loaded by it
+child = '''
+import sys, time
+sys.path[:0] = %r
+t = time.time()
+%s
+print(time.time() - t)
+print(' '.join(name for name in %r if name in sys.modules))
+'''
+
+tmp_dir = tempfile.mkdtemp()
+auc_file = os.path.join(tmp_dir, 'aucs.csv')
+with open(auc_file, 'w') as f:
+    f.write('subj,auc_1,auc_2\n')
+    for sbj in range(25, 35):
+        f.write('%d,%f,%f\n' % (sbj, 0.8 + 0.01 * (sbj % 3), 0.78 + 0.01 * (sbj % 5)))
+
+# (name, statement, sys.path entries, budget in seconds, allowed heavy modules)
+entry_points = [
+    ('import tools/data.py', 'import data', [tools], 0.5, []),
+    ('import tools/ingest.py', 'import ingest', [tools], 0.5, []),
+    ('import src/utils.py', 'import src.utils', [here], 0.5, []),
+    ('import src/inference.py', 'import src.inference', [here], 0.5, []),
+    # Most of pmean.py is the import of scipy.stats for the Wilcoxon test (~1.3 s with scipy 1.17)
+    ('run pmean.py', 'sys.argv = ["pmean.py", %r]; exec(open(%r).read())' % (auc_file, os.path.join(here, 'pmean.py')),
+     [here], 2.5, []),
+]
+
+failed = False
+try:
+    for name, statement, path, budget, allowed in entry_points:
+        out = subprocess.check_output([sys.executable, '-c', child % (path, statement, HEAVY)], cwd=here)
+        lines = out.decode().splitlines()
+        seconds, loaded = float(lines[-2]), [mod for mod in lines[-1].split() if mod not in allowed]
+        ok = seconds <= budget and not loaded
+        failed = failed or not ok
+        print('%-25s %6.3f s (budget %.1f s)%s %s' % (name, seconds, budget,
+                                                     ', loads ' + ' '.join(loaded) if loaded else '',
+                                                     'OK' if ok else 'FAILED'))
+finally:
+    shutil.rmtree(tmp_dir)
+sys.exit(1 if failed else 0)
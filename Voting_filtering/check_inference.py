@@ -0,0 +1,123 @@
+'''
+Checks NumpyModel (src/inference.py) against a straightforward forward pass of get_model (src/NN.py) in float64:
+layers are applied one by one in the order of Keras (batch normalization before pooling, 'same' convolutions
+as sums of shifted inputs), with random weights and negative batch normalization scales.
+Weights are also passed through a Keras-style HDF5 file and an .npz file of export. Needs h5py (for the HDF5
+file), no TensorFlow.
+Usage: python check_inference.py
+'''
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+from src.inference import NumpyModel, export, BN_EPSILON, POOL_SIZE
+
+rng = np.random.RandomState(0)
+n_trials, time_samples_num, channels_num = 37, 97, 27
+
+
+def random_weights():
+    '''
+    Random weights of get_model in the order of Model.get_weights()
+    '''
+    def bn(n):
+        # gamma (with negative values), beta, moving mean, moving variance
+        return [rng.randn(n), rng.randn(n), rng.randn(n) * 0.1, rng.rand(n) + 0.5]
+    flat = 4 * (16 // 4) * (time_samples_num // 4 // 4)
+    return ([rng.randn(1, channels_num, 16) * 0.3, rng.randn(16) * 0.1] + bn(16) +
+            [rng.randn(2, 32, 1, 4) * 0.1, rng.randn(4) * 0.1] + bn(4) +
+            [rng.randn(8, 4, 4, 4) * 0.2, rng.randn(4) * 0.1] + bn(4) +
+            [rng.randn(flat, 2) * 0.2, rng.randn(2) * 0.1])
+
+
+def elu(x):
+    return np.where(x > 0, x, np.exp(np.minimum(x, 0)) - 1)
+
+
+def batch_norm(x, gamma, beta, mean, var, axis):
+    shape = [1] * x.ndim
+    shape[axis] = -1
+    return (x - mean.reshape(shape)) / np.sqrt(var.reshape(shape) + BN_EPSILON) * gamma.reshape(shape) + \
+           beta.reshape(shape)
+
+
+def conv2d_same(x, kernel, bias):
+    '''
+    Conv2D with 'same' padding (the smaller half before the data, as in TensorFlow), channels_first
+    '''
+    kh, kw = kernel.shape[:2]
+    n, c, h, w = x.shape
+    padded = np.zeros((n, c, h + kh - 1, w + kw - 1))
+    padded[:, :, (kh - 1) // 2:(kh - 1) // 2 + h, (kw - 1) // 2:(kw - 1) // 2 + w] = x
+    out = np.zeros((n, kernel.shape[3], h, w))
+    for i in range(kh):
+        for j in range(kw):
+            out += np.einsum('nchw,co->nohw', padded[:, :, i:i + h, j:j + w], kernel[i, j])
+    return out + bias[:, None, None]
+
+
+def max_pool(x):
+    ph, pw = POOL_SIZE
+    n, c, h, w = x.shape
+    out = np.zeros((n, c, h // ph, w // pw))
+    for i in range(h // ph):
+        for j in range(w // pw):
+            out[:, :, i, j] = x[:, :, i * ph:(i + 1) * ph, j * pw:(j + 1) * pw].max(axis=(2, 3))
+    return out
+
+
+def reference_predict(weights, X):
+    w = [np.asarray(value, dtype=np.float64) for value in weights]
+    x = elu(np.einsum('ntc,cf->ntf', X, w[0][0]) + w[1])
+    x = x.reshape(len(X), 1, 16, time_samples_num)  # Reshape((1, 16, time_samples_num)) of Keras
+    x = batch_norm(x, *w[2:6], axis=2)
+    x = max_pool(batch_norm(elu(conv2d_same(x, w[6], w[7])), *w[8:12], axis=1))
+    x = max_pool(batch_norm(elu(conv2d_same(x, w[12], w[13])), *w[14:18], axis=1))
+    x = np.dot(x.reshape(len(X), -1), w[18]) + w[19]
+    x = np.exp(x - x.max(axis=1, keepdims=True))
+    return x / x.sum(axis=1, keepdims=True)
+
+
+def write_keras_weights(fname, weights):
+    '''
+    HDF5 file in the layout of Model.save_weights of get_model (the weight names do not matter for reading)
+    '''
+    import h5py
+    layers = [('conv1d', 2), ('bn1', 4), ('conv2d1', 2), ('bn2', 4), ('conv2d2', 2), ('bn3', 4), ('dense', 2)]
+    with h5py.File(fname, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _ in layers]
+        start = 0
+        for name, n_weights in layers:
+            group = f.create_group(name)
+            weight_names = ['%s/w%d' % (name, i) for i in range(n_weights)]
+            group.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name in weight_names]
+            for weight_name, value in zip(weight_names, weights[start:start + n_weights]):
+                group.create_dataset(weight_name, data=value)
+            start += n_weights
+
+
+weights = [value.astype(np.float32) for value in random_weights()]
+X = rng.randn(n_trials, time_samples_num, channels_num).astype(np.float32)
+expected = reference_predict(weights, X)
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    write_keras_weights(os.path.join(tmp_dir, 'model.hdf5'), weights)
+    export(weights, os.path.join(tmp_dir, 'model.npz'))
+    models = [('NumpyModel.from_weights', NumpyModel.from_weights(weights)),
+              ('NumpyModel.from_keras_file', NumpyModel.from_keras_file(os.path.join(tmp_dir, 'model.hdf5'))),
+              ('NumpyModel.load (export)', NumpyModel.load(os.path.join(tmp_dir, 'model.npz')))]
+finally:
+    shutil.rmtree(tmp_dir)
+
+failed = False
+for name, model in models:
+    # A batch size which does not divide the number of trials
+    y_pred = model.predict(X, batch_size=16)
+    error = np.abs(y_pred - expected).max()
+    ok = y_pred.shape == expected.shape and error < 1e-4
+    failed = failed or not ok
+    print('%-30s max error %.2e %s' % (name, error, 'OK' if ok else 'FAILED'))
+sys.exit(1 if failed else 0)
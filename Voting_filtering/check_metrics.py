@@ -0,0 +1,97 @@
+'''
+Checks fast numpy code of scoring and filtering against the code it replaced, on random data (numpy only, no
+TensorFlow):
+fast_auc (src/utils.py) against sklearn's roc_auc_score (or a brute-force AUC over all pairs without sklearn),
+with and without tied scores, and select_errors (src/filtering.py) against the argsort selection which
+classification_filtering.py and cf_ensemble_naive.py used before.
+Usage: python check_metrics.py
+'''
+from __future__ import print_function
+import sys
+import numpy as np
+from src.utils import fast_auc
+from src.filtering import select_errors
+
+rng = np.random.RandomState(0)
+n_trials = 300
+
+
+def pairs_auc(y_true, y_score):
+    '''
+    AUC by definition: share of (target, nontarget) pairs ordered right, tied pairs count as one half
+    '''
+    pos, neg = y_score[y_true == 1][:, None], y_score[y_true == 0][None, :]
+    return ((pos > neg).sum() + 0.5 * (pos == neg).sum()) / float(pos.size * neg.size)
+
+
+try:
+    from sklearn.metrics import roc_auc_score
+    reference_auc, reference_name = roc_auc_score, 'roc_auc_score'
+except ImportError:
+    reference_auc, reference_name = pairs_auc, 'brute-force AUC'
+
+
+def select_errors_argsort(y_pred, y_true, ind, rate):
+    '''
+    Selection of erroneous samples of a fold as it was in classification_filtering.py
+    '''
+    n_err1 = int(np.round(y_true.sum()*rate))  # Number of samples in target class to be thrown away
+    n_err0 = int(np.round((len(y_true)-y_true.sum())*rate))  # Number of samples in nontarget class
+    argsort0 = np.argsort(y_pred[y_true==0])[::-1]  # Descending sorting of predictions for nontarget class
+    argsort1 = np.argsort(y_pred[y_true==1])  # Ascending sorting of predictions for target class
+    target_ind = ind[y_true==1][argsort1]
+    nontarg_ind = ind[y_true==0][argsort0]
+    return np.append(target_ind[n_err1:], nontarg_ind[n_err0:]), nontarg_ind[:n_err0], target_ind[:n_err1]
+
+
+def check_fast_auc():
+    for trial in range(n_trials):
+        n = rng.randint(2, 200)
+        y_true = rng.randint(0, 2, n)
+        y_true[:2] = [0, 1]  # Both classes are present
+        # Every third trial has rounded scores, i.e. many ties
+        y_score = rng.rand(n) if trial % 3 else np.round(rng.rand(n), 1)
+        if not np.isclose(fast_auc(y_true, y_score), reference_auc(y_true, y_score)):
+            return False
+        # Several score vectors in one call
+        scores = rng.rand(3, n)
+        if not np.allclose(fast_auc(y_true, scores), [reference_auc(y_true, score) for score in scores]):
+            return False
+    return True
+
+
+def check_select_errors():
+    for trial in range(n_trials):
+        n = rng.randint(1, 100)
+        y_true = rng.randint(0, 2, n)
+        # Predictions without ties: with ties the order of equal predictions is arbitrary in both versions
+        y_pred = rng.permutation(n) / float(n)
+        ind = rng.permutation(1000)[:n]
+        rates = list(rng.rand(rng.randint(1, 4)) * 0.5)
+        for rate, (pure_ind, err_nontarg_ind, err_target_ind) in zip(rates, select_errors(y_pred, y_true, ind, rates)):
+            old_pure_ind, old_err_nontarg_ind, old_err_target_ind = select_errors_argsort(y_pred, y_true, ind, rate)
+            # Erroneous samples come in the same order (the most erroneous first), pure ones in any order
+            if not (np.array_equal(err_nontarg_ind, old_err_nontarg_ind) and
+                    np.array_equal(err_target_ind, old_err_target_ind) and
+                    np.array_equal(np.sort(pure_ind), np.sort(old_pure_ind))):
+                return False
+        # Threshold mode against the loop of classification_filtering.py
+        threshold = rng.rand()
+        pure_ind, err_nontarg_ind, err_target_ind = select_errors(y_pred, y_true, ind, threshold=threshold)
+        old_pure_ind = [i for j, i in enumerate(ind) if y_true[j] and y_pred[j] >= threshold or
+                        y_true[j] == 0 and y_pred[j] < threshold]
+        if list(pure_ind) != old_pure_ind or \
+                set(err_nontarg_ind) != set(ind[(y_true == 0) & (y_pred >= threshold)]) or \
+                set(err_target_ind) != set(ind[(y_true == 1) & (y_pred < threshold)]):
+            return False
+    return True
+
+
+checks = [('fast_auc vs %s' % reference_name, check_fast_auc),
+          ('select_errors vs argsort', check_select_errors)]
+failed = False
+for name, check in checks:
+    ok = check()
+    failed = failed or not ok
+    print('%-40s %s' % (name, 'OK' if ok else 'FAILED'))
+sys.exit(1 if failed else 0)
@@ -1,170 +1,188 @@
 from src.data import DataBuildClassifier
 from src.NN import get_model
-from src.callbacks import LossMetricHistory
+from src.folds import train_folds, new_session
+from src.scheduler import schedule_subjects
+from src.filtering import select_errors
 from sklearn.model_selection import train_test_split, StratifiedKFold
 import numpy as np
 from keras.utils import to_categorical
-from keras.models import load_model
 from sklearn.metrics import roc_auc_score, roc_curve
+from functools import partial
+import multiprocessing
 import os, sys
 
-if len(sys.argv) < 3:
-    print("Usage: \n"
-          "python classification_filtering.py path_to_data path_to_logs filtration_rate[0...0.5) \n"
-          "For example, if you want to discard 10% of data in each class \n"
-          "and then train the network again, use something like: \n"
-          "./classification_filtering.py ../Data ./logs/cf 0.1")
-    exit()
-
-
-# Data import and making train, test and validation sets
-sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
-path_to_data = sys.argv[1] #'/home/likan_blk/BCI/NewData/'  # os.path.join(os.pardir,'sample_data')
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3), resample_to=323)
-# Some files for logging
-logdir = sys.argv[2]#os.path.join(os.getcwd(),'logs', 'cf_threshold')
-if not os.path.isdir(logdir):
-    os.makedirs(logdir)
-fname = os.path.join(logdir, 'auc_scores.csv')
-with open(fname, 'w') as fout:
-    fout.write('subject,auc_noisy,auc_pure,samples_before,samples_after,epoch_number\n')
-fname_err_ind = os.path.join(logdir, 'err_indices.csv')
-with open(fname_err_ind, 'w') as fout:
-    fout.write('subject,class,indices\n')
-
-epochs = 150
-dropouts = (0.72,0.32,0.05)
-
-if len(sys.argv) > 3:
-    filt_rate = sys.argv[3]
-else:
-    filt_rate = "all"
-
-
-# Iterate over subjects and clean label noise for all of them
-for sbj in sbjs:
+
+def load_subject(sbj, params):
+    '''
+    Loads preprocessed data of one subject (from the cache, filled by the main process)
+    '''
+    data = DataBuildClassifier(params['path_to_data'], cache_dir=params['cache_dir']).get_data(
+        [sbj], shuffle=False, windows=[(0.2, 0.5)], baseline_window=(0.2, 0.3), resample_to=323)
+    return data[sbj][0], data[sbj][1]
+
+
+def clean_subject(sbj, params):
+    '''
+    Classification filtering of one subject: cross-validation on the training set and search of noisy samples
+    :return: dict with indices of train and test samples, the number of epochs and 'sets': dict {filtration rate:
+             dict of indices of pure and erroneous samples}
+    '''
     print("Classification filtering for subject %s data"%(sbj))
-    X, y = data[sbj][0], data[sbj][1]
+    X, y = load_subject(sbj, params)
     train_ind, test_ind = train_test_split(np.arange(len(y)), shuffle=True,
                                            test_size=0.2, stratify=y,
                                            random_state=108)
-    X_train, y_train, X_test, y_test = X[train_ind], y[train_ind], X[test_ind], y[test_ind]
-    cv = StratifiedKFold(n_splits=4, shuffle=False)
+    X_train, y_train = X[train_ind], y[train_ind]
+    cv = StratifiedKFold(n_splits=params['nfold'], shuffle=False)
 
     val_inds = []
-    fold_pairs = []
+    folds = []
     for tr_ind, val_ind in cv.split(X_train, y_train):
-        X_tr, X_val = X_train[tr_ind], X_train[val_ind]
-        y_tr, y_val = y_train[tr_ind], y_train[val_ind]
-        fold_pairs.append((X_tr, y_tr, X_val, y_val))
+        folds.append((train_ind[tr_ind], train_ind[val_ind]))
         val_inds.append(train_ind[val_ind]) # indices of all the validation instances in the initial X array
 
-    # Getting and training models with cross-validation
-    i = 0 # Fold number iterator
-    pure_ind = np.array([], dtype=np.int32)
-    err_target_ind = np.array([], dtype=np.int32)
-    err_nontarg_ind = np.array([], dtype=np.int32)
+    # Getting and training models with cross-validation (in this worker, subjects run in parallel)
+    fold_results = train_folds(X, y, folds, epochs=params['epochs'], dropouts=params['dropouts'], verbose=1,
+                               n_jobs=1, intra_op_threads=params['threads'],
+                               patience=params['patience'], min_epochs=params['min_epochs'],
+                               cache_dir=params['fold_cache'],
+                               fname_bestmodels=[os.path.join(params['logdir'],"model%s_%s.hdf5"%(sbj,fold_num))
+                                                 for fold_num in range(len(folds))])
+    rates = params['filt_rates']
+    float_rates = [rate for rate in rates if rate != "all"]
+    parts = dict((rate, ([], [], [])) for rate in rates) # Pure and erroneous indices of every fold for every rate
     bestepochs = np.array([])
-    time_samples_num = X_train.shape[1]
-    channels_num = X_train.shape[2]
-
-    for fold in fold_pairs:
-        X_tr, y_tr, X_val, y_val = fold[0], to_categorical(fold[1]), fold[2], to_categorical(fold[3])
-        y_val_bin = fold[3]
 
-        model = get_model(time_samples_num, channels_num, dropouts=dropouts)
-        callback = LossMetricHistory(n_iter=epochs,verbose=1,
-                                     fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(i)))
-        hist = model.fit(X_tr, y_tr, epochs=epochs,
-                        validation_data=(X_val, y_val), callbacks=[callback],
-                        batch_size=64, shuffle=True)
-        bestepochs = np.append(bestepochs, callback.bestepoch+1)
+    for i, fold in enumerate(fold_results):
+        y_val_bin = y[val_inds[i]]
+        bestepochs = np.append(bestepochs, fold['bestepoch'])
 
         # Validation and data cleaning
-        model = load_model(os.path.join(logdir, "model%s.hdf5"%(i)))
-        y_pred = model.predict(X_val)[:,1]
-
-        # Choosing threshold (specificity should be at least 0.9)
-        FPR, TPR, thresholds = roc_curve(y_val_bin, y_pred)
-        threshold = (thresholds[FPR <= 0.1]).min()
-
-        if filt_rate != "all":
-            filt_rate = float(filt_rate)
-            ind = np.array(val_inds[i]) # indices of validation samples in the initial dataset
-            n_err1 = int(np.round(y_val_bin.sum()*filt_rate))  # Number of samples in target class to be thrown away
-            n_err0 = int(np.round((len(y_val_bin)-y_val_bin.sum())*filt_rate))  # Number of samples in nontarget class
-                                                                        # to be thrown away
-            argsort0 = np.argsort(y_pred[y_val_bin==0])[::-1]   # Descending sorting of predictions for nontarget class
-                                                            # so that the most erroneous sample are at the
-                                                            #begining of the array
-            argsort1 = np.argsort(y_pred[y_val_bin==1])     # Ascending Sorting of predictions for target class
-                                                        # so that the most erroneous sample are at the
-                                                        #begining of the array
-            target_ind = ind[y_val_bin==1][argsort1]
-            nontarg_ind = ind[y_val_bin==0][argsort0]
-            err_target_ind = np.append(err_target_ind, target_ind[:n_err1])
-            err_nontarg_ind = np.append(err_nontarg_ind, nontarg_ind[:n_err0]) # Take demanded amount of error samples
-            pure_ind = np.append(pure_ind, target_ind[n_err1:])
-            pure_ind = np.append(pure_ind, nontarg_ind[n_err0:])
-        else:
-            # Indices of non-noisy samples
-            for j, ind in enumerate(val_inds[i]):
-                if y[ind] and y_pred[j] >= threshold or \
-                    y[ind] == 0 and y_pred[j] < threshold:
-                    pure_ind = np.append(pure_ind, ind)
-                #if np.abs(y[ind] - y_pred[j]) < 0.5: # It is useful only if threshold = 0.5
-                #    pure_ind.append(ind)
-                # OPTIONALLY: let's save indices of erroneous samples for each class separately
-                # in order to look at this data after all.
-                elif y[ind] == 1:
-                    err_target_ind = np.append(err_target_ind, ind)
-                else:
-                    err_nontarg_ind = np.append(err_nontarg_ind, ind)
-            #pure_ind += list(val_inds[i][np.abs(y_val_bin - y_pred) < 0.5])
-        i += 1 # Fold number
-
-
-    bestepoch = int(round(bestepochs.mean()))
+        y_pred = fold['predictions']['val'][:,1]
+
+        if float_rates:
+            # Sets of all rates from one partial sorting of predictions of each class
+            for rate, sets in zip(float_rates, select_errors(y_pred, y_val_bin, val_inds[i],
+                                                             [float(rate) for rate in float_rates])):
+                for part, fold_part in zip(parts[rate], sets):
+                    part.append(fold_part)
+        if "all" in rates:
+            # Choosing threshold (specificity should be at least 0.9)
+            FPR, TPR, thresholds = roc_curve(y_val_bin, y_pred)
+            threshold = (thresholds[FPR <= 0.1]).min()
+            # Indices of non-noisy samples and of erroneous samples for each class separately
+            # (in order to look at this data after all)
+            for part, fold_part in zip(parts["all"], select_errors(y_pred, y_val_bin, val_inds[i],
+                                                                   threshold=threshold)):
+                part.append(fold_part)
 
     # Removing instances with noisy labels
-    np.random.shuffle(pure_ind)
-    X_train_pure = X[pure_ind]
-    y_train_pure = y[pure_ind]
-
-    # OPTIONALLY: saving erroneous sample indices
-    with open(fname_err_ind, 'a') as fout:
-        fout.write(str(sbj))
-        fout.write(',0,')
-        fout.write(','.join(map(str,err_nontarg_ind)))
-        fout.write('\n')
-        fout.write(str(sbj))
-        fout.write(',1,')
-        fout.write(','.join(map(str,err_target_ind)))
-        fout.write('\n')
-
-    # Testing and comparison of cleaned and noisy data
-    samples_before = y_train.shape[0]
-    samples_after = y_train_pure.shape[0]
-    y_train = to_categorical(y_train)
-    y_train_pure = to_categorical(y_train_pure)
-
-    model_noisy = get_model(time_samples_num, channels_num, dropouts=dropouts)
-    model_noisy.fit(X_train, y_train, epochs=bestepoch,
-                    batch_size=64, shuffle=False)
-
-    y_pred_noisy = model_noisy.predict(X_test)
-    y_pred_noisy = y_pred_noisy[:,1]
-    auc_noisy = roc_auc_score(y_test,y_pred_noisy)
-
-    model_pure = get_model(time_samples_num, channels_num, dropouts=dropouts)
-    model_pure.fit(X_train_pure, y_train_pure, epochs=bestepoch,
-                   batch_size=64, shuffle=False)
-    y_pred_pure = model_pure.predict(X_test)
-    y_pred_pure = y_pred_pure[:,1]
-    auc_pure = roc_auc_score(y_test,y_pred_pure)
-
-    with open(fname, 'a') as fout:
-        fout.write(','.join(map(str,[sbj,auc_noisy,auc_pure,samples_before,samples_after,bestepoch])))
-        fout.write('\n')
+    sets = {}
+    for rate in rates:
+        pure_ind, err_nontarg_ind, err_target_ind = [np.concatenate(part) for part in parts[rate]]
+        np.random.shuffle(pure_ind)
+        sets[rate] = {'pure_ind': pure_ind, 'err_target_ind': err_target_ind, 'err_nontarg_ind': err_nontarg_ind}
+    return {'sbj': sbj, 'train_ind': train_ind, 'test_ind': test_ind, 'sets': sets,
+            'bestepoch': int(round(bestepochs.mean()))}
+
+
+def train_final(state, params, which):
+    '''
+    Trains the final model of a subject on the noisy ('noisy') or cleaned (filtration rate) training set
+    :return: AUC on the test set
+    '''
+    X, y = load_subject(state['sbj'], params)
+    new_session(params['threads'])
+    train_ind = state['train_ind'] if which == 'noisy' else state['sets'][which]['pure_ind']
+    model = get_model(X.shape[1], X.shape[2], dropouts=params['dropouts'])
+    model.fit(X[train_ind], to_categorical(y[train_ind]), epochs=state['bestepoch'],
+              batch_size=64, shuffle=False)
+    y_pred = model.predict(X[state['test_ind']])[:,1]
+    return roc_auc_score(y[state['test_ind']], y_pred)
+
+
+def write_results(sbj, state, results, rates, fname, fname_err_ind):
+    '''
+    Appends results of a subject for all filtration rates to the log files (called in order of subjects).
+    The noisy model is the same for all rates
+    '''
+    for rate in rates:
+        sets = state['sets'][rate]
+        # OPTIONALLY: saving erroneous sample indices
+        with open(fname_err_ind, 'a') as fout:
+            fout.write('%s,%s,0,' % (sbj, rate))
+            fout.write(','.join(map(str,sets['err_nontarg_ind'])))
+            fout.write('\n')
+            fout.write('%s,%s,1,' % (sbj, rate))
+            fout.write(','.join(map(str,sets['err_target_ind'])))
+            fout.write('\n')
+
+        # Testing and comparison of cleaned and noisy data
+        samples_before = len(state['train_ind'])
+        samples_after = len(sets['pure_ind'])
+        with open(fname, 'a') as fout:
+            fout.write(','.join(map(str,[sbj,rate,results['noisy'],results['pure%s' % rate],samples_before,
+                                         samples_after,state['bestepoch']])))
+            fout.write('\n')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: \n"
+              "python classification_filtering.py path_to_data path_to_logs [filtration_rate[0...0.5) ...] \n"
+              "For example, if you want to discard 10% of data in each class \n"
+              "and then train the network again, use something like: \n"
+              "./classification_filtering.py ../Data ./logs/cf 0.1 \n"
+              "Several rates are evaluated with one cross-validation: ./classification_filtering.py ../Data ./logs/cf 0.05 0.1 \n"
+              "Without a rate the threshold is chosen in every fold (filtration rate 'all')")
+        exit()
+
+
+    # Data import and making train, test and validation sets
+    sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
+    path_to_data = sys.argv[1] #'/home/likan_blk/BCI/NewData/'  # os.path.join(os.pardir,'sample_data')
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+    # Preprocess all subjects into the cache in advance, workers read their subjects from it
+    DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                    windows=[(0.2, 0.5)],
+                                                                    baseline_window=(0.2, 0.3), resample_to=323,
+                                                                    lazy=True, max_memory=0, n_jobs=-1)
+    # Some files for logging
+    logdir = sys.argv[2]#os.path.join(os.getcwd(),'logs', 'cf_threshold')
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    fname = os.path.join(logdir, 'auc_scores.csv')
+    with open(fname, 'w') as fout:
+        fout.write('subject,filt_rate,auc_noisy,auc_pure,samples_before,samples_after,epoch_number\n')
+    fname_err_ind = os.path.join(logdir, 'err_indices.csv')
+    with open(fname_err_ind, 'w') as fout:
+        fout.write('subject,filt_rate,class,indices\n')
+
+    epochs = 150
+    # Early stopping: no improvement of validation AUC for patience epochs (but not before min_epochs)
+    patience = 30
+    min_epochs = 40
+    dropouts = (0.72,0.32,0.05)
+    nfold = 4
+
+    filt_rates = sys.argv[3:] or ["all"]
+
+    # Subjects (and their final models) are processed in parallel, one single-threaded worker per core.
+    # A worker trains the folds of its subject one after another: workers can not start processes of their own
+    n_workers = multiprocessing.cpu_count()
+    # Trained folds are cached: runs with other filtration rates skip the cross-validation
+    fold_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'fold_cache')
+    params = {'path_to_data': path_to_data, 'cache_dir': cache_dir, 'fold_cache': fold_cache, 'logdir': logdir,
+              'epochs': epochs,
+              'patience': patience, 'min_epochs': min_epochs,
+              'dropouts': dropouts, 'nfold': nfold, 'filt_rates': filt_rates,
+              'threads': max(multiprocessing.cpu_count() // n_workers, 1)}
+
+    # Clean label noise for all subjects, then train the noisy model and pure models of all rates independently.
+    # Rows of a subject are written as soon as it and all previous subjects are done
+    jobs = {'noisy': partial(train_final, params=params, which='noisy')}
+    for rate in filt_rates:
+        jobs['pure%s' % rate] = partial(train_final, params=params, which=rate)
+    schedule_subjects(sbjs, partial(clean_subject, params=params), jobs=jobs,
+                      finish=partial(write_results, rates=filt_rates, fname=fname, fname_err_ind=fname_err_ind),
+                      n_workers=n_workers)
@@ -6,12 +6,12 @@ np.random.seed(random_state)
 import tensorflow as tf
 tf.set_random_seed(random_state)
 from src.data import DataBuildClassifier
-from src.NN import get_model
+from src.NN import ModelFactory
 from src.callbacks import LossMetricHistory
+from src.filtering import select_errors
 from sklearn.model_selection import train_test_split, StratifiedKFold
 import numpy as np
 from keras.utils import to_categorical
-from keras.models import load_model
 from sklearn.metrics import roc_auc_score, roc_curve
 import os, sys
 
@@ -28,9 +28,11 @@ import os, sys
 sbjs = [32] #[25,26,27,28,29,30,32,33,34,35,36,37,38]
 frs = [0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.35, 0.4] # filter rates
 path_to_data =  sys.argv[1] #'/home/likan_blk/BCI/NewData/' #os.path.join(os.pardir,'sample_data')
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3), resample_to=323)
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+data = DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                       windows=[(0.2, 0.5)],
+                                                                       baseline_window=(0.2, 0.3), resample_to=323,
+                                                                       lazy=True, max_memory=0, n_jobs=-1)
 # Some files for logging
 logdir =  sys.argv[2] #os.path.join(os.getcwd(),'logs', 'cf_fr')
 if not os.path.isdir(logdir):
@@ -44,7 +46,11 @@ for fr in frs:
         fout.write('subject,class,indices\n')
 
 epochs = 150
+# Early stopping: no improvement of validation AUC for patience epochs (but not before min_epochs)
+patience = 30
+min_epochs = 40
 dropouts = (0.72,0.32,0.05)
+factory = ModelFactory(dropouts) # The model is built once and reset for every training
 
 #if len(sys.argv) > 3:
 #    filt_rate = sys.argv[3]
@@ -79,54 +85,37 @@ for sbj in sbjs:
     pure_ind = {}
     err_target_ind = {}
     err_nontarg_ind = {}
-    for fr in frs:
-        pure_ind[fr] = np.array([], dtype=np.int32)
-        err_target_ind[fr] = np.array([], dtype=np.int32)
-        err_nontarg_ind[fr] = np.array([], dtype=np.int32)
+    for fr in frs: # Lists of indices of every fold
+        pure_ind[fr] = []
+        err_target_ind[fr] = []
+        err_nontarg_ind[fr] = []
     bestepochs = np.array([])
 
 
     for fold,  (X_tr, y_tr, X_val, y_val_bin) in enumerate(fold_pairs):
         y_tr = to_categorical(y_tr)
         y_val = to_categorical(y_val_bin)
-        callback = LossMetricHistory(n_iter=epochs,verbose=1,
-                                     fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(fold)))
-
-        np.random.seed(random_state)
-        tf.set_random_seed(random_state)
-        model = get_model(time_samples_num, channels_num, dropouts=dropouts)
-        model.fit(X_tr, y_tr, epochs=epochs,
-                        validation_data=(X_val, y_val), callbacks=[callback],
+        callback = LossMetricHistory(n_iter=epochs,verbose=1,restore_best=True,lean=True,
+                                     validation_data=(X_val, y_val),
+                                     patience=patience, min_epochs=min_epochs)
+
+        # Every model gets its own initial weights, as with models added one after another to the TF graph
+        model = factory.get_model(time_samples_num, channels_num, seed=random_state + fold)
+        model.fit(X_tr, y_tr, epochs=epochs, callbacks=[callback],
                         batch_size=64, shuffle=True)
         bestepochs = np.append(bestepochs, callback.bestepoch+1)
 
         # Classification filtering of validation data
-        model = load_model(os.path.join(logdir, "model%s.hdf5"%(fold)))
         y_pred = model.predict(X_val)[:,1]
 
-        #if filt_rate != "all":
-        for fr in frs:
-            #filt_rate = float(filt_rate)
-            ind = np.array(val_inds[fold]) # indices of validation samples in the initial dataset
-            n_err1 = int(np.round(y_val_bin.sum()*fr))  # Number of samples in target class to be thrown away
-            n_err0 = int(np.round((len(y_val_bin)-y_val_bin.sum())*fr))  # Number of samples in nontarget class
-                                                                        # to be thrown away
-            argsort0 = np.argsort(y_pred[y_val_bin==0])[::-1]   # Descending sorting of predictions for nontarget class
-                                                            # so that the most erroneous sample are at the
-                                                            #begining of the array
-            argsort1 = np.argsort(y_pred[y_val_bin==1])     # Ascending Sorting of predictions for target class
-                                                        # so that the most erroneous sample are at the
-                                                        #begining of the array
-            target_ind = ind[y_val_bin==1][argsort1]
-            nontarg_ind = ind[y_val_bin==0][argsort0]
-            err_target_ind[fr] = np.append(err_target_ind, target_ind[:n_err1])
-            err_nontarg_ind[fr] = np.append(err_nontarg_ind, nontarg_ind[:n_err0]) # Take demanded amount of error samples
-            pure_ind[fr] = np.append(pure_ind[fr], target_ind[n_err1:])
-            pure_ind[fr] = np.append(pure_ind[fr], nontarg_ind[n_err0:])
+        # Sets of all filter rates from one partial sorting of predictions of each class
+        for fr, (fold_pure, fold_nontarg, fold_target) in zip(frs, select_errors(y_pred, y_val_bin,
+                                                                                 val_inds[fold], frs)):
+            err_target_ind[fr].append(fold_target)
+            err_nontarg_ind[fr].append(fold_nontarg) # Take demanded amount of error samples
+            pure_ind[fr].append(fold_pure)
     bestepoch = int(round(bestepochs.mean()))
-    np.random.seed(random_state)
-    tf.set_random_seed(random_state)
-    model_noisy = get_model(time_samples_num, channels_num, dropouts=dropouts)
+    model_noisy = factory.get_model(time_samples_num, channels_num, seed=random_state + len(fold_pairs))
     model_noisy.fit(X_train, to_categorical(y_train),
                     epochs=bestepoch,
                     batch_size=64, shuffle=False)
@@ -135,7 +124,10 @@ for sbj in sbjs:
     y_pred_noisy = y_pred_noisy[:, 1]
     auc_noisy = roc_auc_score(y_test, y_pred_noisy)
 
-    for fr in frs:
+    for fr_idx, fr in enumerate(frs):
+        pure_ind[fr] = np.concatenate(pure_ind[fr])
+        err_target_ind[fr] = np.concatenate(err_target_ind[fr])
+        err_nontarg_ind[fr] = np.concatenate(err_nontarg_ind[fr])
         np.random.shuffle(pure_ind[fr])
         X_train_pure = X[pure_ind[fr]]
         y_train_pure = y[pure_ind[fr]]
@@ -158,9 +150,8 @@ for sbj in sbjs:
 
         callback = LossMetricHistory(n_iter=epochs, verbose=1,
                                      fname_bestmodel=os.path.join(logdir, "model_pure%s.hdf5" % str(fr)))
-        np.random.seed(random_state)
-        tf.set_random_seed(random_state)
-        model_pure = get_model(time_samples_num, channels_num, dropouts=dropouts)
+        model_pure = factory.get_model(time_samples_num, channels_num,
+                                       seed=random_state + len(fold_pairs) + 1 + fr_idx)
         model_pure.fit(X_train_pure, y_train_pure, epochs=bestepoch,
                        batch_size=64, shuffle=False)
         y_pred_pure = model_pure.predict(X_test)
@@ -11,14 +11,40 @@ import shutil
 import os
 from src.data_bogdan import DataBuildClassifier
 from keras.utils import to_categorical
-from keras.callbacks import ModelCheckpoint
-from keras.models import load_model
 from src.NN_bogdan import get_model
-from src.utils_bogdan import single_auc_loging, clean_bad_auc_models
+from src.utils_bogdan import single_auc_loging
 from src.my_callbacks import PerSubjAucMetricHistory,AucMetricHistory
+from keras.callbacks import Callback
 import numpy as np
 import pickle
 
+
+class BestAucCheckpoint(Callback):
+    '''
+    Keeps the weights of the epoch with the best validation AUC in memory (logged as 'val_auc' by AucMetricHistory,
+    which has to come first in callbacks) and saves the model with them to fname at the end of training
+    '''
+    def __init__(self, fname):
+        super(BestAucCheckpoint, self).__init__()
+        self.fname = fname
+
+    def on_train_begin(self, logs={}):
+        self.best_auc = -np.inf
+        self.best_weights = None
+
+    def on_epoch_end(self, epoch, logs={}):
+        # The first epoch with the maximal AUC, as np.argmax(history['val_auc'])
+        if logs['val_auc'] > self.best_auc:
+            self.best_auc = logs['val_auc']
+            self.best_weights = self.model.get_weights()
+
+    def on_train_end(self, logs={}):
+        last_weights = self.model.get_weights()
+        self.model.set_weights(self.best_weights)
+        self.model.save(self.fname)
+        self.model.set_weights(last_weights)
+
+
 def cv_test(x,y,model,model_path):
     model.save_weights('tmp.h5') # Nasty hack. This weights will be used to reset model
     same_subj_auc = AucMetricHistory()
@@ -30,21 +56,22 @@ def cv_test(x,y,model,model_path):
     cv = StratifiedKFold(n_splits=folds,shuffle=True)
     best_val_epochs = []
     best_val_aucs = []
+    fold_weights = [] # Best weights of every fold (for ensemble)
     # for fold, (train_idx, val_idx) in enumerate(cv.split(x_tr, y_tr[:,1])):
     for fold, (train_idx, val_idx) in enumerate(cv.split(x_tr, y_tr)):
         fold_model_path = os.path.join(model_path,'%d' % fold)
         if not os.path.isdir(fold_model_path):
             os.makedirs(fold_model_path)
-        make_checkpoint = ModelCheckpoint(os.path.join(fold_model_path, '{epoch:02d}.hdf5'),
-                                          monitor='val_loss', verbose=0, save_best_only=False, mode='auto')
+        # Best weights (by val_auc, as best_val_epochs) are kept in memory and written to disk once
+        best_checkpoint = BestAucCheckpoint(os.path.join(fold_model_path, 'best.hdf5'))
         model.load_weights('tmp.h5') # Rest model on each fold
         x_tr_fold,y_tr_fold = x_tr[train_idx],y_tr[train_idx]
         x_val_fold, y_val_fold = x_tr[val_idx], y_tr[val_idx]
         val_history = model.fit(x_tr_fold, y_tr_fold, epochs=150, validation_data=(x_val_fold, y_val_fold),
-                            callbacks=[same_subj_auc,make_checkpoint], batch_size=64, shuffle=True)
+                            callbacks=[same_subj_auc,best_checkpoint], batch_size=64, shuffle=True)
         best_val_epochs.append(np.argmax(val_history.history['val_auc']) + 1) # epochs count from 1 (not from 0)
         best_val_aucs.append(np.max(val_history.history['val_auc']))
-        clean_bad_auc_models(fold_model_path, val_history.history)
+        fold_weights.append(best_checkpoint.best_weights)
 
 
     #Test  performance (Naive, until best epoch
@@ -60,15 +87,10 @@ def cv_test(x,y,model,model_path):
     os.remove('tmp.h5')
 
     # Test  performance (ensemble)
-    best_models = []
     predictions = np.zeros_like(y_tst)
-    for fold_folder in os.listdir(model_path):
-        fold_model_path = os.path.join(model_path,fold_folder)
-        if os.path.isdir(fold_model_path):
-            model_checkpoint = os.listdir(fold_model_path)[0]
-            fold_model_path = os.path.join(fold_model_path,model_checkpoint)
-            # best_models.append(load_model(fold_model_path))
-            predictions+=load_model(fold_model_path).predict(x_tst)[:,0]
+    for weights in fold_weights:
+        model.set_weights(weights)
+        predictions+=model.predict(x_tst)[:,0]
 
     predictions /= (folds)
     test_auc_ensemble = roc_auc_score(y_tst,predictions)#roc_auc_score(y_tst[:,1],predictions[:,1])
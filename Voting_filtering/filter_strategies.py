@@ -0,0 +1,158 @@
+from src.data import DataBuildClassifier
+from src.NN import get_model
+from src.folds import new_session
+from src.filtering import collect_predictions, get_strategies
+from src.scheduler import schedule_subjects
+from sklearn.model_selection import train_test_split
+import numpy as np
+from keras.utils import to_categorical
+from sklearn.metrics import roc_auc_score
+from functools import partial
+import multiprocessing
+import os, sys
+
+
+def load_subject(sbj, params):
+    '''
+    Loads preprocessed data of one subject (from the cache, filled by the main process)
+    '''
+    data = DataBuildClassifier(params['path_to_data'], cache_dir=params['cache_dir']).get_data(
+        [sbj], shuffle=False, windows=[(0.2, 0.5)], baseline_window=(0.2, 0.3), resample_to=323)
+    return data[sbj][0], data[sbj][1]
+
+
+def train_model(X, y, train_ind, test_ind, bestepoch, dropouts, params):
+    '''
+    Trains a model on train_ind for bestepoch epochs
+    :return: the model and its AUC on the test set
+    '''
+    new_session(params['threads'], seed=params['random_state'])
+    model = get_model(X.shape[1], X.shape[2], dropouts=dropouts)
+    model.fit(X[train_ind], to_categorical(y[train_ind]), epochs=bestepoch, batch_size=64, shuffle=False)
+    return model, roc_auc_score(y[test_ind], model.predict(X[test_ind])[:,1])
+
+
+def predict_subject(sbj, params):
+    '''
+    The only training of a subject shared by all strategies: for every training group (settings of the drivers)
+    cross-validation folds of its splits and the noisy model on the whole training set (the baseline of the group
+    and the source of naive predictions)
+    '''
+    print("Training of shared models for subject %s data"%(sbj))
+    X, y = load_subject(sbj, params)
+    train_ind, test_ind = train_test_split(np.arange(len(y)), shuffle=True,
+                                           test_size=0.2, stratify=y,
+                                           random_state=108)
+    state = {'sbj': sbj, 'predictions': {}, 'auc_noisy': {}, 'auc_noisy_ensemble': {}}
+    for group in params['groups']:
+        settings = params['settings'][group]
+        predictions = collect_predictions(X, y, train_ind, test_ind, epochs=settings['epochs'],
+                                          dropouts=settings['dropouts'], nfold=params['nfold'],
+                                          n_shufflings=settings['n_shufflings'],
+                                          shuffle_splits=settings['shuffle_splits'], seed=params['random_state'],
+                                          shuffle=settings['shuffle'], verbose=1,
+                                          n_jobs=1, intra_op_threads=params['threads'],
+                                          patience=params['patience'], min_epochs=params['min_epochs'],
+                                          cache_dir=params['fold_cache'])
+        model_noisy, state['auc_noisy'][group] = train_model(X, y, train_ind, test_ind, predictions.bestepoch,
+                                                             settings['dropouts'], params)
+        predictions.naive = model_noisy.predict(X[train_ind])[:,1]
+        state['predictions'][group] = predictions
+        state['auc_noisy_ensemble'][group] = roc_auc_score(y[test_ind], predictions.ensemble_test)
+    return state
+
+
+def train_pure(state, params, strategy):
+    '''
+    Filters the training set of a subject by a strategy and trains the pure model with the settings of its group
+    '''
+    X, y = load_subject(state['sbj'], params)
+    predictions = state['predictions'][strategy.group]
+    pure_ind, err_nontarg_ind, err_target_ind = strategy.select(predictions)
+    np.random.RandomState(params['random_state']).shuffle(pure_ind)
+    _, auc_pure = train_model(X, y, pure_ind, predictions.test_ind, predictions.bestepoch,
+                              params['settings'][strategy.group]['dropouts'], params)
+    return {'auc_pure': auc_pure, 'samples_after': len(pure_ind),
+            'err_nontarg_ind': err_nontarg_ind, 'err_target_ind': err_target_ind}
+
+
+def write_results(sbj, state, results, strategies, fname, fname_err_ind):
+    '''
+    Appends rows of all strategies of a subject to the log files (called in order of subjects)
+    '''
+    with open(fname, 'a') as fout:
+        for strategy in strategies:
+            res = results[strategy.name]
+            predictions = state['predictions'][strategy.group]
+            fout.write(','.join(map(str, [sbj, strategy.name, state['auc_noisy'][strategy.group], res['auc_pure'],
+                                          len(predictions.train_ind), res['samples_after'],
+                                          predictions.bestepoch])))
+            fout.write('\n')
+    with open(fname_err_ind, 'a') as fout:
+        for strategy in strategies:
+            res = results[strategy.name]
+            fout.write('%s,%s,0,%s\n' % (sbj, strategy.name, ','.join(map(str, res['err_nontarg_ind']))))
+            fout.write('%s,%s,1,%s\n' % (sbj, strategy.name, ','.join(map(str, res['err_target_ind']))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: \n"
+              "python filter_strategies.py path_to_data path_to_logs [filtration_rate[0...0.5) ...] \n"
+              "Evaluates all filtering strategies (threshold, rate, ensemble, naive, majority and consensus vote)\n"
+              "from one cross-validation training per subject and settings of the drivers, for example: \n"
+              "./filter_strategies.py ../Data ./logs/filtering 0.1 0.2")
+        exit()
+
+    sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
+    path_to_data = sys.argv[1]
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+    # Preprocess all subjects into the cache in advance, workers read their subjects from it
+    DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                    windows=[(0.2, 0.5)],
+                                                                    baseline_window=(0.2, 0.3), resample_to=323,
+                                                                    lazy=True, max_memory=0, n_jobs=-1)
+    logdir = sys.argv[2]
+    if not os.path.isdir(logdir):
+        os.makedirs(logdir)
+    fname = os.path.join(logdir, 'auc_scores.csv')
+    with open(fname, 'w') as fout:
+        fout.write('subject,strategy,auc_noisy,auc_pure,samples_before,samples_after,epoch_number\n')
+    fname_err_ind = os.path.join(logdir, 'err_indices.csv')
+    with open(fname_err_ind, 'w') as fout:
+        fout.write('subject,strategy,class,indices\n')
+
+    epochs = 150
+    # Early stopping: no improvement of validation AUC for patience epochs (but not before min_epochs)
+    patience = 30
+    min_epochs = 40
+    nfold = 4
+    # Every strategy is evaluated with the settings of its own driver: 'cf' - classification_filtering.py and
+    # cf_ensemble_naive.py (one unshuffled split, batches of folds are shuffled as in classification_filtering.py),
+    # 'vf' - vf_val_majority_vote.py and vf_val_consensus_vote.py (shuffled splits for votes, unshuffled batches).
+    # Noisy and pure models are trained without shuffling of batches in both groups
+    settings = {'cf': {'dropouts': (0.72,0.32,0.05), 'n_shufflings': 1, 'shuffle_splits': False,
+                       'epochs': epochs, 'shuffle': True},
+                'vf': {'dropouts': (0.2,0.4,0.6), 'n_shufflings': 5, 'shuffle_splits': True,
+                       'epochs': epochs, 'shuffle': False}}
+    rates = [float(rate) for rate in sys.argv[3:]] or [0.1]
+    strategies = get_strategies(rates)
+    groups = sorted(set(strategy.group for strategy in strategies))
+
+    # One single-threaded worker per core, a worker trains the folds of its subject one after another
+    # (workers can not start processes of their own)
+    n_workers = multiprocessing.cpu_count()
+    # Trained folds are cached, a run with other rates skips straight to filtering
+    fold_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'fold_cache')
+    params = {'path_to_data': path_to_data, 'cache_dir': cache_dir, 'fold_cache': fold_cache,
+              'settings': settings, 'groups': groups,
+              'patience': patience, 'min_epochs': min_epochs, 'nfold': nfold,
+              'random_state': 108, 'threads': max(multiprocessing.cpu_count() // n_workers, 1)}
+
+    # Pure models of all strategies of a subject are trained in parallel after its shared training
+    schedule_subjects(sbjs, partial(predict_subject, params=params),
+                      jobs=dict((strategy.name, partial(train_pure, params=params, strategy=strategy))
+                                for strategy in strategies),
+                      finish=partial(write_results, strategies=strategies, fname=fname,
+                                     fname_err_ind=fname_err_ind),
+                      n_workers=n_workers)
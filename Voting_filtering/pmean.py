@@ -1,9 +1,22 @@
-from src.utils import mean_and_pvalue
+from src.utils import mean_and_pvalue, mean_and_pvalue_by
 import sys
 
 fname = sys.argv[1]#'/home/moskaleona/alenadir/GitHub/EEG_classification_with_noisy_labels/Voting_filtering/logs/tmp.csv' #'/home/moskaleona/alenadir/GitHub/EEG_classification_with_noisy_labels/Voting_filtering/logs/cf_threshold/auc_scores.csv'
-res = mean_and_pvalue(fname)
+with open(fname) as f:
+    header = [name.strip() for name in f.readline().split(',')]
+# Tables of classification_filtering.py and cf_ensemble_naive.py are grouped by filtration rate by default
+column = sys.argv[2] if len(sys.argv) > 2 else ('filt_rate' if 'filt_rate' in header else None)
+if column is not None:
+    # One table of several runs (e.g. python pmean.py auc_scores.csv filt_rate): summary of every run
+    summaries = mean_and_pvalue_by(fname, column)
+else:
+    summaries = [(None, mean_and_pvalue(fname))]
 
 with open(fname, 'a') as f:
-    f.write(u"Mean %0.4f+-%0.4f %0.4f+-%0.4f \n"%(res[0][0],res[1][0], res[0][1], res[1][1])+
-            u"P-value: %0.4f"%(res[2][0]))
+    for value, res in summaries:
+        if value is not None:
+            f.write(u"%s %s \n"%(column, value))
+        f.write(u"Mean %0.4f+-%0.4f %0.4f+-%0.4f \n"%(res[0][0],res[1][0], res[0][1], res[1][1])+
+                u"P-value: %0.4f"%(res[2][0]))
+        if value is not None:
+            f.write(u"\n")
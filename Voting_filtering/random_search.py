@@ -6,7 +6,6 @@ from src.data import DataBuildClassifier
 from src.NN import get_model
 from src.callbacks import LossMetricHistory
 from sklearn.model_selection import train_test_split, StratifiedKFold
-from keras.models import load_model
 from src.utils import *
 from sklearn.metrics import roc_auc_score
 
@@ -35,9 +34,11 @@ for i in range(N):
         fout.write('id,\t\tdropout1,\t\tdropout2,\t\tdropout3,\t\tl1_l2,\t\tsample rate,\t\tp-value\n')
     logdir = os.path.join(logdir, str(i))
     os.mkdir(logdir)
-    data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                      windows=[(0.2, 0.5)],
-                                                      baseline_window=(0.2, 0.3), resample_to=params['sample_rate'])
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+    data = DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                           windows=[(0.2, 0.5)],
+                                                                           baseline_window=(0.2, 0.3), resample_to=params['sample_rate'],
+                                                                           lazy=True, max_memory=0, n_jobs=-1)
     for sbj in sbjs:
         X, y = data[sbj][0], data[sbj][1]
         train_ind, test_ind = train_test_split(np.arange(len(y)), shuffle=True,
@@ -62,13 +63,12 @@ for i in range(N):
             model, _ = get_model(time_samples_num, channels_num, dropouts=params['dropout'])
             callback = LossMetricHistory(n_iter=epochs,
                                          verbose=1,
-                                         fname_bestmodel=os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)))
-            model.fit(X_tr, y_tr, epochs=epochs,
-                      validation_data=(X_val, y_val), callbacks=[callback],
+                                         fname_bestmodel=os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)),
+                                         restore_best=True, validation_data=(X_val, y_val))
+            model.fit(X_tr, y_tr, epochs=epochs, callbacks=[callback],
                       batch_size=64, shuffle=True)
             bestepochs = np.append(bestepochs, callback.bestepoch + 1)
             # Testing and saving predictions
-            model = load_model(os.path.join(logdir, str(n), "model%s.hdf5" % (sbj)))
             y_pred_tr = model.predict(X_tr)[:, 0]
             y_pred_val = model.predict(X_val)[:, 0]
             y_pred_test = model.predict(X_test)
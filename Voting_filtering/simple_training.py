@@ -15,15 +15,17 @@ from src.utils import *
 from src.callbacks import LossMetricHistory
 from src.data import DataBuildClassifier
 from src.NN import get_model
-from keras.models import load_model
+from sklearn.model_selection import train_test_split
 
 
 # Data import and making train, test and validation sets
 sbjs = [25,26,27,28,29,30,32,33,34,35,36,37,38]
 path_to_data = '/home/likan_blk/BCI/NewData/'  #os.path.join(os.pardir,'sample_data')
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3),resample_to=250)
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+data = DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                       windows=[(0.2, 0.5)],
+                                                                       baseline_window=(0.2, 0.3),resample_to=250,
+                                                                       lazy=True, max_memory=0, n_jobs=-1)
 # Some files for logging
 logdir = os.path.join(os.getcwd(),'logs', 'cf', 'simple_training_resample')
 if not os.path.isdir(logdir):
@@ -126,14 +128,13 @@ for sbj in sbjs:
     bestepochs = np.array([])
     model, _ = get_model(time_samples_num, channels_num, dropouts=dropouts)
     callback = LossMetricHistory(n_iter=epochs,
-                                 verbose=1, fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(sbj)))
-    hist = model.fit(X_train, y_train, epochs=epochs,
-                    validation_data=(X_test, y_test), callbacks=[callback],
+                                 verbose=1, fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(sbj)),
+                                 restore_best=True, validation_data=(X_test, y_test))
+    hist = model.fit(X_train, y_train, epochs=epochs, callbacks=[callback],
                     batch_size=64, shuffle=True)
     bestepoch = callback.bestepoch + 1
 
     # Testing and saving predictions
-    model = load_model(os.path.join(logdir, "model%s.hdf5"%(sbj)))
     y_pred_test = model.predict(X_test)[:,0]
     y_pred_train = model.predict(X_train)[:,0]
 
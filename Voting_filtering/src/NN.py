@@ -5,6 +5,11 @@ from keras.regularizers import l1_l2
 from keras.optimizers import Adam
 import  keras.backend as K
 import tensorflow as tf
+import numpy as np
+import random
+
+LEARNING_RATE = 0.0009  # Adam of get_model and get_stacked_model
+L1_L2 = 0.0001  # Regularization of the first convolution
 
 
 def auc_metric(y_true,y_pred):
@@ -14,18 +19,24 @@ def auc_metric(y_true,y_pred):
         score = tf.identity(score)
     return score
 
-def get_model(time_samples_num,channels_num,dropouts):
+def _tower(input, time_samples_num, dropouts, prefix=None):
+    '''
+    Layers of get_model applied to input
+    :param prefix: string, prefix of names of the layers. None - default names of Keras
+    :return: output tensor (class probabilities)
+    '''
+    name = lambda layer: None if prefix is None else '%s_%s' % (prefix, layer)
     # rn_init = RandomNormal(stddev=0.001,seed=1)
     #First
     num_of_filt = 16
 
-    input=Input(shape=(time_samples_num, channels_num, ))
-    convolved = Conv1D(num_of_filt,kernel_size=(1),activation='elu',padding='same',kernel_regularizer=l1_l2(0.0001))(input)
-    convolved = Reshape((1, num_of_filt, time_samples_num))(convolved)
+    convolved = Conv1D(num_of_filt,kernel_size=(1),activation='elu',padding='same',kernel_regularizer=l1_l2(L1_L2),
+                       name=name('conv1d'))(input)
+    convolved = Reshape((1, num_of_filt, time_samples_num),name=name('reshape'))(convolved)
     #
     #
-    b_normed = BatchNormalization(axis=2)(convolved)
-    dropouted = Dropout(dropouts[0])(b_normed)
+    b_normed = BatchNormalization(axis=2,name=name('bn1'))(convolved)
+    dropouted = Dropout(dropouts[0],name=name('dropout1'))(b_normed)
     #
     # #second
     num_of_filt = 4
@@ -33,10 +44,10 @@ def get_model(time_samples_num,channels_num,dropouts):
             activation='elu',
            #kernel_regularizer=l1_l2(0.0000),
             data_format='channels_first',
-           padding='same')(dropouted)
-    b_normed = BatchNormalization(axis=1)(convolved)
-    pooled = MaxPooling2D(pool_size=(2,4),data_format='channels_first')(b_normed)
-    dropouted = Dropout(dropouts[1])(pooled)
+           padding='same',name=name('conv2d1'))(dropouted)
+    b_normed = BatchNormalization(axis=1,name=name('bn2'))(convolved)
+    pooled = MaxPooling2D(pool_size=(2,4),data_format='channels_first',name=name('pool1'))(b_normed)
+    dropouted = Dropout(dropouts[1],name=name('dropout2'))(pooled)
     #
     # #Third
     num_of_filt = 4
@@ -44,22 +55,191 @@ def get_model(time_samples_num,channels_num,dropouts):
                        activation='elu',
                        #kernel_regularizer=l1_l2(0.0000),
                        data_format='channels_first',
-                       padding='same')(dropouted)
-    b_normed = BatchNormalization(axis=1)(convolved)
-    pooled = MaxPooling2D(pool_size=(2, 4),data_format='channels_first')(b_normed) # 41 time sample point affects this feature
-    dropouted = Dropout(dropouts[2],seed=1)(pooled)
+                       padding='same',name=name('conv2d2'))(dropouted)
+    b_normed = BatchNormalization(axis=1,name=name('bn3'))(convolved)
+    pooled = MaxPooling2D(pool_size=(2, 4),data_format='channels_first',name=name('pool2'))(b_normed) # 41 time sample point affects this feature
+    dropouted = Dropout(dropouts[2],seed=1,name=name('dropout3'))(pooled)
 
     #Fourth
-    flatten = Flatten()(dropouted)
-    out = Dense(2,activation=None)(flatten)
-    out = Activation(activation='softmax')(out)
+    flatten = Flatten(name=name('flatten'))(dropouted)
+    out = Dense(2,activation=None,name=name('dense'))(flatten)
+    out = Activation(activation='softmax',name=prefix)(out)
+    return out
+
+
+def get_model(time_samples_num,channels_num,dropouts):
+    input=Input(shape=(time_samples_num, channels_num, ))
+    out = _tower(input, time_samples_num, dropouts)
     classification_model = Model(inputs=input,outputs=out)
-    opt = Adam(lr=0.0009)
+    opt = Adam(lr=LEARNING_RATE)
     classification_model.compile(optimizer=opt,loss='categorical_crossentropy',metrics=['accuracy'])
 
     return classification_model
 
 
+def get_stacked_model(time_samples_num,channels_num,dropouts,n_towers):
+    '''
+    n_towers independent copies of get_model ("towers") on one shared input, trained by one fit call.
+    Output k (named 'tower<k>') is the output of tower k, layers of tower k are named 'tower<k>_...'.
+    Losses of the outputs are summed, a tower gets gradients of its own loss only, and Adam updates every
+    weight separately: with per-output masks of targets (see folds.train_folds_stacked) every tower is trained
+    as get_model on its own samples, but all of them run as a few wide ops instead of many tiny ones.
+    Batch normalizations of a tower still see the whole batch (inputs, not labels) during training
+    :param n_towers: int, number of towers (e.g. number of cross-validation folds)
+    :return: compiled model with n_towers outputs
+    '''
+    input=Input(shape=(time_samples_num, channels_num, ))
+    outputs = [_tower(input, time_samples_num, dropouts, prefix='tower%d' % k) for k in range(n_towers)]
+    stacked_model = Model(inputs=input,outputs=outputs)
+    opt = Adam(lr=LEARNING_RATE)
+    stacked_model.compile(optimizer=opt,loss='categorical_crossentropy',metrics=['accuracy'])
+
+    return stacked_model
+
+
+def tower_positions(model, n_towers):
+    '''
+    Positions of weights of every tower of get_stacked_model in model.get_weights()
+    :return: list of lists of ints. Weights of tower k in the order of get_model().get_weights() are
+             [weights[i] for i in positions[k]]
+    '''
+    positions = [[] for _ in range(n_towers)]
+    start = 0
+    for layer in model.layers:
+        n_weights = len(layer.weights)
+        if n_weights:
+            k = int(layer.name.split('_')[0][len('tower'):])
+            positions[k].extend(range(start, start + n_weights))
+        start += n_weights
+    return positions
+
+
+def _compute_fans(shape):
+    '''
+    Fan in and fan out of a weight tensor, as in Keras initializers (kernels are stored channels last)
+    '''
+    if len(shape) == 2:
+        return shape[0], shape[1]
+    if len(shape) in (3, 4, 5):
+        receptive_field_size = np.prod(shape[:-2])
+        return shape[-2] * receptive_field_size, shape[-1] * receptive_field_size
+    fan = np.sqrt(np.prod(shape))
+    return fan, fan
+
+
+def _initial_value(initializer, shape, rng):
+    '''
+    Draws an initial value of a weight in numpy, so that re-initialization does not add ops to the graph
+    :param initializer: Keras initializer of the weight
+    :param rng: numpy random Generator
+    :return: numpy array or None if the initializer is not supported
+    '''
+    config = initializer.get_config()
+    name = initializer.__class__.__name__
+    if name == 'Zeros':
+        return np.zeros(shape)
+    if name == 'Ones':
+        return np.ones(shape)
+    if name == 'Constant':
+        return np.full(shape, config['value'])
+    if name == 'VarianceScaling':
+        fan_in, fan_out = _compute_fans(shape)
+        n = {'fan_in': fan_in, 'fan_out': fan_out}.get(config['mode'], (fan_in + fan_out) / 2.)
+        scale = config['scale'] / max(1., n)
+        if config['distribution'] == 'uniform':
+            limit = np.sqrt(3. * scale)
+            return rng.uniform(-limit, limit, shape)
+        if config['distribution'] == 'untruncated_normal':
+            return rng.normal(0., np.sqrt(scale), shape)
+        # Truncated at two standard deviations, the constant corrects the variance of the truncation
+        stddev = np.sqrt(scale) / .87962566103423978
+        value = rng.normal(0., stddev, shape)
+        outside = np.abs(value) > 2 * stddev
+        while outside.any():
+            value[outside] = rng.normal(0., stddev, outside.sum())
+            outside = np.abs(value) > 2 * stddev
+        return value
+    return None
+
+
+class ModelFactory(object):
+    '''
+    Builds a model (get_model by default) once for every input shape and reuses it, instead of building
+    and compiling a new graph for every fold. Every call of get_model resets the cached model to its initial
+    weights (or to new ones drawn with a seed) and clears the optimizer state, so training starts from scratch.
+    Train and predict functions of Keras are created only once per model, so the TF graph and memory stay
+    the same over hundreds of trainings. clear (or exit from "with ModelFactory(...) as factory:") drops the
+    models and the Keras session.
+    Dropout masks are drawn by the graph, they depend on the TF seed set before the first build only.
+    '''
+    def __init__(self, dropouts, build=get_model):
+        '''
+        :param dropouts: dropouts of the model
+        :param build: function(time_samples_num, channels_num, dropouts) returning a compiled model
+        '''
+        self.dropouts = dropouts
+        self.build = build
+        self._models = {}
+
+    def get_model(self, time_samples_num, channels_num, seed=None):
+        '''
+        :param seed: int. None - initial weights of the first build, otherwise new weights drawn with this seed
+                     (random and numpy are seeded with it as well, it makes shuffling in fit reproducible)
+        :return: compiled model with reset weights and optimizer
+        '''
+        key = (time_samples_num, channels_num)
+        if key not in self._models:
+            model = self.build(time_samples_num, channels_num, dropouts=self.dropouts)
+            self._models[key] = (model, model.get_weights())
+            if seed is None:
+                return model
+        model, initial_weights = self._models[key]
+        if seed is None:
+            model.set_weights(initial_weights)
+        else:
+            random.seed(seed)
+            np.random.seed(seed)
+            self.reinit(model, seed)
+        # Optimizer weights (iterations and moments of Adam) are created by the first fit with zeros
+        optimizer_weights = getattr(model.optimizer, 'weights', [])
+        K.batch_set_value([(w, np.zeros(K.int_shape(w), dtype=K.dtype(w))) for w in optimizer_weights])
+        return model
+
+    @staticmethod
+    def reinit(model, seed):
+        '''
+        Sets new initial weights of a model, drawn by initializers of its layers with the seed
+        '''
+        rng = np.random.default_rng(seed)
+        initializers = {}
+        for layer in model.layers:
+            for attr, initializer in vars(layer).items():
+                weight = getattr(layer, attr[:-len('_initializer')], None) if attr.endswith('_initializer') else None
+                if weight is not None:
+                    initializers[id(weight)] = initializer
+        values = []
+        # get_weights goes layer by layer, while model.weights has all trainable weights first
+        weights = [weight for layer in model.layers for weight in layer.weights]
+        for weight, value in zip(weights, model.get_weights()):
+            new_value = None
+            if id(weight) in initializers:
+                new_value = _initial_value(initializers[id(weight)], value.shape, rng)
+            if new_value is None:
+                # Unknown initializer: run its op (not affected by the seed)
+                K.get_session().run(weight.initializer)
+                new_value = K.get_value(weight)
+            values.append(new_value.astype(value.dtype))
+        model.set_weights(values)
 
+    def clear(self):
+        '''
+        Drops all models and the graph of the Keras session
+        '''
+        self._models = {}
+        K.clear_session()
 
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.clear()
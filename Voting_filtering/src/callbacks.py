@@ -1,22 +1,134 @@
 from keras.callbacks import Callback
 from keras import backend as K
-from keras.utils import to_categorical
+from keras.utils import to_categorical, Sequence
 import os
-import matplotlib.pyplot as plt
 import shutil
+import threading
 import numpy as np
 from numpy import argmax, max
 import logging
-from sklearn.metrics import roc_auc_score, roc_curve
+from src.utils import fast_auc
+
+
+def save_weights_hdf5(fname, layers, keras_version, backend):
+    '''
+    Writes weights to HDF5 file in the format of Model.save_weights (the file can be read by Model.load_weights),
+    without access to the model. It is safe to call from a background thread
+    :param fname: string, file name. The file is written under a temporary name and then renamed
+    :param layers: list of tuples (layer name, list of weight names, list of numpy arrays) for all layers of a model
+    :param keras_version: string, keras.__version__
+    :param backend: string, K.backend()
+    '''
+    import h5py
+    fname_tmp = fname + '.tmp'
+    with h5py.File(fname_tmp, 'w') as f:
+        f.attrs['layer_names'] = [name.encode('utf8') for name, _, _ in layers]
+        f.attrs['backend'] = backend.encode('utf8')
+        f.attrs['keras_version'] = str(keras_version).encode('utf8')
+        for name, weight_names, values in layers:
+            group = f.create_group(name)
+            group.attrs['weight_names'] = [weight_name.encode('utf8') for weight_name in weight_names]
+            for weight_name, value in zip(weight_names, values):
+                group.create_dataset(weight_name, data=value)
+    os.rename(fname_tmp, fname)
+
+
+def crossentropy(y_true, y_pred):
+    '''
+    Mean categorical crossentropy computed in numpy in the same way as Keras does
+    :param y_true: 2d numpy array of one-hot labels
+    :param y_pred: 2d numpy array of predicted probabilities
+    '''
+    eps = K.epsilon()
+    y_pred = y_pred / y_pred.sum(axis=-1, keepdims=True)
+    y_pred = np.clip(y_pred, eps, 1 - eps)
+    return float(-(y_true * np.log(y_pred)).sum(axis=-1).mean())
+
+
+def regularization_loss(model):
+    '''
+    Sum of regularization penalties of a model (added by Keras to the loss)
+    '''
+    if not model.losses:
+        return 0.
+    return float(np.sum(K.batch_get_value(model.losses)))
+
+
+def validation_loss(model, x, y, y_pred):
+    '''
+    Loss of a model on validation data from its predictions, without one more pass over the data.
+    Implemented for categorical crossentropy of every output (with loss weights, if they are given),
+    models with other losses fall back to model.evaluate
+    :param y: 2d numpy array of one-hot labels (list of targets of all outputs for a multi-output model)
+    :param y_pred: predictions of the model for x (list of predictions of all outputs for a multi-output model)
+    '''
+    n_outputs = len(model.outputs)
+    losses = model.loss
+    if isinstance(losses, dict):
+        losses = [losses.get(name) for name in model.output_names]
+    elif not isinstance(losses, (list, tuple)):
+        losses = [losses] * n_outputs
+    loss_weights = getattr(model, 'loss_weights', None)
+    if isinstance(loss_weights, dict):
+        loss_weights = [loss_weights.get(name, 1.) for name in model.output_names]
+    elif not loss_weights:
+        loss_weights = [1.] * n_outputs
+    y_true = y if isinstance(y, list) else [y]
+    y_pred = y_pred if isinstance(y_pred, list) else [y_pred]
+    if not len(losses) == len(loss_weights) == len(y_true) == len(y_pred) == n_outputs or \
+            any(getattr(loss, '__name__', loss) != 'categorical_crossentropy' for loss in losses):
+        if isinstance(x, Sequence):
+            scores = model.evaluate_generator(x)
+        else:
+            scores = model.evaluate(x, y, verbose=0)
+        return scores[0] if isinstance(scores, list) else scores
+    total = 0.
+    for output_true, output_pred, weight in zip(y_true, y_pred, loss_weights):
+        if output_true.ndim == 1:
+            output_true = to_categorical(output_true, output_pred.shape[-1])
+        total += weight * crossentropy(output_true, output_pred)
+    return total + regularization_loss(model)
+
 
 class LossMetricHistory(Callback):
     def __init__(self, n_iter, verbose=1,
-                 fname_bestmodel=None, fname_lastmodel=None):
+                 fname_bestmodel=None, fname_lastmodel=None, restore_best=False, lean=False,
+                 validation_data=None, batch_size=256, patience=None, min_epochs=0):
+        '''
+        Weights of the epoch with the best validation AUC are kept in memory (best_weights)
+        :param validation_data: tuple (x_val, y_val) with one-hot y_val. If given, it should not be passed to fit:
+                                then validation loss, accuracy and AUC are computed from one prediction pass per epoch
+                                (instead of evaluation by Keras and then prediction for AUC) and added to logs
+                                as 'val_loss', 'val_acc' and 'val_auc'. x_val can be a keras.utils.Sequence
+                                of validation batches in order of y_val (see streaming.IndexSequence)
+        :param batch_size: int, batch size of prediction on validation_data
+        :param patience: int, stop training if validation AUC has not improved for this number of epochs.
+                         None - train all the epochs. bestepoch is the same as without stopping, if the best
+                         epoch is not followed by more than patience epochs without improvement
+        :param min_epochs: int, training is not stopped earlier than after this number of epochs
+        :param fname_bestmodel: string, file to save the best weights to (as Model.save_weights, read them
+                                with Model.load_weights). It is written once, at the end of training,
+                                in a background thread (see wait)
+        :param fname_lastmodel: string, file to save the whole model after the last epoch to
+        :param restore_best: bool, set the best weights to the model at the end of training
+                             (after fname_lastmodel is saved)
+        :param lean: bool, store only scalar metrics for every epoch. The ROC curve is computed for the best
+                     epoch only at the end of training: then sens, spc and thresholds (and the same keys
+                     of scores) are 1d arrays of this single curve
+        '''
         super(LossMetricHistory, self).__init__()
         self.n_iter = n_iter
         self.fname_best = fname_bestmodel
         self.fname_last = fname_lastmodel
+        self.restore_best = restore_best
+        self.lean = lean
+        self.val_data = validation_data
+        self.batch_size = batch_size
+        self.patience = patience
+        self.min_epochs = min_epochs
         self.verbose = verbose
+        self.best_weights = None
+        self._flush_thread = None
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)
@@ -42,34 +154,47 @@ class LossMetricHistory(Callback):
 
         self.maxauc = 0
         self.bestepoch = 0
+        self.stopped_epoch = None  # Epoch (counted from 0) after which training was stopped early
+        self.wait()
+        self.best_weights = None
+        self.best_pred = None  # Validation predictions of the best epoch (for ROC curve in lean mode)
 
     def on_epoch_end(self, epoch, logs={}):
+        from sklearn.metrics import roc_curve
         # Count loss and accuracy on the training data
         self.losses.append(logs.get('loss'))
         self.accs.append(logs.get('acc'))
 
         # Count ROC AUC, loss and accuracy on the validation data
-        if self.validation_data is not None:
+        if self._validation() is not None:
+            x_val, y_val = self._validation()
+            if isinstance(x_val, Sequence):
+                self.y_pred = self.model.predict_generator(x_val, workers=2, use_multiprocessing=False)
+            else:
+                self.y_pred = self.model.predict(x_val, batch_size=self.batch_size, verbose=0)
+            if self.val_data is not None:
+                # The only pass over validation data in this epoch
+                logs['val_loss'] = validation_loss(self.model, x_val, y_val, self.y_pred)
+                logs['val_acc'] = float(np.mean(self._y_val_bin() == argmax(self.y_pred, -1)))
             self.val_losses.append(logs.get('val_loss'))
             self.val_accs.append(logs.get('val_acc'))
-            self.y_pred = self.model.predict(self.validation_data[0], verbose=0)#self.y_pred = self.model.predict(self.x_val, verbose=0)
             if self.y_pred.ndim==2 and self.y_pred.shape[1]==2:
                 self.y_pred = max(self.y_pred,1)
-            if self.validation_data[1].ndim==2 and self.validation_data[1].shape[1]==2:
-                self.aucs.append(roc_auc_score(argmax(self.validation_data[1],1), self.y_pred))
-                FPR, TPR, thresholds = roc_curve(argmax(self.validation_data[1],1), self.y_pred)
-            else:
-                self.aucs.append(roc_auc_score(self.validation_data[1], self.y_pred))
-                FPR, TPR, thresholds = roc_curve(self.validation_data[1], self.y_pred)
-            self.sens.append(TPR)
-            self.spc.append(1 - FPR)
-            self.thresholds.append(thresholds)
+            self.aucs.append(fast_auc(self._y_val_bin(), self.y_pred))
+            if self.val_data is not None:
+                logs['val_auc'] = self.aucs[-1]
+            if not self.lean:
+                FPR, TPR, thresholds = roc_curve(self._y_val_bin(), self.y_pred)
+                self.sens.append(TPR)
+                self.spc.append(1 - FPR)
+                self.thresholds.append(thresholds)
 
             if self.aucs[-1] > self.maxauc:
                 self.maxauc = self.aucs[-1]
                 self.bestepoch = epoch
-                if self.fname_best is not None:
-                    self.model.save(self.fname_best)
+                self.best_weights = self.model.get_weights()
+                if self.lean:
+                    self.best_pred = self.y_pred
 
             if self.verbose > 0:
                 self.logger.info("Epoch %d/%d: train loss = %.6f, test loss = %.6f" % (epoch + 1, self.n_iter,
@@ -77,14 +202,41 @@ class LossMetricHistory(Callback):
                                                                                        self.val_losses[-1]) +
                                  "\n\tacc = %.6f, test acc = %.6f" % (self.accs[-1], self.val_accs[-1]) +
                                  "\n\tauc = %.6f" % (self.aucs[-1]))
+
+            if self.patience is not None and epoch + 1 >= self.min_epochs and \
+                    epoch - self.bestepoch >= self.patience:
+                self.stopped_epoch = epoch
+                self.model.stop_training = True
+                if self.verbose > 0:
+                    self.logger.info("Early stopping after epoch %d, best epoch %d" % (epoch + 1, self.bestepoch + 1))
         elif self.verbose > 0:
             self.logger.info("Epoch %d/%d results: train loss = %.6f" % (epoch + 1, self.n_iter, self.losses[-1]) +
                              "\n\t\t\tacc = %.6f" % (self.accs[-1]))
 
+    def _validation(self):
+        '''
+        Own validation data or validation data of fit, None if there is no validation
+        '''
+        if self.val_data is not None:
+            return self.val_data
+        if self.validation_data is not None:
+            return self.validation_data[0], self.validation_data[1]
+        return None
+
+    def _y_val_bin(self):
+        y_val = self._validation()[1]
+        if y_val.ndim==2 and y_val.shape[1]==2:
+            return argmax(y_val,1)
+        return y_val
+
     def on_train_end(self, logs={}):
+        from sklearn.metrics import roc_curve
         self.losses = np.array(self.losses)
-        if self.validation_data is not None:
+        if self._validation() is not None:
             self.val_losses = np.array(self.val_losses)
+            if self.lean and self.best_pred is not None:
+                FPR, self.sens, self.thresholds = roc_curve(self._y_val_bin(), self.best_pred)
+                self.spc = 1 - FPR
             self.scores = {}
             self.scores['auc'] = np.array(self.aucs)
             self.scores['acc'] = np.array(self.val_accs)
@@ -93,7 +245,161 @@ class LossMetricHistory(Callback):
             self.scores['thresholds'] = np.array(self.thresholds)
         if self.fname_last is not None:
             self.model.save(self.fname_last)
+        if self.best_weights is None:
+            return
+        if self.restore_best:
+            self.model.set_weights(self.best_weights)
+        if self.fname_best is not None:
+            import keras
+            # get_weights goes layer by layer
+            layers = []
+            start = 0
+            for layer in self.model.layers:
+                n_weights = len(layer.weights)
+                layers.append((layer.name, [weight.name for weight in layer.weights],
+                               self.best_weights[start:start + n_weights]))
+                start += n_weights
+            self._flush_thread = threading.Thread(target=save_weights_hdf5,
+                                                  args=(self.fname_best, layers, keras.__version__, K.backend()))
+            self._flush_thread.start()
+
+    def wait(self):
+        '''
+        Waits until the best weights are written to fname_bestmodel
+        '''
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+            self._flush_thread = None
+
+
+class TowerMetricHistory(Callback):
+    def __init__(self, n_towers, x, y, val_positions, n_iter, verbose=1, restore_best=True,
+                 batch_size=256, patience=None, min_epochs=0):
+        '''
+        LossMetricHistory for every tower of a model from NN.get_stacked_model: validation loss, accuracy and AUC
+        of a tower are computed on its own validation samples, the best epoch and the best weights are tracked
+        for every tower separately. All towers are validated by one prediction pass over x per epoch
+        :param n_towers: int, number of towers of the model
+        :param x: 3d numpy array, data containing validation samples of all towers (usually the fit data)
+        :param y: 1d numpy array of binary labels of x
+        :param val_positions: list of 1d numpy arrays (one per tower), positions of validation samples in x
+        :param restore_best: bool, set the best weights of every tower to the model at the end of training
+        :param patience: int, a tower is stopped when its validation AUC has not improved for this number
+                         of epochs, training is stopped when all the towers are stopped. None - train all the epochs.
+                         A stopped tower keeps training with the others, but its best epoch and weights are frozen
+                         at the moment it stopped, as if it was trained alone
+        :param min_epochs: int, towers are not stopped earlier than after this number of epochs
+        Note: an epoch of a stacked model takes len(x)/batch_size steps for every tower (all the rows are fit with
+        zero targets out of the fold) rather than the number of steps of a fold trained alone, so the best epochs
+        are not directly comparable with the ones of separate training
+        '''
+        super(TowerMetricHistory, self).__init__()
+        self.n_towers = n_towers
+        self.x = x
+        self.y = np.asarray(y)
+        self.val_positions = [np.asarray(positions) for positions in val_positions]
+        self.n_iter = n_iter
+        self.verbose = verbose
+        self.restore_best = restore_best
+        self.batch_size = batch_size
+        self.patience = patience
+        self.min_epochs = min_epochs
 
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)
+        console = logging.StreamHandler()
+        console.setLevel(logging.INFO)
+        formatter = logging.Formatter("%(message)s")
+        console.setFormatter(formatter)
+        if len(self.logger.handlers) > 0:
+            self.logger.handlers = []
+        self.logger.addHandler(console)
+
+    def on_train_begin(self, logs={}):
+        from src.NN import tower_positions
+        if self.verbose > 0:
+            self.logger.info("Training of %d towers began" % self.n_towers)
+        self.positions = tower_positions(self.model, self.n_towers)
+        # Regularization penalties of every tower (added by Keras to the summed loss)
+        self._tower_penalties = [[] for _ in range(self.n_towers)]
+        for layer in self.model.layers:
+            if layer.losses:
+                self._tower_penalties[int(layer.name.split('_')[0][len('tower'):])].extend(layer.losses)
+        # Histories, rows are epochs and columns are towers. Training accuracy is not tracked: logged accuracies
+        # of towers count samples out of their folds (with zero targets)
+        self.losses = []
+        self.val_losses = []
+        self.val_accs = []
+        self.aucs = []
+
+        self.maxauc = np.zeros(self.n_towers)
+        self.bestepoch = np.zeros(self.n_towers, dtype=int)
+        self.stopped_epoch = None
+        self.tower_stopped_epochs = np.full(self.n_towers, -1, dtype=int)  # -1 - the tower is still running
+        self.best_weights = [None] * self.n_towers  # Weights of every tower (see NN.tower_positions)
+        self.best_pred = [None] * self.n_towers  # Validation predictions of the best epoch of every tower
+
+    def on_epoch_end(self, epoch, logs={}):
+        # Loss of a single output is logged as 'loss'
+        names = self.model.output_names
+        self.losses.append([logs.get('%s_loss' % name, logs.get('loss')) for name in names])
+
+        y_pred = self.model.predict(self.x, batch_size=self.batch_size, verbose=0)
+        if not isinstance(y_pred, list):
+            y_pred = [y_pred]
+        penalties = [float(np.sum(K.batch_get_value(p))) if p else 0. for p in self._tower_penalties]
+        weights = None
+        val_losses, val_accs, aucs = [], [], []
+        for k, positions in enumerate(self.val_positions):
+            tower_pred = y_pred[k][positions]
+            y_val = self.y[positions]
+            val_losses.append(crossentropy(to_categorical(y_val, tower_pred.shape[-1]), tower_pred) + penalties[k])
+            val_accs.append(float(np.mean(y_val == argmax(tower_pred, -1))))
+            # Scored as in LossMetricHistory
+            aucs.append(fast_auc(y_val, max(tower_pred, 1)))
+            if self.tower_stopped_epochs[k] >= 0:
+                continue
+            if aucs[-1] > self.maxauc[k]:
+                self.maxauc[k] = aucs[-1]
+                self.bestepoch[k] = epoch
+                if weights is None:
+                    weights = self.model.get_weights()
+                self.best_weights[k] = [weights[i] for i in self.positions[k]]
+                self.best_pred[k] = tower_pred
+            elif self.patience is not None and epoch + 1 >= self.min_epochs and \
+                    epoch - self.bestepoch[k] >= self.patience:
+                self.tower_stopped_epochs[k] = epoch
+        self.val_losses.append(val_losses)
+        self.val_accs.append(val_accs)
+        self.aucs.append(aucs)
+        logs['val_loss'] = float(np.mean(val_losses))
+        logs['val_auc'] = float(np.mean(aucs))
+
+        if self.verbose > 0:
+            self.logger.info("Epoch %d/%d: train loss = %.6f, test loss = %.6f" % (epoch + 1, self.n_iter,
+                                                                                   np.mean(self.losses[-1]),
+                                                                                   logs['val_loss']) +
+                             "\n\tauc = %s" % ', '.join('%.6f' % auc for auc in aucs))
+
+        if self.patience is not None and (self.tower_stopped_epochs >= 0).all():
+            self.stopped_epoch = epoch
+            self.model.stop_training = True
+            if self.verbose > 0:
+                self.logger.info("Early stopping after epoch %d, best epochs %s" %
+                                 (epoch + 1, ', '.join(str(e + 1) for e in self.bestepoch)))
+
+    def on_train_end(self, logs={}):
+        self.losses = np.array(self.losses)
+        self.val_losses = np.array(self.val_losses)
+        self.val_accs = np.array(self.val_accs)
+        self.aucs = np.array(self.aucs)
+        if self.restore_best:
+            weights = self.model.get_weights()
+            for positions, best_weights in zip(self.positions, self.best_weights):
+                if best_weights is not None:
+                    for i, value in zip(positions, best_weights):
+                        weights[i] = value
+            self.model.set_weights(weights)
 
 '''
 class LossMetricHistory(Callback):
@@ -197,23 +503,25 @@ class PerSubjAucMetricHistory(Callback):
         for subj in self.subjects.keys():
             x,y = self.subjects[subj]
 
-            y_pred = self.model.predict(x, verbose=0)
-            if isinstance(y_pred,list):
-                y_pred = y_pred[0]
+            # One prediction pass gives both AUC and loss
+            outputs = self.model.predict(x, verbose=0)
+            y_pred = outputs[0] if isinstance(outputs,list) else outputs
             if len(y_pred.shape) == 1:
                 y_pred = to_categorical(y_pred,2)
             if len(y.shape) == 1:
                 y = to_categorical(y,2)
-            y_pred = to_categorical(y_pred) if (len(y_pred.shape)==1) else y_pred
-            logs['val_auc_%s' %(subj)] = roc_auc_score(y[:,1], y_pred[:,1])
-            if type(self.model.output) == list:
-                fake_subj_labels = np.zeros((len(y),self.model.output[1].shape._dims[1]._value))
-                logs['val_loss_%s' % (subj)] = self.model.evaluate(x,[y,fake_subj_labels], verbose=0)[0]
+            logs['val_auc_%s' %(subj)] = fast_auc(y[:,1], y_pred[:,1])
+            if isinstance(outputs,list):
+                # Zero targets of other outputs (subject labels) add nothing to crossentropy
+                fake_subj_labels = [np.zeros_like(output) for output in outputs[1:]]
+                logs['val_loss_%s' % (subj)] = validation_loss(self.model, x, [y] + fake_subj_labels,
+                                                               [y_pred] + outputs[1:])
             else:
-                logs['val_loss_%s' % (subj)] = self.model.evaluate(x,y, verbose=0)[0]
+                logs['val_loss_%s' % (subj)] = validation_loss(self.model, x, y, y_pred)
 
 class AucMetricHistory(Callback):
     def on_epoch_end(self, epoch, logs={}):
+        from sklearn.metrics import roc_auc_score
         x_val,y_val = self.validation_data[0],self.validation_data[1]
         y_pred = self.model.predict(x_val,batch_size=len(y_val), verbose=0)
         if isinstance(y_pred,list):
@@ -223,6 +531,7 @@ class AucMetricHistory(Callback):
 
 class DomainActivations(Callback):
     def __init__(self, x_train,y_train, subj_label_train,path_to_save):
+        import matplotlib.pyplot as plt
         super(DomainActivations, self).__init__()
         self.path_to_save = '%s/domain_activations_grl/' % path_to_save
         self.x_train = x_train
@@ -235,6 +544,7 @@ class DomainActivations(Callback):
         plt.savefig(os.path.join('%s/class_distr' % self.path_to_save))
         plt.close()
     def _log_domain_activations(self, domain_label_pred, domain_label,pic_name):
+        import matplotlib.pyplot as plt
         activations = (domain_label_pred * domain_label).sum(axis=1)
         plt.plot(activations)
         # plt.plot(activations[self.y_train[:,1] == 1])
@@ -411,6 +721,7 @@ class MyTensorBoard(Callback):
             projector.visualize_embeddings(self.writer, config)
 
     def on_epoch_end(self, epoch, logs=None):
+        from sklearn.metrics import roc_auc_score
         logs = logs or {}
 
         if not self.validation_data and self.histogram_freq:
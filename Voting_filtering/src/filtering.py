@@ -0,0 +1,285 @@
+'''
+Label noise filtering strategies computed from shared trained models. collect_predictions trains cross-validation
+folds of a subject once (optionally on several shufflings of the training set) and keeps out-of-fold and ensemble
+predictions in a Predictions object. Strategy objects (ThresholdFilter, RateFilter, EnsembleFilter, NaiveFilter,
+VoteFilter) only read these predictions, so every rule of classification_filtering.py, cf_ensemble_naive.py
+and vf_val_*_vote.py is evaluated without training the folds again.
+Each strategy reads the predictions of its training group (its group attribute): 'cf' - one unshuffled split
+with the settings of classification_filtering.py and cf_ensemble_naive.py, 'vf' - several shuffled splits
+with the settings of vf_val_*_vote.py:
+
+    predictions = {'cf': collect_predictions(X, y, train_ind, test_ind, 150, (0.72,0.32,0.05)),
+                   'vf': collect_predictions(X, y, train_ind, test_ind, 150, (0.2,0.4,0.6), n_shufflings=5,
+                                             shuffle_splits=True)}
+    for strategy in [ThresholdFilter(), RateFilter(0.1), EnsembleFilter(0.1), VoteFilter('majority')]:
+        pure_ind, err_nontarg_ind, err_target_ind = strategy.select(predictions[strategy.group])
+'''
+import numpy as np
+
+
+class Predictions(object):
+    '''
+    Predictions of models of a subject (probabilities of the target class) shared by all strategies of a group.
+    All per-sample arrays are aligned with train_ind
+    '''
+    def __init__(self, train_ind, test_ind, y_train, oof, fold_of, ensemble, ensemble_test, bestepoch, naive=None):
+        '''
+        :param train_ind: 1d numpy array, indices of training samples in the initial X array
+        :param test_ind: 1d numpy array, indices of test samples
+        :param y_train: 1d numpy array, labels of training samples
+        :param oof: 2d numpy array (Shufflings x Training samples), out-of-fold predictions of every shuffling
+        :param fold_of: 2d int numpy array of the same shape, number of the fold a sample is validated in
+        :param ensemble: 1d numpy array, mean prediction of the fold models of the first split on the training set
+        :param ensemble_test: 1d numpy array, mean prediction of the same models on the test set
+        :param bestepoch: int, mean best epoch of the fold models of the last split
+        :param naive: 1d numpy array, predictions of a model trained on the whole training set (see NaiveFilter).
+                      None - not computed
+        '''
+        self.train_ind = train_ind
+        self.test_ind = test_ind
+        self.y_train = y_train
+        self.oof = oof
+        self.fold_of = fold_of
+        self.ensemble = ensemble
+        self.ensemble_test = ensemble_test
+        self.bestepoch = bestepoch
+        self.naive = naive
+
+    @property
+    def n_shufflings(self):
+        return self.oof.shape[0]
+
+
+def split_folds(y_train, nfold=4, n_shufflings=1, shuffle_splits=False):
+    '''
+    Cross-validation splits of a training set as in the drivers
+    :param shuffle_splits: bool. False - a single unshuffled split (classification_filtering.py,
+                           cf_ensemble_naive.py), True - n_shufflings splits shuffled with random_state 1, 3, 5...
+                           (vf_val_*_vote.py)
+    :return: list (one per shuffling) of lists of tuples (train positions, validation positions) in y_train
+    '''
+    from sklearn.model_selection import StratifiedKFold
+    if shuffle_splits:
+        cvs = [StratifiedKFold(n_splits=nfold, shuffle=True, random_state=i*2+1) for i in range(n_shufflings)]
+    elif n_shufflings == 1:
+        cvs = [StratifiedKFold(n_splits=nfold, shuffle=False)]
+    else:
+        raise ValueError('%d unshuffled splits would be the same split' % n_shufflings)
+    dummy_X = np.zeros((len(y_train), 1))
+    return [list(cv.split(dummy_X, y_train)) for cv in cvs]
+
+
+def collect_predictions(X, y, train_ind, test_ind, epochs, dropouts, nfold=4, n_shufflings=1,
+                        shuffle_splits=False, **train_kwargs):
+    '''
+    Trains folds of all shufflings of the training set once (train_folds) and collects their predictions.
+    As in the drivers, the ensemble consists of the nfold models of the first split and the number of epochs
+    for final models is the mean best epoch of the folds of the last split
+    :param X: 3d numpy array (Trials x Time x Channels)
+    :param y: 1d numpy array of binary labels
+    :param shuffle_splits: bool, see split_folds
+    :param train_kwargs: other arguments of train_folds (seed, n_jobs, patience...)
+    :return: Predictions (without naive predictions)
+    '''
+    from src.folds import train_folds
+
+    train_ind, test_ind = np.asarray(train_ind), np.asarray(test_ind)
+    y_train = y[train_ind]
+    splits = split_folds(y_train, nfold, n_shufflings, shuffle_splits)
+    folds = [(train_ind[tr_pos], train_ind[val_pos]) for split in splits for tr_pos, val_pos in split]
+    fold_results = train_folds(X, y, folds, epochs=epochs, dropouts=dropouts,
+                               predict_on={'train': train_ind, 'test': test_ind}, **train_kwargs)
+
+    oof = np.zeros((len(splits), len(train_ind)))
+    fold_of = np.zeros((len(splits), len(train_ind)), dtype=np.int32)
+    fold_results_iter = iter(fold_results)
+    for s, split in enumerate(splits):
+        for f, (_, val_pos) in enumerate(split):
+            result = next(fold_results_iter)
+            oof[s, val_pos] = result['predictions']['val'][:, 1]
+            fold_of[s, val_pos] = f
+    first, last = fold_results[:nfold], fold_results[-nfold:]
+    ensemble = np.mean([result['predictions']['train'][:, 1] for result in first], axis=0)
+    ensemble_test = np.mean([result['predictions']['test'][:, 1] for result in first], axis=0)
+    bestepoch = int(round(np.mean([result['bestepoch'] for result in last])))
+    return Predictions(train_ind, test_ind, y_train, oof, fold_of, ensemble, ensemble_test, bestepoch)
+
+
+def select_errors(y_pred, y_true, ind, rate=None, threshold=None):
+    '''
+    Splits samples into pure ones and erroneous ones of each class. Either rate of samples of each class with
+    the most erroneous predictions is erroneous (only these samples are sorted, with np.argpartition), or samples
+    misclassified with threshold are erroneous
+    :param y_pred: 1d numpy array, predicted probabilities of the target class
+    :param y_true: 1d numpy array, labels
+    :param ind: 1d numpy array, indices of the samples in the initial X array
+    :param rate: float from 0 to 0.5 or list of floats. For a list the most erroneous samples are sorted once
+                 for the largest rate, sets of other rates are prefixes of its sets
+    :param threshold: float, used if rate is None: samples with y_pred >= threshold are classified as target
+    :return: tuple of 1d int32 numpy arrays (pure_ind, err_nontarg_ind, err_target_ind), list of such tuples
+             (one per rate) if rate is a list
+    '''
+    y_pred = np.asarray(y_pred)
+    y_true = np.asarray(y_true)
+    ind = np.asarray(ind).astype(np.int32)
+    target = y_true == 1
+    if rate is None:
+        pure = (y_pred >= threshold) == target
+        return ind[pure], ind[~pure & ~target], ind[~pure & target]
+    if np.isscalar(rate):
+        return select_errors(y_pred, y_true, ind, [rate])[0]
+
+    target_ind, nontarg_ind = ind[target], ind[~target]
+    n_err1 = [int(np.round(len(target_ind)*r)) for r in rate]  # Numbers of samples in target class to be thrown away
+    n_err0 = [int(np.round(len(nontarg_ind)*r)) for r in rate]  # and in nontarget class
+    # The most erroneous target samples have the lowest predictions, nontarget samples the highest ones
+    err_pos1 = _most_erroneous(y_pred[target], max([0] + n_err1))
+    err_pos0 = _most_erroneous(-y_pred[~target], max([0] + n_err0))
+    sets = []
+    for n1, n0 in zip(n_err1, n_err0):
+        pure_ind = np.empty(len(ind) - n1 - n0, dtype=np.int32)
+        mask1 = np.ones(len(target_ind), dtype=bool)
+        mask1[err_pos1[:n1]] = False
+        mask0 = np.ones(len(nontarg_ind), dtype=bool)
+        mask0[err_pos0[:n0]] = False
+        n_pure1 = len(target_ind) - n1
+        pure_ind[:n_pure1] = target_ind[mask1]
+        pure_ind[n_pure1:] = nontarg_ind[mask0]
+        sets.append((pure_ind, nontarg_ind[err_pos0[:n0]], target_ind[err_pos1[:n1]]))
+    return sets
+
+
+def _most_erroneous(key, n):
+    '''
+    Positions of n smallest values of key in ascending order: only these values are sorted
+    '''
+    if n == 0:
+        return np.zeros(0, dtype=np.intp)
+    positions = np.argpartition(key, n - 1)[:n] if n < len(key) else np.arange(len(key))
+    return positions[np.argsort(key[positions], kind='stable')]
+
+
+class ThresholdFilter(object):
+    '''
+    classification_filtering.py without a rate: in every fold of the (unshuffled) split the threshold is chosen
+    on out-of-fold predictions so that specificity is at least 1 - max_fpr, misclassified samples are noisy
+    '''
+    def __init__(self, max_fpr=0.1):
+        self.max_fpr = max_fpr
+        self.name = 'threshold'
+        self.group = 'cf'
+
+    def select(self, predictions):
+        '''
+        :return: pure_ind, err_nontarg_ind, err_target_ind - indices into the initial X array
+        '''
+        from sklearn.metrics import roc_curve
+        y_true, y_pred, fold_of = predictions.y_train, predictions.oof[0], predictions.fold_of[0]
+        parts = []
+        for f in np.unique(fold_of):
+            in_fold = fold_of == f
+            FPR, TPR, thresholds = roc_curve(y_true[in_fold], y_pred[in_fold])
+            threshold = (thresholds[FPR <= self.max_fpr]).min()
+            parts.append(select_errors(y_pred[in_fold], y_true[in_fold], predictions.train_ind[in_fold],
+                                       threshold=threshold))
+        return tuple(np.concatenate(part) for part in zip(*parts))
+
+
+class RateFilter(object):
+    '''
+    classification_filtering.py with a filtration rate: in every fold of the (unshuffled) split rate of samples
+    of each class with the most erroneous out-of-fold predictions are noisy
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.name = 'rate%s' % rate
+        self.group = 'cf'
+
+    def select(self, predictions):
+        '''
+        :return: pure_ind, err_nontarg_ind, err_target_ind - indices into the initial X array
+        '''
+        y_true, y_pred, fold_of = predictions.y_train, predictions.oof[0], predictions.fold_of[0]
+        parts = [select_errors(y_pred[fold_of == f], y_true[fold_of == f], predictions.train_ind[fold_of == f],
+                               self.rate)
+                 for f in np.unique(fold_of)]
+        return tuple(np.concatenate(part) for part in zip(*parts))
+
+
+class EnsembleFilter(object):
+    '''
+    Ensemble model of cf_ensemble_naive.py: rate of samples of each class of the whole training set
+    with the most erroneous mean predictions of the fold models are noisy
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.name = 'ensemble%s' % rate
+        self.group = 'cf'
+
+    def _predictions(self, predictions):
+        return predictions.ensemble
+
+    def select(self, predictions):
+        '''
+        :return: pure_ind, err_nontarg_ind, err_target_ind - indices into the initial X array
+        '''
+        y_pred = self._predictions(predictions)
+        if y_pred is None:
+            raise ValueError('%s filter needs predictions which were not computed' % self.name)
+        return select_errors(y_pred, predictions.y_train, predictions.train_ind, self.rate)
+
+
+class NaiveFilter(EnsembleFilter):
+    '''
+    Naive model of cf_ensemble_naive.py: as EnsembleFilter, but with predictions of a single model trained
+    on the whole noisy training set (Predictions.naive)
+    '''
+    def __init__(self, rate):
+        super(NaiveFilter, self).__init__(rate)
+        self.name = 'naive%s' % rate
+
+    def _predictions(self, predictions):
+        return predictions.naive
+
+
+class VoteFilter(object):
+    '''
+    vf_val_*_vote.py: a sample is noisy if its out-of-fold prediction is wrong (by 0.5) in at least half
+    of the shufflings ('majority') or in all of them ('consensus')
+    '''
+    def __init__(self, rule='majority'):
+        if rule not in ('majority', 'consensus'):
+            raise ValueError('Unknown vote rule %s' % rule)
+        self.rule = rule
+        self.name = rule
+        self.group = 'vf'
+
+    def select(self, predictions):
+        '''
+        :return: pure_ind, err_nontarg_ind, err_target_ind - indices into the initial X array
+        '''
+        mistakes = (np.abs(predictions.y_train - predictions.oof) >= 0.5).sum(axis=0)
+        n_votes = predictions.n_shufflings / 2. if self.rule == 'majority' else predictions.n_shufflings
+        return _split_mask(predictions, mistakes < n_votes)
+
+
+def _split_mask(predictions, pure):
+    '''
+    Indices of pure samples and of erroneous samples of each class by a boolean mask of pure training samples
+    '''
+    train_ind, y_true = predictions.train_ind, predictions.y_train
+    return (train_ind[pure].astype(np.int32), train_ind[~pure & (y_true == 0)].astype(np.int32),
+            train_ind[~pure & (y_true == 1)].astype(np.int32))
+
+
+def get_strategies(rates=(0.1,), max_fpr=0.1, votes=True):
+    '''
+    Default set of strategies: threshold, rate, ensemble and naive filters for every rate ('cf' group) and votes
+    ('vf' group, the latter need several shufflings)
+    '''
+    strategies = [ThresholdFilter(max_fpr)]
+    for rate in rates:
+        strategies += [RateFilter(rate), EnsembleFilter(rate), NaiveFilter(rate)]
+    if votes:
+        strategies += [VoteFilter('majority'), VoteFilter('consensus')]
+    return strategies
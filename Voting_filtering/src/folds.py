@@ -0,0 +1,339 @@
+import os
+import shutil
+import random
+import pickle
+import hashlib
+import tempfile
+import multiprocessing
+import numpy as np
+
+_worker = {}  # State of a fold worker process, filled by _init_worker
+_FOLD_CACHE_VERSION = 1  # Bump when get_model or training of folds changes, so old cache entries are not reused
+
+
+def new_session(intra_op_threads, inter_op_threads=1, seed=None):
+    '''
+    Replaces the Keras session by a new one (with a new graph) with limited thread pools.
+    Used in worker processes, where several models are trained on one machine in parallel
+    :param seed: int, seed of random, numpy and the new TF graph. None - no seeding
+    '''
+    import tensorflow as tf
+    from keras import backend as K
+
+    K.clear_session()
+    # Graph-level seed has to be set on the new graph
+    if seed is not None:
+        random.seed(seed)
+        np.random.seed(seed)
+        tf.set_random_seed(seed)
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+    K.set_session(tf.Session(graph=tf.get_default_graph(), config=config))
+
+
+def _array_digest(a, chunk=1024):
+    '''
+    sha1 of shape, type and contents of an array (or memory map), read in chunks of trials
+    '''
+    a = np.asarray(a)
+    h = hashlib.sha1(repr((a.shape, a.dtype.str)).encode('utf8'))
+    for start in range(0, len(a), chunk):
+        h.update(np.ascontiguousarray(a[start:start + chunk]))
+    return h.hexdigest()
+
+
+def _fold_cache_key(X, y, folds, predict_on, seed, params):
+    '''
+    Everything that defines results of train_folds: data, folds, sets to predict, seeds and hyperparameters
+    of training and of get_model
+    '''
+    from src.NN import LEARNING_RATE, L1_L2
+    key = [_FOLD_CACHE_VERSION, _array_digest(X), _array_digest(y),
+           [(_array_digest(tr_ind), _array_digest(val_ind)) for tr_ind, val_ind in folds],
+           sorted((name, _array_digest(ind)) for name, ind in predict_on.items()),
+           list(seed), sorted(params.items()), LEARNING_RATE, L1_L2]
+    return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+
+def _read_fold_cache(entry, fname_bestmodels):
+    '''
+    Results of train_folds from a cache entry (and copies of the best weights to fname_bestmodels),
+    None if there is no entry or it misses a file of the best weights
+    '''
+    try:
+        with open(os.path.join(entry, 'results.pkl'), 'rb') as f:
+            results = pickle.load(f)
+        for fold_num, fname_best in enumerate(fname_bestmodels):
+            if fname_best is not None:
+                shutil.copyfile(os.path.join(entry, 'model%d.hdf5' % fold_num), fname_best)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return results
+
+
+def _init_worker(fname_X, intra_op_threads, inter_op_threads):
+    '''
+    Initializer of fold worker processes: maps the data and remembers thread counts for TF sessions
+    '''
+    _worker['X'] = np.load(fname_X, mmap_mode='r')
+    _worker['threads'] = (intra_op_threads, inter_op_threads)
+
+
+def _train_fold(task):
+    '''
+    Trains get_model on one fold in a worker process (see train_folds)
+    '''
+    from keras.utils import to_categorical
+    from src.NN import get_model
+    from src.callbacks import LossMetricHistory
+    from src.streaming import IndexSequence, fit_stream, predict_stream
+
+    tr_ind, val_ind, y, predict_on, seed, fname_best, params = task
+    X = _worker['X']
+    intra_op_threads, inter_op_threads = _worker['threads']
+
+    new_session(intra_op_threads, inter_op_threads, seed)  # Fresh graph and session for every fold
+
+    y_val = to_categorical(y[val_ind], 2)
+    if params['stream']:
+        # Batches are gathered from the memory-mapped X, fold subsets are not copied
+        x_val = IndexSequence(X, val_ind, y, batch_size=256)
+        predict = lambda ind: predict_stream(model, X, ind)
+    else:
+        X_tr, y_tr = X[tr_ind], to_categorical(y[tr_ind], 2)
+        x_val = X[val_ind]
+        predict = lambda ind: model.predict(X[ind])
+    model = get_model(X.shape[1], X.shape[2], dropouts=params['dropouts'])
+    # Best weights are restored from memory, fname_best is written in background while predicting
+    callback = LossMetricHistory(n_iter=params['epochs'], verbose=params['verbose'], fname_bestmodel=fname_best,
+                                 restore_best=True, lean=True, validation_data=(x_val, y_val),
+                                 patience=params['patience'], min_epochs=params['min_epochs'])
+    if params['stream']:
+        fit_stream(model, X, y, tr_ind, epochs=params['epochs'], callbacks=[callback],
+                   batch_size=params['batch_size'], shuffle=params['shuffle'], seed=seed)
+    else:
+        model.fit(X_tr, y_tr, epochs=params['epochs'], callbacks=[callback],
+                  batch_size=params['batch_size'], shuffle=params['shuffle'], verbose=0)
+
+    predictions = {'val': predict(val_ind)}
+    if params['predict_train']:
+        predictions['fold_train'] = predict(tr_ind)
+    for name, ind in predict_on.items():
+        predictions[name] = predict(ind)
+    callback.wait()
+    return {'bestepoch': callback.bestepoch + 1,
+            'weights': model.get_weights(),
+            'predictions': predictions,
+            'losses': np.array(callback.losses),
+            'val_losses': np.array(callback.val_losses),
+            'aucs': np.array(callback.aucs)}
+
+
+def _train_pool(X, tasks, n_jobs, intra_op_threads, inter_op_threads):
+    '''
+    Runs _train_fold for every task in a pool of n_jobs spawned worker processes (see train_folds)
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='folds_')
+    # Spawned workers inherit the environment: limit OpenMP/MKL threads in the same way as TF threads
+    thread_vars = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS']
+    saved_env = dict((var, os.environ.get(var)) for var in thread_vars)
+    try:
+        fname_X = os.path.join(tmp_dir, 'X.npy')
+        np.save(fname_X, X)
+        for var in thread_vars:
+            os.environ[var] = str(intra_op_threads)
+        pool = multiprocessing.get_context('spawn').Pool(n_jobs, initializer=_init_worker,
+                                                           initargs=(fname_X, intra_op_threads, inter_op_threads))
+        try:
+            results = pool.map(_train_fold, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def train_folds(X, y, folds, epochs, dropouts, predict_on=None, predict_train=False, seed=None,
+                fname_bestmodels=None, n_jobs=None, intra_op_threads=None, inter_op_threads=1, batch_size=64,
+                shuffle=True, verbose=0, patience=None, min_epochs=0, stream=False, cache_dir=None):
+    '''
+    Trains a model (get_model) on every cross-validation fold, each fold in a separate worker process
+    (or one after another in the current process if n_jobs is 1).
+    Every fold is trained as in the serial loop of the drivers: LossMetricHistory tracks validation AUC,
+    and the model is evaluated with the weights of its best epoch.
+    Workers are started with 'spawn', so the calling script should be protected by if __name__ == '__main__'.
+    Data is passed to them as a memory-mapped .npy file. Inside a worker of another pool (e.g. schedule_subjects)
+    use n_jobs=1: daemonic workers (Python < 3.9) can not start processes
+    :param X: 3d numpy array (Trials x Time x Channels)
+    :param y: 1d numpy array of binary labels
+    :param folds: list of tuples (train indices, validation indices), indices into X
+    :param epochs: int, number of training epochs
+    :param patience: int, early stopping of a fold if validation AUC has not improved for this number of epochs
+                     (see LossMetricHistory). None - all the epochs are trained
+    :param min_epochs: int, no early stopping before this number of epochs
+    :param stream: bool, feed batches from the memory-mapped X by indices in background threads (see streaming)
+                   instead of copying training and validation subsets of every fold
+    :param dropouts: dropouts of get_model
+    :param predict_on: dict {name: indices into X}, additional sets to predict with the best model of every fold
+    :param predict_train: bool, predict also the training part of every fold ('fold_train' in predictions)
+    :param seed: int or list of ints (one per fold). A fold worker seeds random, numpy and TF with it
+                 before building its model. None - no seeding
+    :param fname_bestmodels: list of file names (one per fold) to save the best weights of every fold to
+                             (read them with Model.load_weights). None - best weights are kept only in memory
+    :param n_jobs: int, number of worker processes (default: number of folds, but not more than CPU cores).
+                   1 - folds are trained in the current process, without a pool
+    :param intra_op_threads: int, TF intra-op threads of every worker (default: CPU cores / n_jobs)
+    :param inter_op_threads: int, TF inter-op threads of every worker
+    :param cache_dir: string, folder of cached results. Results (with files of the best weights) are stored
+                      under the hash of X, y, folds, predict_on, seeds and hyperparameters (of training and
+                      of get_model), a later call with the same ones reads them instead of training.
+                      None - no cache. Training without seeds (seed None for some fold) is not cached,
+                      as its results are not reproducible
+    :return: list of dicts (one per fold, in order of folds) with keys: 'bestepoch' (counted from 1),
+             'weights' (best weights, as model.get_weights()), 'predictions' (dict {name: model output}
+             for 'val' (out-of-fold predictions), 'fold_train' (if predict_train) and names of predict_on),
+             'losses', 'val_losses', 'aucs' (histories of LossMetricHistory)
+    '''
+    cpu_count = multiprocessing.cpu_count()
+    if n_jobs is None:
+        n_jobs = min(len(folds), cpu_count)
+    if intra_op_threads is None:
+        intra_op_threads = max(cpu_count // n_jobs, 1)
+    if seed is None or np.isscalar(seed):
+        seed = [seed] * len(folds)
+    params = {'epochs': epochs, 'dropouts': dropouts, 'batch_size': batch_size, 'shuffle': shuffle,
+              'verbose': verbose, 'predict_train': predict_train, 'patience': patience, 'min_epochs': min_epochs,
+              'stream': stream}
+    y = np.asarray(y)
+    folds = [(np.asarray(tr_ind), np.asarray(val_ind)) for tr_ind, val_ind in folds]
+    predict_on = predict_on or {}
+    if fname_bestmodels is None:
+        fname_bestmodels = [None] * len(folds)
+
+    entry = None
+    if cache_dir is not None and all(fold_seed is not None for fold_seed in seed):
+        cache_params = dict((name, value) for name, value in params.items() if name != 'verbose')
+        entry = os.path.join(cache_dir, _fold_cache_key(X, y, folds, predict_on, seed, cache_params))
+        results = _read_fold_cache(entry, fname_bestmodels)
+        if results is not None:
+            return results
+        # Best weights of folds are written into a new entry, which becomes visible when it is complete
+        tmp_entry = '%s.tmp%d' % (entry, os.getpid())
+        if os.path.isdir(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+        fname_workers = [os.path.join(tmp_entry, 'model%d.hdf5' % fold_num) for fold_num in range(len(folds))]
+    else:
+        fname_workers = fname_bestmodels
+    tasks = [(tr_ind, val_ind, y, predict_on, fold_seed, fname_best, params)
+             for (tr_ind, val_ind), fold_seed, fname_best in zip(folds, seed, fname_workers)]
+
+    if n_jobs == 1:
+        _worker['X'] = X
+        _worker['threads'] = (intra_op_threads, inter_op_threads)
+        try:
+            results = [_train_fold(task) for task in tasks]
+        finally:
+            _worker.clear()
+    else:
+        results = _train_pool(X, tasks, n_jobs, intra_op_threads, inter_op_threads)
+
+    if entry is not None:
+        with open(os.path.join(tmp_entry, 'results.pkl'), 'wb') as f:
+            pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)  # incomplete or concurrent entry
+        os.rename(tmp_entry, entry)
+        for fold_num, fname_best in enumerate(fname_bestmodels):
+            if fname_best is not None:
+                shutil.copyfile(os.path.join(entry, 'model%d.hdf5' % fold_num), fname_best)
+    return results
+
+
+def _outputs(y_pred):
+    '''
+    Predictions of a multi-output model as a list (Keras returns a single array for one output)
+    '''
+    return y_pred if isinstance(y_pred, list) else [y_pred]
+
+
+def train_folds_stacked(X, y, folds, epochs, dropouts=None, model=None, predict_on=None, predict_train=False,
+                        batch_size=64, shuffle=True, verbose=0, patience=None, min_epochs=0):
+    '''
+    Trains all cross-validation folds at once, in the current process: every fold is a tower of one stacked model
+    (see NN.get_stacked_model), which is fitted on the union of samples of all folds. Targets of a tower are masked
+    out of the training part of its fold, so each tower learns from its own training samples only.
+    Validation AUC and the best epoch of every tower are tracked by TowerMetricHistory, the model is evaluated
+    with the best weights of every tower. Results have the same structure as those of train_folds.
+    Best epochs of towers are not those of get_model trained on the folds: an epoch takes len(rows)/batch_size
+    steps, and batch normalizations of a tower see its validation samples (inputs, not labels). Use them to
+    compare towers, but take the number of epochs for final models from folds trained by get_model
+    :param X: 3d numpy array (Trials x Time x Channels)
+    :param y: 1d numpy array of binary labels
+    :param folds: list of tuples (train indices, validation indices), indices into X. Folds of several
+                  cross-validation splits (e.g. repeated shufflings) can be trained together
+    :param dropouts: dropouts of get_model, used if model is None
+    :param model: compiled model from get_stacked_model with len(folds) towers (e.g. from
+                  ModelFactory(dropouts, build=partial(get_stacked_model, n_towers=len(folds))), for reuse
+                  over subjects). None - a new model is built
+    :param patience: int, a fold stops (its best epoch and weights are frozen) when its validation AUC has not
+                     improved for this number of epochs, training stops when all the folds have stopped.
+                     None - all the epochs are trained. Note that an epoch here takes len(rows)/batch_size steps,
+                     more than an epoch of a fold trained alone by train_folds, so best epochs differ from its ones
+    :return: list of dicts (one per fold, in order of folds), see train_folds. 'losses', 'val_losses' and 'aucs'
+             are histories of the tower of the fold
+    '''
+    from keras.utils import to_categorical
+    from src.NN import get_stacked_model
+    from src.callbacks import TowerMetricHistory
+
+    y = np.asarray(y)
+    folds = [(np.asarray(tr_ind), np.asarray(val_ind)) for tr_ind, val_ind in folds]
+    # All the samples of the folds, every one is fed to the model once per epoch
+    rows = np.unique(np.concatenate([np.concatenate(fold) for fold in folds]))
+    X_rows = X[rows]
+    y_rows = to_categorical(y[rows], 2)
+    # A tower gets zero targets (zero crossentropy and gradient) for samples out of the training part of its fold.
+    # Zero sample weights would do the same, but Keras divides the loss of a batch by the number of nonzero
+    # weights, which is zero for a small batch without samples of the fold. Instead the loss of a tower is scaled
+    # by a constant weight, so that on average it is the mean over its own training samples, as in get_model
+    targets, sample_weights = [], []
+    for tr_ind, _ in folds:
+        mask = np.zeros(len(rows), dtype=np.float32)
+        mask[np.searchsorted(rows, tr_ind)] = 1.
+        targets.append(y_rows * mask[:, None])
+        sample_weights.append(np.full(len(rows), len(rows) / mask.sum(), dtype=np.float32))
+    val_positions = [np.searchsorted(rows, val_ind) for _, val_ind in folds]
+
+    if model is None:
+        model = get_stacked_model(X.shape[1], X.shape[2], dropouts, len(folds))
+    callback = TowerMetricHistory(len(folds), X_rows, y[rows], val_positions, n_iter=epochs, verbose=verbose,
+                                  patience=patience, min_epochs=min_epochs)
+    model.fit(X_rows, targets, sample_weight=sample_weights, epochs=epochs, callbacks=[callback],
+              batch_size=batch_size, shuffle=shuffle, verbose=0)
+
+    # One prediction pass for all the folds
+    predict = lambda x: _outputs(model.predict(x))
+    y_pred = predict(X_rows)
+    other = dict((name, predict(X[ind])) for name, ind in (predict_on or {}).items())
+    weights = model.get_weights()  # The best weights of every tower
+    results = []
+    for k, (tr_ind, _) in enumerate(folds):
+        predictions = {'val': y_pred[k][val_positions[k]]}
+        if predict_train:
+            predictions['fold_train'] = y_pred[k][np.searchsorted(rows, tr_ind)]
+        for name, pred in other.items():
+            predictions[name] = pred[k]
+        results.append({'bestepoch': callback.bestepoch[k] + 1,
+                        'weights': [weights[i] for i in callback.positions[k]],
+                        'predictions': predictions,
+                        'losses': callback.losses[:, k],
+                        'val_losses': callback.val_losses[:, k],
+                        'aucs': callback.aucs[:, k]})
+    return results
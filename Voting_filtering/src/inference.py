@@ -0,0 +1,174 @@
+'''
+Forward pass of trained get_model networks (see NN.py) in pure numpy, for scoring without TensorFlow.
+Weights are taken from Model.get_weights() (e.g. 'weights' of train_folds results), from Keras HDF5 files
+(Model.save, Model.save_weights, fname_bestmodel of LossMetricHistory) or from .npz files written by export.
+Dropout is not applied (inference mode), batch normalizations use their moving statistics.
+'''
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+BN_EPSILON = 1e-3  # Default epsilon of Keras BatchNormalization (used by get_model)
+POOL_SIZE = (2, 4)  # Pool size of both MaxPooling2D layers of get_model
+
+
+def read_keras_weights(fname):
+    '''
+    Reads weights from HDF5 file of Keras (whole model or weights only) without Keras
+    :return: list of numpy arrays in the order of Model.get_weights()
+    '''
+    import h5py
+    with h5py.File(fname, 'r') as f:
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+        weights = []
+        for layer_name in f.attrs['layer_names']:
+            group = f[_to_str(layer_name)]
+            for weight_name in group.attrs['weight_names']:
+                weights.append(np.asarray(group[_to_str(weight_name)]))
+    return weights
+
+
+def _to_str(name):
+    return name.decode('utf8') if isinstance(name, bytes) else name
+
+
+def fold_weights(weights):
+    '''
+    Converts weights of get_model to parameters of the numpy forward pass. Batch normalizations follow
+    ELU activations in get_model, so they can not be merged into convolution kernels: each of them is folded
+    into one per-channel scale and shift
+    :param weights: list of numpy arrays in the order of Model.get_weights()
+    :return: dict {name: numpy array}
+    '''
+    weights = [np.asarray(w, dtype=np.float32) for w in weights]
+    layers = []  # ('kernel', kernel, bias) or ('bn', gamma, beta, moving_mean, moving_variance)
+    i = 0
+    while i < len(weights):
+        if weights[i].ndim > 1:
+            layers.append(('kernel', weights[i], weights[i + 1]))
+            i += 2
+        else:
+            layers.append(('bn',) + tuple(weights[i:i + 4]))
+            i += 4
+    if [layer[0] for layer in layers] != ['kernel', 'bn'] * 3 + ['kernel'] or \
+            [layer[1].ndim for layer in layers[::2]] != [3, 4, 4, 2]:
+        raise ValueError('Weights do not match get_model architecture')
+
+    params = {}
+    for n, (_, kernel, bias) in enumerate(layers[::2]):
+        params['kernel%d' % n] = kernel
+        params['bias%d' % n] = bias
+    for n, (_, gamma, beta, mean, var) in enumerate(layers[1::2]):
+        scale = gamma / np.sqrt(var + BN_EPSILON)
+        params['scale%d' % n] = scale
+        params['shift%d' % n] = beta - mean * scale
+    return params
+
+
+def export(weights, fname):
+    '''
+    Saves parameters of the numpy forward pass to .npz file
+    :param weights: list of numpy arrays (Model.get_weights()) or name of Keras HDF5 file
+    :param fname: string, name of .npz file
+    '''
+    if isinstance(weights, str):
+        weights = read_keras_weights(weights)
+    np.savez(fname, **fold_weights(weights))
+
+
+def _elu(x):
+    return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+
+
+def _conv2d_same(x, kernel, bias):
+    '''
+    Conv2D of Keras (TensorFlow) with 'same' padding and channels_first data
+    :param x: 4d numpy array (Trials x Channels x Height x Width)
+    :param kernel: 4d numpy array (Height x Width x Input channels x Output channels)
+    :return: 4d numpy array (Trials x Output channels x Height x Width)
+    '''
+    kh, kw = kernel.shape[:2]
+    # TensorFlow puts the smaller half of 'same' padding before the data
+    x = np.pad(x, ((0, 0), (0, 0), ((kh - 1) // 2, kh // 2), ((kw - 1) // 2, kw // 2)), mode='constant')
+    n, c, h, w = x.shape
+    s = x.strides
+    windows = as_strided(x, shape=(n, c, h - kh + 1, w - kw + 1, kh, kw), strides=s + s[2:], writeable=False)
+    out = np.einsum('nchwij,ijco->nohw', windows, kernel, optimize=True)
+    out += bias[:, None, None]
+    return out
+
+
+def _bn_max_pool(x, scale, shift, pool_size=POOL_SIZE):
+    '''
+    Batch normalization (folded to scale and shift over axis 1) followed by MaxPooling2D ('valid', channels_first).
+    Pooling goes first: maximum of scale * x + shift is scale * max(x) + shift for positive scales
+    and scale * min(x) + shift for negative ones
+    '''
+    ph, pw = pool_size
+    n, c, h, w = x.shape
+    blocks = x[:, :, :h // ph * ph, :w // pw * pw].reshape(n, c, h // ph, ph, w // pw, pw)
+    pooled = blocks.max(axis=(3, 5))
+    negative = scale < 0
+    if negative.any():
+        pooled[:, negative] = blocks[:, negative].min(axis=(3, 5))
+    return pooled * scale[:, None, None] + shift[:, None, None]
+
+
+class NumpyModel(object):
+    '''
+    Trained get_model network for prediction in numpy:
+        model = NumpyModel.load('model.npz')  # or NumpyModel.from_keras_file('model.hdf5')
+        y_pred = model.predict(X)  # the same as keras_model.predict(X)
+    '''
+    def __init__(self, params):
+        '''
+        :param params: dict of parameters (see fold_weights)
+        '''
+        self.params = dict((name, np.asarray(value, dtype=np.float32)) for name, value in params.items())
+
+    @classmethod
+    def from_weights(cls, weights):
+        '''
+        :param weights: list of numpy arrays in the order of Model.get_weights()
+        '''
+        return cls(fold_weights(weights))
+
+    @classmethod
+    def from_keras_file(cls, fname):
+        return cls.from_weights(read_keras_weights(fname))
+
+    @classmethod
+    def load(cls, fname):
+        '''
+        :param fname: string, .npz file written by export
+        '''
+        with np.load(fname) as f:
+            return cls(dict(f.items()))
+
+    def _forward(self, X):
+        p = self.params
+        n, time_samples_num, _ = X.shape
+        # Conv1D with kernel size 1 is a matrix product over channels
+        x = _elu(np.dot(X, p['kernel0'][0]) + p['bias0'])
+        # Keras Reshape((1, num_of_filt, time_samples_num)) just reinterprets the memory
+        x = x.reshape(n, 1, -1, time_samples_num)
+        x = x * p['scale0'][:, None] + p['shift0'][:, None]
+        x = _elu(_conv2d_same(x, p['kernel1'], p['bias1']))
+        x = _bn_max_pool(x, p['scale1'], p['shift1'])
+        x = _elu(_conv2d_same(x, p['kernel2'], p['bias2']))
+        x = _bn_max_pool(x, p['scale2'], p['shift2'])
+        x = np.dot(x.reshape(n, -1), p['kernel3']) + p['bias3']
+        x = np.exp(x - x.max(axis=1, keepdims=True))
+        return x / x.sum(axis=1, keepdims=True)
+
+    def predict(self, X, batch_size=64):
+        '''
+        :param X: 3d numpy array (Trials x Time x Channels)
+        :param batch_size: int, number of trials in one pass (limits memory of convolutions)
+        :return: 2d numpy array (Trials x 2) of class probabilities
+        '''
+        X = np.asarray(X, dtype=np.float32)
+        if len(X) == 0:
+            return np.zeros((0, len(self.params['bias3'])), dtype=np.float32)
+        return np.concatenate([self._forward(X[start:start + batch_size])
+                               for start in range(0, len(X), batch_size)])
@@ -0,0 +1,61 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def schedule_subjects(subjects, prepare, jobs=None, finish=None, n_workers=None):
+    '''
+    Processes subjects in a pool of worker processes. For every subject prepare(subject) is run first
+    (e.g. cross-validation and data filtering). Then the independent jobs of the subject (e.g. training of noisy
+    and pure models) are run in parallel with each other and with other subjects.
+    Jobs of subjects, which are already started, go before the next subjects, so results come roughly in the
+    order of subjects. finish is called in the main process strictly in the order of subjects, as soon as a subject
+    and all the subjects before it are done, so rows written by it are in a deterministic order.
+    Workers are started with 'spawn': the functions should be defined at module level of an importable module
+    (or of the main script, which should be protected by if __name__ == '__main__'). Workers are daemonic
+    before Python 3.9 and can not start processes: jobs should train in their own process (train_folds with
+    n_jobs=1), the pool of subjects is the only level of parallelism
+    :param subjects: list of subject numbers
+    :param prepare: function(subject) -> state, stage 1 of a subject
+    :param jobs: dict {name: function(state) -> result}, stage 2 jobs of every subject
+    :param finish: function(subject, state, results), results is dict {name: result} of jobs
+    :param n_workers: int, number of worker processes (default: number of CPU cores)
+    :return: list of finish results (or of states if finish is None) in the order of subjects
+    '''
+    jobs = jobs or {}
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = max(min(n_workers, len(subjects) * max(len(jobs), 1)), 1)
+
+    waiting = list(range(len(subjects)))[::-1]  # Positions of subjects, which are not started yet (stack)
+    pending = {}  # Future -> (position of subject, job name or None for prepare)
+    states = {}
+    results = {}
+    done = [False] * len(subjects)
+    out = [None] * len(subjects)
+    next_out = 0
+    with ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        def start_subjects():
+            while waiting and len(pending) < n_workers:
+                pos = waiting.pop()
+                pending[executor.submit(prepare, subjects[pos])] = (pos, None)
+
+        start_subjects()
+        while pending:
+            finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in finished:
+                pos, name = pending.pop(future)
+                if name is None:
+                    states[pos] = future.result()
+                    results[pos] = {}
+                    for job_name, job in jobs.items():
+                        pending[executor.submit(job, states[pos])] = (pos, job_name)
+                else:
+                    results[pos][name] = future.result()
+                done[pos] = len(results[pos]) == len(jobs)
+            start_subjects()
+
+            while next_out < len(subjects) and done[next_out]:
+                state, res = states.pop(next_out), results.pop(next_out)
+                out[next_out] = state if finish is None else finish(subjects[next_out], state, res)
+                next_out += 1
+    return out
@@ -0,0 +1,69 @@
+'''
+Streaming of training and validation batches from a (memory-mapped) array of a subject. Batches are gathered
+by indices on the fly in background threads of Keras (fit_generator/predict_generator), so subsets of folds
+(X_tr, X_val) are never materialized and the data can be larger than RAM (e.g. arrays from the data cache).
+'''
+import numpy as np
+from keras.utils import Sequence, to_categorical
+
+
+class IndexSequence(Sequence):
+    '''
+    Batches of X[indices] (and one-hot labels y[indices]) in order of indices or in a new random order every epoch
+    '''
+    def __init__(self, X, indices, y=None, batch_size=64, shuffle=False, seed=None, num_classes=2):
+        '''
+        :param X: 3d numpy array or memory map (Trials x Time x Channels)
+        :param indices: 1d numpy array, indices of trials of X to serve
+        :param y: 1d numpy array of labels of all trials of X. None - batches contain only data (for prediction)
+        :param batch_size: int
+        :param shuffle: bool, shuffle indices before every epoch
+        :param seed: int, seed of shuffling
+        '''
+        self.X = X
+        self.indices = np.asarray(indices)
+        self.y = None if y is None else to_categorical(np.asarray(y), num_classes)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.order = self.indices
+        if shuffle:
+            self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / float(self.batch_size)))
+
+    def __getitem__(self, i):
+        batch = self.order[i * self.batch_size:(i + 1) * self.batch_size]
+        if self.shuffle:
+            # Order inside a training batch does not matter, sorted indices read a memory map sequentially
+            batch = np.sort(batch)
+        if self.y is None:
+            return self.X[batch]
+        return self.X[batch], self.y[batch]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.order = self.rng.permutation(self.indices)
+
+
+def fit_stream(model, X, y, indices, epochs, callbacks=None, batch_size=64, shuffle=True, seed=None, workers=2,
+               max_queue_size=10, verbose=0):
+    '''
+    model.fit on X[indices], y[indices] with batches assembled in parallel threads and prefetched
+    :param workers: int, number of threads assembling batches
+    :param max_queue_size: int, number of prefetched batches
+    :return: History of fit_generator
+    '''
+    sequence = IndexSequence(X, indices, y, batch_size=batch_size, shuffle=shuffle, seed=seed)
+    return model.fit_generator(sequence, epochs=epochs, callbacks=callbacks, workers=workers,
+                               use_multiprocessing=False, max_queue_size=max_queue_size, shuffle=False,
+                               verbose=verbose)
+
+
+def predict_stream(model, X, indices, batch_size=256, workers=2, max_queue_size=10):
+    '''
+    model.predict(X[indices]) without a copy of X[indices]
+    '''
+    return model.predict_generator(IndexSequence(X, indices, batch_size=batch_size), workers=workers,
+                                   use_multiprocessing=False, max_queue_size=max_queue_size)
@@ -1,12 +1,8 @@
-import matplotlib.pyplot as plt
 import pickle
 import operator
-from sklearn.model_selection import train_test_split
 import numpy as np
 import os
 import csv
-from sklearn.metrics import roc_curve, roc_auc_score
-from scipy.stats import wilcoxon
 
 # def loging(history,title):
 #     fig = plt.figure()
@@ -47,6 +43,7 @@ def single_auc_loging(history,title,path_to_save):
     :param path_to_save: Path to save file
     :return:
     """
+    import matplotlib.pyplot as plt
     f, (ax1, ax2) = plt.subplots(1, 2,figsize=(12,12))
 
     if 'loss' in history.keys():
@@ -81,6 +78,7 @@ def multi_auc_loging(history,title,val_subject_numbers,path_to_save):
     :param path_to_save: Path to save file
     :return:
     """
+    import matplotlib.pyplot as plt
     aucs = {}
     for subj in val_subject_numbers:
         f, (ax1, ax2) = plt.subplots(1, 2,figsize=(12,12))
@@ -116,6 +114,7 @@ def multisubj_val_split(subjects,val_split=0.2,random_state=42):
     :param subjects: dict {subj_number:(x,y)}
     :return: x_train, x_val, y_train, y_val
     """
+    from sklearn.model_selection import train_test_split
     tmp = []
     for subj in subjects.keys():
         tmp.append(train_test_split(subjects[subj][0], subjects[subj][1], test_size=val_split,
@@ -143,6 +142,7 @@ def remove_commas(fname):
         f.writelines(newlines)
 
 def plot_EEG(data, logdir, ind, timewin = (0.2,0.5)):
+    import matplotlib.pyplot as plt
     for sbj in data.keys():
         X, y = data[int(sbj)][0], data[int(sbj)][1]
         ind_T = np.arange(len(y))[y == 1]  # Indices of target class instances
@@ -185,6 +185,7 @@ def hist_deviations(fname, dir_hist, word='',threshold=None):
     :param threshold: optional, if not None - plotting a vertical line x = threshold
     :return: None
     '''
+    import matplotlib.pyplot as plt
     if not os.path.isdir(dir_hist):
         os.makedirs(dir_hist)
     if word != '':
@@ -229,6 +230,8 @@ def roc_curve_and_auc(fname_true, fname_pred, dir_auc, dir_roc, word=''):
     :param word: optional, str, additional word to name the resulting files. It will be added to the beginning of file name
     :return: None
     '''
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import roc_curve, roc_auc_score
     if not os.path.isdir(dir_auc):
         os.makedirs(dir_auc)
     if not os.path.isdir(dir_roc):
@@ -277,6 +280,7 @@ def roc_curve_and_auc(fname_true, fname_pred, dir_auc, dir_roc, word=''):
 
 
 def plot_auc(fname, dir_plots, word=''):
+    import matplotlib.pyplot as plt
     if not os.path.isdir(dir_plots):
         os.makedirs(dir_plots)
     if word != '':
@@ -312,6 +316,7 @@ def plot_auc(fname, dir_plots, word=''):
 
 
 def plot_losses(fname1, fname2, dir_plots):
+    import matplotlib.pyplot as plt
     if not os.path.isdir(dir_plots):
         os.makedirs(dir_plots)
 
@@ -349,6 +354,7 @@ def plot_losses(fname1, fname2, dir_plots):
 
 
 def plot_loss_auc(fname_auc, fname_loss, fname_tloss, dir_plots):
+    import matplotlib.pyplot as plt
     if not os.path.isdir(dir_plots):
         os.makedirs(dir_plots)
 
@@ -415,7 +421,42 @@ def plot_loss_auc(fname_auc, fname_loss, fname_tloss, dir_plots):
         ax2.cla()
         fig.clf()
 
+def fast_auc(y_true, y_score):
+    '''
+    ROC AUC computed from ranks (Mann-Whitney U statistic). Tied scores get their mean rank, so the result
+    is the same as of sklearn's roc_auc_score. Each prediction vector is sorted once, several vectors are scored
+    in one call
+    :param y_true: 1d numpy array of binary labels (0 and 1)
+    :param y_score: 1d numpy array of scores or 2d array (number of vectors x samples)
+    :return: float AUC for 1d y_score, 1d numpy array of AUCs for 2d
+    '''
+    y_true = np.asarray(y_true).ravel() == 1
+    scores = np.atleast_2d(y_score)
+    n_vectors, n = scores.shape
+    n_pos = y_true.sum()
+    n_neg = n - n_pos
+    if n_pos == 0 or n_neg == 0:
+        raise ValueError('Only one class present in y_true. ROC AUC score is not defined in that case.')
+
+    order = np.argsort(scores, axis=1, kind='mergesort')
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+    # Groups of tied scores in all the rows at once (every row starts a new group)
+    new_group = np.ones((n_vectors, n), dtype=bool)
+    new_group[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    new_group = new_group.ravel()
+    starts = np.flatnonzero(new_group)
+    sizes = np.diff(np.append(starts, n_vectors * n))
+    midranks = starts % n + (sizes + 1) / 2.  # Mean of ranks (counted from 1) of a group
+    ranks = midranks[np.cumsum(new_group) - 1].reshape(n_vectors, n)
+
+    pos_rank_sum = (ranks * y_true[order]).sum(axis=1)
+    aucs = (pos_rank_sum - n_pos * (n_pos + 1) / 2.) / (n_pos * n_neg)
+    if np.ndim(y_score) == 1:
+        return aucs[0]
+    return aucs
+
 def ensemble(predictions_list, y_true, fname_preds, fname_dev, fname_auc):
+    from sklearn.metrics import roc_auc_score
     y_pred = reduce(lambda a, b: np.hstack((a,b)), predictions_list)
     y_pred = np.mean(y_pred, axis=1)
     with open(fname_preds, 'a') as fout:
@@ -428,6 +469,58 @@ def ensemble(predictions_list, y_true, fname_preds, fname_dev, fname_auc):
     with open(fname_auc, 'a') as fout:
         fout.write('%s,'%auc)
 
+def _mean_and_pvalue(aucs):
+    from scipy.stats import wilcoxon
+    pval = []
+    for i in range(1,aucs.shape[1]):
+        pval.append(wilcoxon(aucs[:,0], aucs[:,i])[1])
+    return aucs.mean(0), aucs.std(0), pval
+
+
+def mean_and_pvalue_by(fname, column):
+    """
+    mean_and_pvalue for a csv file with rows of several runs (e.g. of several filtration rates), separately
+    for every value of column. Lines with a different number of fields (e.g. appended summaries) are skipped
+    :param column: string, name of the column in the header (it is not included in the statistics)
+    :return: list of tuples (value, (mean[n], std[n], pvalue[n-1])) in order of first appearance of values
+    """
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    header = [name.strip() for name in lines[0].split(',')]
+    col = header.index(column)
+    groups = {}
+    order = []
+    for line in lines[1:]:
+        fields = line.split(',')
+        if len(fields) != len(header):
+            continue
+        value = fields[col]
+        if value not in groups:
+            groups[value] = []
+            order.append(value)
+        groups[value].append([float(field) for j, field in enumerate(fields) if j not in (0, col)])
+    return [(value, _mean_and_pvalue(np.array(groups[value]))) for value in order]
+
+
+def _read_aucs(fname, column='filt_rate'):
+    """
+    Numeric columns of a csv file of one run for mean_and_pvalue: the first (subject) column and column
+    (if it is in the header) are dropped. Lines with a different number of fields (e.g. appended summaries)
+    are skipped
+    """
+    with open(fname) as f:
+        lines = f.read().splitlines()
+    header = [name.strip() for name in lines[0].split(',')]
+    rows = [line.split(',') for line in lines[1:] if len(line.split(',')) == len(header)]
+    if column in header:
+        col = header.index(column)
+        if len(set(fields[col] for fields in rows)) > 1:
+            raise ValueError('%s has rows of several values of %s, use mean_and_pvalue_by' % (fname, column))
+    else:
+        col = None
+    return np.array([[float(field) for j, field in enumerate(fields) if j not in (0, col)] for fields in rows])
+
+
 def mean_and_pvalue(file1, file2=None):
     """
     For auc files compute mean, std of aucs (over subjects) for both files and do the Wilcoxon signed-rank test.
@@ -437,21 +530,21 @@ def mean_and_pvalue(file1, file2=None):
                                 sbj2, auc2_1, auc2_2, ..., auc2_n
                                 ...
                                 sbjm, aucm_1, aucm_2, ..., aucm_n
+                  A filt_rate column of a run with one filtration rate is skipped (see mean_and_pvalue_by
+                  for several rates)
     :param file2: csv file with auc scores of an algorithm to compare with (in the same format as file1)
                 if None than just mean, std offile1 columns and p-values of Wilcoxon signed-rank test of all
                 the columns of file1 comparing to auc*_1 column
     :return: tuple of 3 numpy.ndarray pvalue[n], mean1[n], std1[n], mean2[n], std2[n]
             or mean[n], std[n] if file2 is None
     """
-    aucs1 = np.loadtxt(file1, delimiter=',', skiprows=1)[:,1:]
+    from scipy.stats import wilcoxon
+    aucs1 = _read_aucs(file1)
 
     if not file2:
-        pval = []
-        for i in range(1,aucs1.shape[1]):
-            pval.append(wilcoxon(aucs1[:,0], aucs1[:,i])[1])
-        return aucs1.mean(0), aucs1.std(0), pval
+        return _mean_and_pvalue(aucs1)
 
-    aucs2 = np.loadtxt(file2, delimiter=',', skiprows=1)[:,1:]
+    aucs2 = _read_aucs(file2)
 
     assert aucs1.shape[1] == aucs2.shape[1],\
             "Auc files are incompatible"
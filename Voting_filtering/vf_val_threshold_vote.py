@@ -1,22 +1,27 @@
 from src.data import DataBuildClassifier
-from src.NN import get_model
+from src.NN import ModelFactory, get_stacked_model
 from src.callbacks import LossMetricHistory
+from src.folds import train_folds_stacked
 from sklearn.model_selection import train_test_split, StratifiedKFold
 import numpy as np
 from keras.utils import to_categorical
-from keras.models import load_model
+from functools import partial
 from sklearn.metrics import roc_auc_score
 import os
 import matplotlib.pyplot as plt
 
 # Noise rate - float from 0 to 0.5 indicating proportion of data to be removed
 noise_rate = 0.1
+# A sample is noisy if mean predicted probability of its label over shufflings is not above the threshold
+prob_threshold = 0.5
 # Data import and making train, test and validation sets
 sbjs = [33, 34]  # [25,26,27,28,29,30,32,33,34,35,36,37,38]
 path_to_data = '/home/likan_blk/BCI/NewData/'  # os.path.join(os.pardir,'sample_data')
-data = DataBuildClassifier(path_to_data).get_data(sbjs, shuffle=False,
-                                                  windows=[(0.2, 0.5)],
-                                                  baseline_window=(0.2, 0.3))
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'data_cache')
+data = DataBuildClassifier(path_to_data, cache_dir=cache_dir).get_data(sbjs, shuffle=False,
+                                                                       windows=[(0.2, 0.5)],
+                                                                       baseline_window=(0.2, 0.3),
+                                                                       lazy=True, max_memory=0, n_jobs=-1)
 # Some files for logging
 logdir = os.path.join(os.getcwd(), 'logs', 'vf_val_thres_vote')
 if not os.path.isdir(logdir):
@@ -27,8 +32,15 @@ with open(fname, 'w') as fout:
 
 
 epochs = 50
+# Early stopping: no improvement of validation AUC for patience epochs (but not before min_epochs),
+# scaled down from 30 and 40 of the scripts with 150 epochs
+patience = 10
+min_epochs = 15
 dropouts = (0.2, 0.4, 0.6)
 n_shufflings = 5  # number of different splits on train and val (in cross-validation)
+factory = ModelFactory(dropouts) # The model is built once and reset for every training
+# Towers of the stacked model: folds of all the shufflings but the last one
+stacked_factory = ModelFactory(dropouts, build=partial(get_stacked_model, n_towers=4*(n_shufflings-1)))
 
 # Iterate over subjects and clean label noise for all of them
 for sbj in sbjs:
@@ -39,50 +51,51 @@ for sbj in sbjs:
                                            random_state=108)
     X_train, y_train, X_test, y_test = X[train_ind], y[train_ind], X[test_ind], y[test_ind]
 
-    mistakes = []  # Array of indices of samples, for which prediction is wrong
+    time_samples_num = X_train.shape[1]
+    channels_num = X_train.shape[2]
+
+    # Folds of all the shufflings but the last one are trained together, as towers of one stacked model.
+    # Their predictions are used for votes only: a stacked epoch takes more steps than an epoch of get_model
+    # and batch normalizations of a tower see its validation samples, so their best epochs are biased
+    folds = []
     for i in range(n_shufflings):
         cv = StratifiedKFold(n_splits=4, shuffle=True, random_state=i*2+1)
-        val_inds = []
-        fold_pairs = []
-        for tr_ind, val_ind in cv.split(X_train, y_train):
-            X_tr, X_val = X_train[tr_ind], X_train[val_ind]
-            y_tr, y_val = y_train[tr_ind], y_train[val_ind]
-            fold_pairs.append((X_tr, y_tr, X_val, y_val))
-            val_inds.append(train_ind[val_ind])  # indices of all the validation instances in the initial X array
-
-        # Getting and training models with cross-validation
-        i = 0
-        pure_ind = []
-        bestepochs = np.array([])
-        time_samples_num = X_train.shape[1]
-        channels_num = X_train.shape[2]
-
-        for fold in fold_pairs:
-            X_tr, y_tr, X_val, y_val = fold[0], to_categorical(fold[1]), fold[2], to_categorical(fold[3])
-            model, _ = get_model(time_samples_num, channels_num, dropouts=dropouts)
-            callback = LossMetricHistory(n_iter=epochs,verbose=1,
-                                         fname_bestmodel=os.path.join(logdir,"model%s.hdf5"%(i)))
-            hist = model.fit(X_tr, y_tr, epochs=epochs,
-                             validation_data=(X_val, y_val), callbacks=[callback],
-                             batch_size=64, shuffle=True)
-            bestepochs = np.append(bestepochs, callback.bestepoch+1)
+        folds += list(cv.split(X_train, y_train))
+    model_seed = 0 # Seed of initial weights of the next model
+    fold_results = []
+    if n_shufflings > 1:
+        model = stacked_factory.get_model(time_samples_num, channels_num, seed=model_seed)
+        model_seed += 1
+        fold_results = train_folds_stacked(X_train, y_train, folds[:-4], epochs, model=model, batch_size=64,
+                                           shuffle=True, verbose=1, patience=patience, min_epochs=min_epochs)
+    # Folds of the last shuffling are trained one by one as get_model: they give votes and the number of epochs
+    for tr_ind, val_ind in folds[-4:]:
+        model = factory.get_model(time_samples_num, channels_num, seed=model_seed)
+        model_seed += 1
+        x_val, y_val = X_train[val_ind], to_categorical(y_train[val_ind], 2)
+        callback = LossMetricHistory(n_iter=epochs, verbose=1, restore_best=True, lean=True,
+                                     validation_data=(x_val, y_val), patience=patience, min_epochs=min_epochs)
+        model.fit(X_train[tr_ind], to_categorical(y_train[tr_ind], 2), epochs=epochs, callbacks=[callback],
+                  batch_size=64, shuffle=True)
+        fold_results.append({'bestepoch': callback.bestepoch + 1, 'predictions': {'val': model.predict(x_val)}})
 
-            # Validation and data cleaning
-            model = load_model(os.path.join(logdir, "model%s.hdf5" % (i)))
-            y_pred = model.predict(X_val)[:,1]
-            # Indices of noisy samples
-            mistakes += list(val_inds[i][np.abs(y_val[:,1] - y_pred) >= 0.5])
-            i += 1
-        bestepoch=int(round(bestepochs.mean()))
+    # Votes for every sample of train_ind: number of wrong predictions (from 0 to n_shufflings)
+    # and sum of predicted probabilities of its label over shufflings
+    mistakes = np.zeros(len(train_ind), dtype=np.int32)
+    prob_sums = np.zeros(len(train_ind))
+    for (tr_ind, val_ind), result in zip(folds, fold_results):
+        # Validation and data cleaning (validation indices of one split are unique)
+        y_pred = result['predictions']['val'][:,1]
+        mistakes[val_ind] += np.abs(y_train[val_ind] - y_pred) >= 0.5
+        prob_sums[val_ind] += np.where(y_train[val_ind] == 1, y_pred, 1 - y_pred)
+    # Number of epochs for final models: mean best epoch of the folds of the last shuffling (get_model)
+    bestepoch = int(round(np.mean([result['bestepoch'] for result in fold_results[-4:]])))
 
     # Removing instances with noisy labels
-    pure_ind = []  # Indices of non-noisy samples (according to majority vote)
-    mistakes_per_sample = []  # Array of numbers of mistakes per each sample (from 0 to n_shufflings)
-    for i in train_ind:
-        c = mistakes.count(i)
-        mistakes_per_sample.append(c)
-        if c < n_shufflings/2.:
-            pure_ind.append(i)
+    mean_prob = prob_sums / n_shufflings  # Every sample is validated once in every shuffling
+    pure_ind = train_ind[mean_prob > prob_threshold]  # Indices of non-noisy samples (according to threshold vote)
+    np.savez(os.path.join(logdir, str(sbj)+'_votes.npz'), train_ind=train_ind, mistakes=mistakes,
+             mean_prob=mean_prob)
     X_train_pure = X[pure_ind]
     y_train_pure = y[pure_ind]
 
@@ -90,7 +103,7 @@ for sbj in sbjs:
     plt.title('Number of mistakes per sample histogram for %s subject'%(sbj))
     plt.xlabel('number of mistakes')
     plt.ylabel('number of samples')
-    plt.hist(mistakes_per_sample, bins=n_shufflings+1, rwidth=0.8, color='indigo')
+    plt.hist(mistakes, bins=n_shufflings+1, rwidth=0.8, color='indigo')
     plt.savefig(os.path.join(logdir, str(sbj)+'mistakes_hist.png'))
 
     # Testing and comparison of cleaned and noisy data
@@ -99,7 +112,8 @@ for sbj in sbjs:
     y_train = to_categorical(y_train)
     y_train_pure = to_categorical(y_train_pure)
 
-    model_noisy, _ = get_model(time_samples_num, channels_num, dropouts=dropouts)
+    model_noisy = factory.get_model(time_samples_num, channels_num, seed=model_seed)
+    model_seed += 1
     model_noisy.fit(X_train, y_train, epochs=bestepoch,
                     batch_size=64, shuffle=True)
 
@@ -107,7 +121,8 @@ for sbj in sbjs:
     y_pred_noisy = y_pred_noisy[:, 1]
     auc_noisy = roc_auc_score(y_test, y_pred_noisy)
 
-    model_pure, _ = get_model(time_samples_num, channels_num, dropouts=dropouts)
+    model_pure = factory.get_model(time_samples_num, channels_num, seed=model_seed)
+    model_seed += 1
     model_pure.fit(X_train, y_train, epochs=bestepoch,
                    batch_size=64, shuffle=True)
     y_pred_pure = model_pure.predict(X_test)
@@ -1,12 +1,142 @@
 from __future__ import print_function
-from scipy.io import loadmat
 import os
+import json
+import random
+import shutil
+import hashlib
+import tempfile
+import threading
+import multiprocessing
 import numpy as np
 import pickle
-from random import shuffle,seed
+from fractions import Fraction
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 #from StringIO import StringIO
 #from scipy.signal import resample
-from mne.filter import resample
+# scipy.io, scipy.signal and mne are imported where they are needed: importing them takes longer
+# than loading of a cached subject
+
+_CACHE_VERSION = 3  # Bump when preprocessing changes, so old cache entries are not reused
+_RESAMPLE_PAD = 0.1  # Seconds of data on both sides of a window, used for window-aware resampling of it
+_resample_matrices = {}  # Cache of _fft_resample_matrix and _polyphase_matrix results
+_polyphase_filters = {}  # Cache of _polyphase_filter results
+_STORE_H5 = 'eeg.h5'  # Chunked store of a subject, written by DataBuildClassifier.ingest
+_STORE_NPY = 'eeg_npy'  # Folder with .npy store of a subject (if h5py is not available)
+
+
+def _import_h5py():
+    '''
+    h5py is optional: it is needed only for the HDF5 store and for MATLAB v7.3 files
+    :return: h5py module or None if it is not installed
+    '''
+    try:
+        import h5py
+    except ImportError:
+        return None
+    return h5py
+
+
+def _fft_resample_grid(x_len, ratio):
+    '''
+    Time grid of mne.filter.resample(x, up=ratio, npad='auto') with FFT method. Replicates padding arithmetic
+    of mne, which shifts the output grid by a fraction of a sample
+    :param x_len: int, number of input samples
+    :param ratio: float, output sample rate / input sample rate
+    :return: tuple: positions of output samples (in input samples) and cutoff frequency (in cycles per input sample)
+    '''
+    min_add = min(x_len // 8, 100) * 2
+    npad = 2 ** int(np.ceil(np.log2(x_len + min_add))) - x_len
+    npad_start = npad // 2
+    padded_len = x_len + npad
+    new_len = max(int(round(ratio * padded_len)), 1)
+    final_len = max(int(round(ratio * x_len)), 1)
+    to_remove = int(round(ratio * npad_start))
+    positions = (np.arange(final_len) + to_remove) * float(padded_len) / new_len - npad_start
+    return positions, min(new_len, padded_len) / 2. / padded_len
+
+
+def _fft_resample_matrix(x_len, ratio, start, end, pad):
+    '''
+    Linear map from input samples around output samples start:end to these output samples of FFT resampling.
+    The input span is extended symmetrically (so its periodic extension is continuous) and interpolated with
+    the band limited (Dirichlet) kernel of the FFT filter. Far from the epoch edges result agrees with
+    resampling of the whole epoch up to the ringing, which mne gets from its own padding
+    :param x_len: int, number of input samples in the whole epoch
+    :param ratio: float, output sample rate / input sample rate
+    :param start: int, first output sample
+    :param end: int, output sample after the last one
+    :param pad: int, number of extra input samples on both sides
+    :return: tuple: first input sample of the span and matrix (Span samples x Output samples)
+    '''
+    key = (x_len, ratio, start, end, pad)
+    if key not in _resample_matrices:
+        positions, cutoff = _fft_resample_grid(x_len, ratio)
+        positions = positions[start:end]
+        span_start = max(int(np.floor(positions[0])) - pad, 0)
+        span_end = min(int(np.ceil(positions[-1])) + 1 + pad, x_len)
+        span_len = span_end - span_start
+        period = 2 * (span_len - 1)
+        n_freqs = int(np.ceil(cutoff * period))  # Frequencies 0..n_freqs-1 (in cycles per period) are kept
+        dist = (positions - span_start)[:, np.newaxis] - np.arange(period)
+        sin_dist = np.sin(np.pi * dist / period)
+        singular = np.abs(sin_dist) < 1e-12
+        kernel = np.sin(np.pi * (2 * n_freqs - 1) * dist / period) / np.where(singular, 1., sin_dist)
+        kernel = np.where(singular, 2 * n_freqs - 1, kernel) / period
+        mirrored = np.concatenate((np.arange(span_len), np.arange(span_len - 2, 0, -1)))
+        matrix = np.zeros((span_len, len(positions)))
+        np.add.at(matrix, mirrored, kernel.T)
+        _resample_matrices[key] = (span_start, matrix)
+    return _resample_matrices[key]
+
+
+def _polyphase_filter(sample_rate, resample_to):
+    '''
+    Rational resampling factors and low-pass FIR filter for resampling from sample_rate to resample_to.
+    The filter is designed as in scipy.signal.resample_poly and cached for every pair of rates
+    :return: tuple: up, down (ints, resample_to / sample_rate = up / down) and filter taps
+    '''
+    key = (sample_rate, resample_to)
+    if key not in _polyphase_filters:
+        from scipy.signal import firwin
+        ratio = Fraction(resample_to).limit_denominator(1000) / Fraction(sample_rate).limit_denominator(1000)
+        up, down = ratio.numerator, ratio.denominator
+        max_rate = max(up, down)
+        taps = firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+        _polyphase_filters[key] = (up, down, taps)
+    return _polyphase_filters[key]
+
+
+def _polyphase_matrix(sample_rate, resample_to, x_len, start, end):
+    '''
+    Linear map from input samples to output samples start:end of
+    scipy.signal.resample_poly(x, up, down, window=taps) with the filter of _polyphase_filter.
+    Only the input samples within the filter reach of these outputs are used, so the result is exactly
+    the same as for resampling of the whole epoch
+    :param x_len: int, number of input samples in the whole epoch
+    :param start: int, first output sample
+    :param end: int, output sample after the last one
+    :return: tuple: first input sample of the span and matrix (Span samples x Output samples)
+    '''
+    key = ('polyphase', sample_rate, resample_to, x_len, start, end)
+    if key not in _resample_matrices:
+        up, down, taps = _polyphase_filter(sample_rate, resample_to)
+        half_len = (len(taps) - 1) // 2
+        outputs = np.arange(start, end)
+        span_start = max(-((half_len - start * down) // up), 0)  # ceil((start*down - half_len) / up)
+        span_end = min((outputs[-1] * down + half_len) // up + 1, x_len)
+        # Index of the tap, which connects input sample n with output sample k
+        tap_ind = outputs * down + half_len - np.arange(span_start, span_end)[:, np.newaxis] * up
+        valid = (tap_ind >= 0) & (tap_ind < len(taps))
+        matrix = np.where(valid, taps[np.clip(tap_ind, 0, len(taps) - 1)], 0.) * up
+        _resample_matrices[key] = (span_start, matrix)
+    return _resample_matrices[key]
+
 
 def to_onehot(labels):
     unique_labels = list(set(labels))
@@ -15,23 +145,108 @@ def to_onehot(labels):
     y[range(len(labels)),corrected_labels] = 1
     return y
 
-def data_shuffle(x, y,subj_indices=None):
-    seed(1)
-    d_len = len(y)
-    sh_data = range(d_len)
-    shuffle(sh_data)
-    new_y = np.zeros_like(y)
-    for i in range(d_len):
-        new_y[i,...] = y[sh_data[i],...]
-    new_x = np.zeros(x.shape)
-    for i in range(d_len):
-        new_x[i,...] = x[sh_data[i],...]
-    if subj_indices is not None:
-        new_subj_indices=np.zeros_like(subj_indices)
-        for i in range(d_len):
-            new_subj_indices[i, ...] = subj_indices[sh_data[i], ...]
-        return new_x, new_y,subj_indices
-    return new_x,new_y
+def data_shuffle(x, y, subj_indices=None, random_state=1, inplace=False):
+    '''
+    Shuffles trials with the permutation of the original data_shuffle: random.shuffle of range(len(y)) seeded
+    with random_state, but from its own random.Random (global random state is neither used nor changed)
+    :param random_state: int or None, seed of the permutation
+    :param inplace: bool, write the permuted data back into the given arrays instead of returning permuted copies
+    :return: x, y and subj_indices (if it is given) permuted in the same way
+    '''
+    perm = list(range(len(y)))
+    random.Random(random_state).shuffle(perm)
+    perm = np.array(perm, dtype=np.intp)
+    arrays = (x, y) if subj_indices is None else (x, y, subj_indices)
+    if inplace:
+        for a in arrays:
+            buf = np.empty_like(a)
+            np.take(a, perm, axis=0, out=buf)
+            a[...] = buf
+        return arrays
+    return tuple(np.take(a, perm, axis=0) for a in arrays)
+
+
+class LazySubjectData(Mapping):
+    '''
+    Read-only {subject: (X, y)} mapping, which loads data of a subject on first access.
+    When a subject is accessed, the next one (in order of the subjects list) is loaded in a background
+    thread. Loaded subjects are evicted, least recently used first, when their total size exceeds max_memory
+    (the subject accessed last is always kept).
+    '''
+    def __init__(self, loader, subjects, prefetch=True, max_memory=None):
+        '''
+        :param loader: callable, subject -> tuple (X, y)
+        :param subjects: list of subject's numbers
+        :param prefetch: bool, whether to load the next subject in background
+        :param max_memory: int, memory cap in bytes for loaded subjects. None means no limit
+        '''
+        self._loader = loader
+        self._subjects = list(subjects)
+        self.max_memory = max_memory
+        self._loaded = OrderedDict()
+        self._pending = {}  # Subject: future of its loading in background
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def __len__(self):
+        return len(self._subjects)
+
+    def __iter__(self):
+        return iter(self._subjects)
+
+    def __contains__(self, subject):
+        return subject in self._subjects
+
+    def __getitem__(self, subject):
+        if subject not in self._subjects:
+            raise KeyError(subject)
+        with self._lock:
+            item = self._loaded.pop(subject, None)
+            future = self._pending.pop(subject, None)
+            if item is not None:
+                self._loaded[subject] = item  # Move to the end, i.e. mark as recently used
+        if item is None:
+            item = future.result() if future is not None else self._loader(subject)
+            self._store(subject, item)
+        self._prefetch(subject)
+        return item
+
+    def _store(self, subject, item):
+        with self._lock:
+            self._loaded[subject] = item
+            if self.max_memory is None:
+                return
+            nbytes = sum(X.nbytes + y.nbytes for X, y in self._loaded.values())
+            while nbytes > self.max_memory and len(self._loaded) > 1:
+                _, (X, y) = self._loaded.popitem(last=False)
+                nbytes -= X.nbytes + y.nbytes
+
+    def _prefetch(self, subject):
+        if self._executor is None:
+            return
+        next_ind = self._subjects.index(subject) + 1
+        if next_ind == len(self._subjects):
+            return
+        next_subject = self._subjects[next_ind]
+        with self._lock:
+            if next_subject not in self._loaded and next_subject not in self._pending:
+                self._pending[next_subject] = self._executor.submit(self._loader, next_subject)
+
+
+class _MatlabDataset(object):
+    '''
+    Trial-major view (Trials x Time x Channels) of a (Time x Channels x Trials) array in a MATLAB v7.3 file,
+    which h5py sees with reversed axes (Trials x Channels x Time). Supports slicing by 3 slices,
+    only the requested part is read from the file
+    '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = (dataset.shape[0], dataset.shape[2], dataset.shape[1])
+
+    def __getitem__(self, key):
+        trials, time, channels = key
+        return self.dataset[trials, channels, time].transpose(0, 2, 1)
+
 
 class Data(object):
     def __init__(self,path_to_data,start_epoch,end_epoch,sample_rate=500):
@@ -65,67 +280,398 @@ class Data(object):
 #             return data_shuffle(data[indexes,start_window_ind:end_window_ind,:],labels)
 #         return data[indexes,start_window_ind:end_window_ind,:],labels
 
+def _load_subject_job(data,subject,windows,baseline_window,resample_to,dtype,out_dir):
+    '''
+    Loads a subject in a worker process of DataBuildClassifier.get_data(n_jobs>1).
+    Arrays are not sent back through a pipe: they are written to the cache of data (if it has one)
+    or to .npy files in out_dir, which the parent process then reads
+    :return: None if data has a cache, otherwise tuple of file names of X and y
+    '''
+    if data.cache_dir is not None:
+        data._get_subject(subject,windows,baseline_window,resample_to,dtype)
+        return None
+    X,y = data._load_subject(subject,windows,baseline_window,resample_to,dtype)
+    fnames = (os.path.join(out_dir,'%s_X.npy' %subject), os.path.join(out_dir,'%s_y.npy' %subject))
+    np.save(fnames[0],X)
+    np.save(fnames[1],y)
+    return fnames
+
+
 class DataBuildClassifier(Data):
-    def __init__(self,path_to_data):
+    def __init__(self,path_to_data,cache_dir=None,resample_method='mne'):
         '''
         :param path_to_data: string, path to folder with all experiments
+        :param cache_dir: string, optional folder for preprocessed data. If given, get_data stores
+                          (X, y) of every subject there as .npy files and maps them back on the next call
+        :param resample_method: 'mne' - mne.filter.resample of whole epochs, then windowing (the original
+                                preprocessing, all results of the repo were obtained with it),
+                                'polyphase' - polyphase FIR filter with rational up/down factors (as in
+                                scipy.signal.resample_poly), applied only to the data around the requested windows,
+                                'fft' - FFT resampling of the requested windows only (with _RESAMPLE_PAD seconds
+                                of data around them; without windows mne is used for whole epochs).
+                                'polyphase' and 'fft' are much faster, but not identical to 'mne': the samples
+                                are filtered differently and may be shifted in time by a fraction of a sample
+                                (resample_to/sample_rate is not an integer), so models trained on data of
+                                different methods are not comparable
         '''
+        if resample_method not in ('polyphase','fft','mne'):
+            raise ValueError('Unknown resample_method %s' %resample_method)
         start_epoch = -0.5 #seconds
         end_epoch = 1#seconds
         super(DataBuildClassifier, self).__init__( path_to_data,start_epoch,end_epoch)
         # Data.__init__(self, path_to_data,start_epoch,end_epoch)
+        self.cache_dir = cache_dir
+        self.resample_method = resample_method
 
-    def _baseline_normalization(self,X,baseline_window=()):
-        bl_start = int((baseline_window[0] - self.start_epoch) * self.sample_rate)
-        bl_end = int((baseline_window[1] - self.start_epoch) * self.sample_rate)
+    def _baseline_normalization(self,X,baseline_window=(),offset=0):
+        '''
+        :param offset: int, sample of the epoch, which is the first time sample of X
+        '''
+        bl_start = int((baseline_window[0] - self.start_epoch) * self.sample_rate) - offset
+        bl_end = int((baseline_window[1] - self.start_epoch) * self.sample_rate) - offset
 
         return X[:,bl_start:bl_end,:].mean(axis=1)
 
     def _resample(self, X, y, resample_to):
-        self.sample_rate = resample_to
+        if self.resample_method == 'polyphase':
+            from scipy.signal import resample_poly
+            up, down, taps = _polyphase_filter(self.sample_rate, resample_to)
+            return resample_poly(X, up, down, axis=1, window=taps).astype(X.dtype,copy=False), y
         duration = self.end_epoch - self.start_epoch
         downsample_factor = X.shape[1] / (resample_to * duration)
-        return resample(X, up=1., down=downsample_factor, npad='auto', axis=1), y
+        from mne.filter import resample
+        # mne filters only float64 data
+        X_resampled = resample(X.astype(np.float64,copy=False), up=1., down=downsample_factor, npad='auto', axis=1)
+        return X_resampled.astype(X.dtype,copy=False), y
 
-    def get_data(self,subjects,shuffle=True,windows=None,baseline_window=(),resample_to=None):
+    def _window_indices(self,windows,sample_rate):
+        '''
+        :return: list of tuples (start, end) of windows in samples
         '''
+        return [(int((win_start - self.start_epoch)*sample_rate), int((win_end - self.start_epoch)*sample_rate))
+                for win_start,win_end in windows]
 
-        :param subjects: list subject's numbers, wich data we want to load
-        :param shuffle: bool
-        :param windows: list of tuples. Each tuple contains two floats - start and end of window in seconds
-        :param baseline_window: tuple of start time and end time of a baseline
-        :param resample_to: int, new sample rate
-        :return: Dict. {Subject_number:tuple of 2 numpy arrays: data (Trials x Time x Channels) and labels}
+    def _resample_plan(self,x_len,resample_to,windows):
         '''
-        res={}
-        for subject in subjects:
+        Resampling matrices of windows (see _polyphase_matrix and _fft_resample_matrix).
+        Window indices are computed in the new sample rate, as in the case of resampling of whole epochs
+        :param x_len: int, number of samples in the whole epoch
+        :return: list of tuples (span_start, matrix), one per window
+        '''
+        if self.resample_method == 'polyphase':
+            up, down, _ = _polyphase_filter(self.sample_rate, resample_to)
+            final_len = -(-x_len * up // down)
+        else:
+            duration = self.end_epoch - self.start_epoch
+            ratio = resample_to * duration / x_len
+            final_len = max(int(round(ratio * x_len)), 1)
+            pad = int(np.ceil(_RESAMPLE_PAD*self.sample_rate))
+        plan = []
+        for start,end in self._window_indices(windows,resample_to):
+            end = min(end,final_len)
+            if self.resample_method == 'polyphase':
+                plan.append(_polyphase_matrix(self.sample_rate,resample_to,x_len,start,end))
+            else:
+                plan.append(_fft_resample_matrix(x_len,ratio,start,end,pad))
+        return plan
 
-            eegT = loadmat(os.path.join(self.path_to_data,str(subject),'eegT.mat'))['eegT']
-            eegNT = loadmat(os.path.join(self.path_to_data,str(subject),'eegNT.mat'))['eegNT']
-            X = np.concatenate((eegT,eegNT),axis=-1).transpose(2,0,1)
+    def _resample_windows(self,X,plan,offset=0):
+        '''
+        Resampling and time windowing in one step. Only the data around windows is resampled.
+        :param X: 3d numpy array (Trials x Time x Channels), the epochs starting from sample offset
+        :param plan: result of _resample_plan
+        :return: 3d numpy array (Trials x Window samples x Channels)
+        '''
+        out = np.empty((X.shape[0],sum(matrix.shape[1] for _,matrix in plan),X.shape[2]),dtype=X.dtype)
+        pos = 0
+        for span_start,matrix in plan:
+            span = X[:,span_start - offset:span_start - offset + matrix.shape[0],:]
+            np.matmul(matrix.T.astype(X.dtype),span,out=out[:,pos:pos + matrix.shape[1],:])
+            pos += matrix.shape[1]
+        return out
+
+    def _needed_range(self,x_len,windows=None,baseline_window=(),resample_to=None):
+        '''
+        Part of the epoch, which is used by preprocessing (baseline, windows and the data around them needed for
+        their resampling)
+        :param x_len: int, number of samples in the whole epoch
+        :return: tuple (start, end) in samples
+        '''
+        if windows is None or (resample_to is not None and self.resample_method == 'mne'):
+            return 0,x_len
+        if resample_to is None:
+            ranges = self._window_indices(windows,self.sample_rate)
+        else:
+            ranges = [(span_start,span_start + matrix.shape[0])
+                      for span_start,matrix in self._resample_plan(x_len,resample_to,windows)]
+        if len(baseline_window):
+            ranges += self._window_indices([baseline_window],self.sample_rate)
+        return max(min(start for start,_ in ranges),0), min(max(end for _,end in ranges),x_len)
+
+    def _assemble(self,eegT,eegNT,baseline_window=(),dtype=np.float32,start=0,end=None):
+        '''
+        Writes target and non-target trials into one preallocated C-contiguous buffer of dtype.
+        Baseline is computed and subtracted in the source precision while writing
+        :param eegT: 3d array-like (Trials x Time x Channels) of target trials (see _open_sources)
+        :param eegNT: 3d array-like (Trials x Time x Channels) of non-target trials
+        :param start: int, first sample of the epoch to read
+        :param end: int, sample after the last one to read (None - up to the end of the epoch)
+        :return: 3d numpy array (Trials x Time x Channels)
+        '''
+        if end is None:
+            end = eegT.shape[1]
+        n_target = eegT.shape[0]
+        X = np.empty((n_target + eegNT.shape[0],end - start,eegT.shape[2]),dtype=dtype)
+        for eeg,part in ((eegT,X[:n_target]),(eegNT,X[n_target:])):
+            eeg = np.asarray(eeg[:,start:end,:])
             if len(baseline_window):
-                baseline = self._baseline_normalization(X,baseline_window)
-                baseline = np.expand_dims(baseline,axis=1)
-                X = X - baseline
-            y = np.hstack((np.ones(eegT.shape[2]),np.zeros(eegNT.shape[2])))
+                baseline = self._baseline_normalization(eeg,baseline_window,start)[:,np.newaxis,:]
+                np.subtract(eeg,baseline,out=part,casting='same_kind')
+            else:
+                part[...] = eeg
+        return X
+
+    @staticmethod
+    def _cut_windows(X,indices,offset=0):
+        '''
+        Copies time windows (given as slices) of X into one C-contiguous array
+        :param indices: list of tuples (start, end) of windows in samples
+        :param offset: int, sample of the epoch, which is the first time sample of X
+        '''
+        indices = [(start - offset,min(end - offset,X.shape[1])) for start,end in indices]
+        out = np.empty((X.shape[0],sum(end - start for start,end in indices),X.shape[2]),dtype=X.dtype)
+        pos = 0
+        for start,end in indices:
+            out[:,pos:pos + end - start,:] = X[:,start:end,:]
+            pos += end - start
+        return out
+
+    def _source_files(self,subject,store=True):
+        '''
+        Files, which data of a subject is read from: the store written by ingest (if there is one and store is True),
+        otherwise eegT.mat and eegNT.mat
+        '''
+        subject_dir = os.path.join(self.path_to_data,str(subject))
+        if store:
+            fname = os.path.join(subject_dir,_STORE_H5)
+            if os.path.isfile(fname) and _import_h5py() is not None:
+                return [fname]
+            fnames = [os.path.join(subject_dir,_STORE_NPY,'%s.npy' %name) for name in ('eegT','eegNT')]
+            if all(os.path.isfile(fname) for fname in fnames):
+                return fnames
+        return [os.path.join(subject_dir,'%s.mat' %name) for name in ('eegT','eegNT')]
+
+    @contextmanager
+    def _open_sources(self,subject,store=True):
+        '''
+        Opens target and non-target trials of a subject for reading (see _source_files).
+        Yields tuple of 2 array-likes (Trials x Time x Channels). Slicing of them reads only the requested part
+        from the store and from MATLAB v7.3 files; MATLAB v5 files are always read whole
+        '''
+        fnames = self._source_files(subject,store)
+        files = []
+        try:
+            if fnames[0].endswith('.h5'):
+                files.append(_import_h5py().File(fnames[0],'r'))
+                yield files[0]['eegT'], files[0]['eegNT']
+            elif fnames[0].endswith('.npy'):
+                yield tuple(np.load(fname,mmap_mode='r') for fname in fnames)
+            else:
+                from scipy.io import loadmat
+                sources = []
+                for fname,name in zip(fnames,('eegT','eegNT')):
+                    try:
+                        sources.append(loadmat(fname)[name].transpose(2,0,1))
+                    except NotImplementedError:
+                        # MATLAB v7.3 file, which is HDF5
+                        h5py = _import_h5py()
+                        if h5py is None:
+                            raise ImportError('h5py is needed to read MATLAB v7.3 file %s' %fname)
+                        files.append(h5py.File(fname,'r'))
+                        sources.append(_MatlabDataset(files[-1][name]))
+                yield tuple(sources)
+        finally:
+            for f in files:
+                f.close()
+
+    def ingest(self,subject,fmt='h5',chunk_trials=16,chunk_time=64):
+        '''
+        Converts eegT.mat and eegNT.mat (MATLAB v5 or v7.3) of a subject into a store in the subject's folder.
+        get_data uses the store instead of .mat files and reads only the needed time range from it
+        :param fmt: 'h5' - file eeg.h5 (needs h5py) with datasets eegT and eegNT (Trials x Time x Channels),
+                    chunked by trials and time; 'npy' - folder eeg_npy with eegT.npy and eegNT.npy
+                    (Trials x Time x Channels), which are memory-mapped on reading
+        :param chunk_trials: int, trials per chunk of eeg.h5
+        :param chunk_time: int, time samples per chunk of eeg.h5
+        :return: list of written files
+        '''
+        if fmt not in ('h5','npy'):
+            raise ValueError('Unknown store format %s' %fmt)
+        subject_dir = os.path.join(self.path_to_data,str(subject))
+        target = os.path.join(subject_dir,_STORE_H5 if fmt == 'h5' else _STORE_NPY)
+        # Write to a temporary name first, so get_data never sees a half-written store
+        tmp_target = '%s.tmp%d' %(target,os.getpid())
+        with self._open_sources(subject,store=False) as sources:
+            if fmt == 'h5':
+                h5py = _import_h5py()
+                if h5py is None:
+                    raise ImportError('h5py is needed for the HDF5 store, use fmt=\'npy\' instead')
+                with h5py.File(tmp_target,'w') as f:
+                    for name,eeg in zip(('eegT','eegNT'),sources):
+                        chunks = (min(chunk_trials,eeg.shape[0]),min(chunk_time,eeg.shape[1]),eeg.shape[2])
+                        f.create_dataset(name,data=np.asarray(eeg[:,:,:]),chunks=chunks)
+            else:
+                os.makedirs(tmp_target)
+                for name,eeg in zip(('eegT','eegNT'),sources):
+                    np.save(os.path.join(tmp_target,'%s.npy' %name),np.ascontiguousarray(eeg[:,:,:]))
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.isfile(target):
+            os.remove(target)
+        os.rename(tmp_target,target)
+        return self._source_files(subject)
+
+    def _cache_params(self,subject,windows,baseline_window,resample_to,dtype):
+        '''
+        Everything (except the source files) that defines preprocessed data of a subject
+        '''
+        if windows is not None:
+            windows = [tuple(window) for window in windows]
+        return [_CACHE_VERSION, str(subject), self.start_epoch, self.end_epoch, self.sample_rate,
+                windows, tuple(baseline_window), resample_to, self.resample_method, np.dtype(dtype).str]
+
+    def _source_stats(self,subject):
+        return [[os.path.basename(fname), os.path.getsize(fname), os.path.getmtime(fname)]
+                for fname in self._source_files(subject)]
+
+    def _load_subject(self,subject,windows=None,baseline_window=(),resample_to=None,dtype=np.float32):
+        '''
+        Reads and preprocesses data of one subject
+        :return: tuple of 2 numpy arrays: data (Trials x Time x Channels) and labels
+        '''
+        sample_rate = self.sample_rate
+        with self._open_sources(subject) as (eegT,eegNT):
+            x_len = eegT.shape[1]
+            start,end = self._needed_range(x_len,windows,baseline_window,resample_to)
+            X = self._assemble(eegT,eegNT,baseline_window,dtype,start,end)
+            y = np.hstack((np.ones(eegT.shape[0]),np.zeros(eegNT.shape[0])))
             #y = np.hstack(np.repeat([[1,0]],eegT.shape[2],axis=0),np.repeat([[0,1]],eegT.shape[2],axis=0))
 
-            if (resample_to is not None) and (resample_to != self.sample_rate):
-                X, y = self._resample(X, y, resample_to)
+        if resample_to is not None and windows is not None and self.resample_method != 'mne':
+            return self._resample_windows(X,self._resample_plan(x_len,resample_to,windows),start),y
 
-            time_indices=[]
-            if windows is not None:
-                for win_start,win_end in windows:
-                    start_window_ind = int((win_start - self.start_epoch)*self.sample_rate)
-                    end_window_ind = int((win_end - self.start_epoch)*self.sample_rate)
-                    time_indices.extend(range(start_window_ind,end_window_ind))
-                X,y = X[:,time_indices,:],y
+        if resample_to is not None:
+            X, y = self._resample(X, y, resample_to)
+            sample_rate = resample_to
 
-            if shuffle:
-                X,y = data_shuffle(X,y)
-            res[subject]=(X,y)
+        if windows is not None:
+            return self._cut_windows(X,self._window_indices(windows,sample_rate),start),y
+        return np.ascontiguousarray(X),y
+
+    def _get_subject(self,subject,windows=None,baseline_window=(),resample_to=None,dtype=np.float32):
+        '''
+        Same as _load_subject, but goes through the cache if cache_dir is set.
+        Cached data is returned as read-only memory-mapped array.
+        A cache entry is rebuilt if the source files (see _source_files) were changed after it was written.
+        '''
+        if self.cache_dir is None:
+            return self._load_subject(subject,windows,baseline_window,resample_to,dtype)
+
+        params = self._cache_params(subject,windows,baseline_window,resample_to,dtype)
+        key = hashlib.sha1(repr(params).encode('utf8')).hexdigest()
+        entry = os.path.join(self.cache_dir,str(subject),key)
+        stats = self._source_stats(subject)
+        try:
+            with open(os.path.join(entry,'meta.json'),'r') as f:
+                fresh = json.load(f)['sources'] == stats
+        except (IOError, OSError, ValueError, KeyError):
+            fresh = False
+        if fresh:
+            return np.load(os.path.join(entry,'X.npy'),mmap_mode='r'), np.load(os.path.join(entry,'y.npy'))
+
+        X,y = self._load_subject(subject,windows,baseline_window,resample_to,dtype)
+        # Write to a temporary folder first, so an interrupted run never leaves a broken entry
+        tmp_entry = '%s.tmp%d' %(entry,os.getpid())
+        if os.path.isdir(tmp_entry):
+            shutil.rmtree(tmp_entry)
+        os.makedirs(tmp_entry)
+        np.save(os.path.join(tmp_entry,'X.npy'),X)
+        np.save(os.path.join(tmp_entry,'y.npy'),y)
+        with open(os.path.join(tmp_entry,'meta.json'),'w') as f:
+            json.dump({'params':repr(params),'sources':stats},f)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)  # stale entry
+        os.rename(tmp_entry,entry)
+        return np.load(os.path.join(entry,'X.npy'),mmap_mode='r'), y
+
+    def _load_parallel(self,subjects,n_jobs,windows=None,baseline_window=(),resample_to=None,dtype=np.float32):
+        '''
+        Loads subjects in a pool of n_jobs processes
+        :return: Dict {Subject_number:(X, y)}. Empty if there is a cache: then the subjects are just
+                 stored there and _get_subject maps them in
+        '''
+        out_dir = None if self.cache_dir is not None else tempfile.mkdtemp(prefix='eeg_data_')
+        res = {}
+        try:
+            with ProcessPoolExecutor(max_workers=min(n_jobs,len(subjects))) as executor:
+                futures = [(subject,executor.submit(_load_subject_job,self,subject,windows,baseline_window,
+                                                    resample_to,dtype,out_dir))
+                           for subject in subjects]
+                for subject,future in futures:
+                    fnames = future.result()
+                    if fnames is not None:
+                        res[subject] = (np.load(fnames[0]), np.load(fnames[1]))
+        finally:
+            if out_dir is not None:
+                shutil.rmtree(out_dir)
         return res
 
+    def get_data(self,subjects,shuffle=True,windows=None,baseline_window=(),resample_to=None,
+                 lazy=False,prefetch=True,max_memory=None,n_jobs=1,dtype=np.float32):
+        '''
+
+        :param subjects: list subject's numbers, wich data we want to load
+        :param shuffle: bool
+        :param windows: list of tuples. Each tuple contains two floats - start and end of window in seconds
+        :param baseline_window: tuple of start time and end time of a baseline
+        :param resample_to: int, new sample rate. None or 0 means no resampling
+        :param lazy: bool, if True, subjects are loaded on first access instead of all at once
+        :param prefetch: bool, only for lazy: load the next subject in background while the current one is used
+        :param max_memory: int, only for lazy: memory cap in bytes for loaded subjects (None - no limit,
+                           0 - keep only the last accessed subject)
+        :param n_jobs: int, number of processes for loading and preprocessing of subjects (-1 means all cores).
+                       Together with lazy it is used only if there is a cache, to fill the cache in advance.
+                       On platforms without fork, the calling script should be protected by
+                       if __name__ == '__main__'
+        :param dtype: numpy float type of the data. All preprocessing after reading of .mat files
+                      (and the cache) works in this type; float32 is what Keras uses anyway
+        :return: Dict (or LazySubjectData if lazy). {Subject_number:tuple of 2 numpy arrays:
+                 data (Trials x Time x Channels) and labels}
+        '''
+        if (not resample_to) or (resample_to == self.sample_rate):
+            resample_to = None
+        if n_jobs < 0:
+            n_jobs = multiprocessing.cpu_count()
+        preloaded = {}
+        if n_jobs > 1 and len(subjects) > 1 and (self.cache_dir is not None or not lazy):
+            preloaded = self._load_parallel(subjects,n_jobs,windows,baseline_window,resample_to,dtype)
+
+        def load(subject):
+            if subject in preloaded:
+                X,y = preloaded.pop(subject)
+            else:
+                X,y = self._get_subject(subject,windows,baseline_window,resample_to,dtype)
+            if shuffle:
+                # Freshly loaded data is shuffled in place, cached read-only data is copied
+                X,y = data_shuffle(X,y,inplace=X.flags.writeable)
+            return X,y
+
+        if lazy:
+            return LazySubjectData(load,subjects,prefetch=prefetch,max_memory=max_memory)
+        res={}
+        for subject in subjects:
+            res[subject]=load(subject)
+        return res
 
 
 
@@ -0,0 +1,19 @@
+'''
+Converts eegT.mat and eegNT.mat of subjects into stores, which DataBuildClassifier.get_data reads partially
+(see DataBuildClassifier.ingest).
+Usage: python ingest.py path_to_data [h5|npy] [subject ...]
+Without subjects all subject folders of path_to_data are converted
+'''
+from __future__ import print_function
+import os
+import sys
+from data import DataBuildClassifier
+
+if __name__ == '__main__':
+    path_to_data = sys.argv[1]
+    fmt = sys.argv[2] if len(sys.argv) > 2 else 'h5'
+    subjects = sys.argv[3:] or sorted(name for name in os.listdir(path_to_data)
+                                      if os.path.isfile(os.path.join(path_to_data,name,'eegT.mat')))
+    data = DataBuildClassifier(path_to_data)
+    for subject in subjects:
+        print(subject, ' '.join(data.ingest(subject,fmt)))